@@ -55,6 +55,8 @@ from eutester.machine import Machine
 from eutester.euvolume import EuVolume
 from eutester import eulogger
 from eutester.sshconnection import CommandExitCodeException
+from concurrent.futures import ThreadPoolExecutor
+from prettytable import PrettyTable
 import re
 import os
 from socket import error as socketerror
@@ -68,7 +70,7 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops, CFNops):
                  as_ip=None, as_path=None, elb_ip=None, elb_path=None, cw_ip=None, cw_path=None,
                  cfn_ip=None, cfn_path=None, sts_ip=None, sts_path=None, force_cert_create=False,
                  port=8773, download_creds=True, boto_debug=0, debug_method=None, region=None,
-                 ssh_proxy=None):
+                 ssh_proxy=None, use_ssh_pool=False, bootstrap_threads=1):
         self.config_file = config_file 
         self.APIVersion = APIVersion
         self.eucapath = "/opt/eucalyptus"
@@ -99,6 +101,10 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops, CFNops):
         self._property_manager = None
         self.cred_zipfile = None
         self.ssh_proxy = None #SshConnection obj to be used as a default ssh proxy
+        self.bootstrap_threads = bootstrap_threads #Number of machines to connect to concurrently in read_config
+        self.machine_connect_times = {}
+        #Share pooled ssh transports between this tester's Machine, Eunode and EuInstance objs
+        self.use_ssh_pool = use_ssh_pool
 
         if self.config_file is not None:
             ## read in the config file
@@ -368,11 +374,25 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops, CFNops):
     def cleanup_artifacts(self,instances=True, snapshots=True, volumes=True,
                           load_balancers=True, ip_addresses=True,
                           auto_scaling_groups=True, launch_configurations=True,
-                          keypairs=True, images=True):
+                          keypairs=True, images=True, parallel=False, worker_threads=4):
         """
         Description: Attempts to remove artifacts created during and through this
         eutester's lifespan.
+
+        :param parallel: boolean, if True use cleanup_artifacts_concurrently()
+        :param worker_threads: max number of artifact types removed at once when parallel is set
         """
+        if parallel:
+            return self.cleanup_artifacts_concurrently(instances=instances,
+                                                       snapshots=snapshots,
+                                                       volumes=volumes,
+                                                       load_balancers=load_balancers,
+                                                       ip_addresses=ip_addresses,
+                                                       auto_scaling_groups=auto_scaling_groups,
+                                                       launch_configurations=launch_configurations,
+                                                       keypairs=keypairs,
+                                                       images=images,
+                                                       worker_threads=worker_threads)
         failmsg = ""
         failcount = 0
         self.debug("Starting cleanup of artifacts")
@@ -447,6 +467,23 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops, CFNops):
                 failcount +=1
                 failmsg += str(tb) + "\nError#:"+ str(failcount)+ ":" + str(e)+"\n"
 
+        errors = self.delete_remaining_test_resources(images=images)
+        failcount += len(errors)
+        failmsg += "".join(errors)
+        if failmsg:
+            failmsg += "\nFound " + str(failcount) + " number of errors while cleaning up. " \
+                                                     "See above"
+            raise Exception(failmsg)
+
+    def delete_remaining_test_resources(self, images=True):
+        """
+        Attempts to delete/deregister every item left in test_resources. Reservations are skipped,
+        see cleanup_test_instances().
+
+        :param images: boolean, if True images will be deregistered
+        :returns: list of error strings, one per item which could not be removed
+        """
+        errors = []
         for key,array in self.test_resources.iteritems():
             for item in array:
                 try:
@@ -467,13 +504,116 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops, CFNops):
                                            + str(item))
                 except Exception, e:
                     tb = self.get_traceback()
-                    failcount += 1
-                    failmsg += str(tb) + "\nUnable to delete item: " + str(item) + "\n" + \
-                               str(e)+"\n"
+                    errors.append(str(tb) + "\nUnable to delete item: " + str(item) + "\n" +
+                                  str(e)+"\n")
+        return errors
+
+    def cleanup_artifacts_concurrently(self, instances=True, snapshots=True, volumes=True,
+                                       load_balancers=True, ip_addresses=True,
+                                       auto_scaling_groups=True, launch_configurations=True,
+                                       keypairs=True, images=True, worker_threads=4):
+        """
+        Description: Dependency aware version of cleanup_artifacts(). Artifact types are
+        removed in stages, types within the same stage are removed concurrently:
+            1) auto scaling groups, load balancers
+            2) instances (bulk terminate request), launch configurations
+            3) volumes, ip addresses
+            4) snapshots
+            5) images and all other remaining test resources
+        A per type timing summary is printed when done.
+
+        :param worker_threads: max number of artifact types removed at once within a stage
+        """
+        def cleanup_volumes():
+            self.clean_up_test_volumes(timeout_per_vol=60)
+            self.test_resources['volumes'] = []
+
+        def cleanup_remaining():
+            errors = self.delete_remaining_test_resources(images=images)
+            if errors:
+                raise Exception("".join(errors) + "\nFound " + str(len(errors)) +
+                                " errors deleting remaining test resources")
+
+        stages = [[('auto_scaling_groups', auto_scaling_groups, self.cleanup_autoscaling_groups),
+                   ('load_balancers', load_balancers, self.cleanup_load_balancers)],
+                  [('instances', instances, self.cleanup_test_instances),
+                   ('launch_configurations', launch_configurations, self.cleanup_launch_configs)],
+                  [('volumes', volumes, cleanup_volumes),
+                   ('ip_addresses', ip_addresses, self.cleanup_addresses)],
+                  [('snapshots', snapshots, self.cleanup_test_snapshots)],
+                  [('remaining_resources', True, cleanup_remaining)]]
+
+        def run_cleanup(name, method):
+            start = time.time()
+            error = None
+            self.debug("Starting cleanup of: " + str(name))
+            try:
+                method()
+            except Exception, e:
+                error = str(self.get_traceback()) + "\n" + str(name) + " cleanup error:" + str(e) + "\n"
+            return (name, time.time() - start, error)
+
+        self.debug("Starting concurrent cleanup of artifacts")
+        cleanup_start = time.time()
+        results = []
+        for stage in stages:
+            tasks = [(name, method) for name, enabled, method in stage if enabled]
+            if not tasks:
+                continue
+            stage_start = time.time()
+            with ThreadPoolExecutor(max_workers=max(1, min(worker_threads, len(tasks)))) as executor:
+                futures = [executor.submit(run_cleanup, name, method) for name, method in tasks]
+            results.extend(future.result() for future in futures)
+            self.debug("Cleanup stage:" + ",".join(name for name, method in tasks) +
+                       " done after:{0:.2f}s".format(time.time() - stage_start))
+        pt = PrettyTable(['ARTIFACT TYPE', 'ELAPSED (sec)', 'RESULT'])
+        pt.align['ARTIFACT TYPE'] = 'l'
+        failmsg = ""
+        for name, elapsed, error in results:
+            pt.add_row([name, "{0:.2f}".format(elapsed), 'FAILED' if error else 'OK'])
+            if error:
+                failmsg += error
+        pt.add_row(['TOTAL', "{0:.2f}".format(time.time() - cleanup_start), ''])
+        self.debug("\n" + str(pt))
         if failmsg:
-            failmsg += "\nFound " + str(failcount) + " number of errors while cleaning up. " \
-                                                     "See above"
-            raise Exception(failmsg)
+            raise Exception(failmsg + "\nFound errors while cleaning up. See above")
+
+    def cleanup_test_instances(self, timeout=480):
+        """
+        Terminates all instances in test_resources['reservations'] using as few terminate
+        requests as possible, then monitors all of them to the terminated state at once.
+        """
+        instance_list = []
+        for res in self.test_resources["reservations"]:
+            if isinstance(res, Instance):
+                instance_list.append(res)
+            elif isinstance(res, Reservation):
+                instance_list.extend(res.instances)
+        if not instance_list:
+            return
+        ids = [instance.id for instance in instance_list]
+        self.debug('Sending terminate for instances:' + ",".join(ids))
+        for index in xrange(0, len(ids), self.max_describe_ids):
+            chunk = ids[index:index + self.max_describe_ids]
+            try:
+                self.ec2.terminate_instances(instance_ids=chunk)
+            except EC2ResponseError, e:
+                if e.status != 400:
+                    raise e
+                # An instance in this request no longer exists, fall back to one id per request
+                for instance_id in chunk:
+                    try:
+                        self.ec2.terminate_instances(instance_ids=[instance_id])
+                    except EC2ResponseError, ie:
+                        if ie.status != 400:
+                            raise ie
+                        self.debug('Instance:' + str(instance_id) + ' not found, assuming terminated')
+                        for instance in instance_list:
+                            if instance.id == instance_id:
+                                instance_list.remove(instance)
+        self.monitor_euinstances_to_state(instance_list=instance_list, state='terminated',
+                                          timeout=timeout)
+        self.test_resources["reservations"] = []
 
     def cleanup_load_balancers(self, lbs=None):
         """
@@ -661,8 +801,11 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops, CFNops):
             self.debug("Current resources in the system:\n" + str(current_artifacts))
         return current_artifacts
     
-    def read_config(self, filepath, username="root"):
+    def read_config(self, filepath, username="root", worker_threads=None):
         """ Parses the config file at filepath returns a dictionary with the config
+            If worker_threads (default: self.bootstrap_threads) is greater than 1, the CLC is
+            created first and then all other machines are connected to concurrently using that
+            many threads. Per host connect times are stored in self.machine_connect_times.
             Config file
             ----------
             The configuration file for (2) private cloud mode has the following structure:
@@ -751,23 +894,51 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops, CFNops):
                                     ssh_proxy_host=proxy_host,
                                     ssh_proxy_keypath=proxy_keypath,
                                     ssh_proxy_username=proxy_username,
-                                    ssh_proxy_password=proxy_password
+                                    ssh_proxy_password=proxy_password,
+                                    use_ssh_pool=self.use_ssh_pool
                                     )
             if proxy_host:
                 self.debug(self.markup('Machine at:"{0}" successfully create using ssh proxy'
                            .format(machine_dict["hostname"]),[1,32]))
             return cloud_machine
 
+        def connect_cloud_machine(machine_dict, ssh_proxy=None):
+            # Create the machine and establish its ssh session, record how long it took
+            start = time.time()
+            cloud_machine = create_cloud_machine(machine_dict, ssh_proxy)
+            try:
+                cloud_machine.ssh
+            except Exception, e:
+                self.debug(self.markup('Failed to connect to:"{0}", err:"{1}"'
+                                       .format(machine_dict["hostname"], e), [1,31]))
+            self.machine_connect_times[machine_dict["hostname"]] = time.time() - start
+            return cloud_machine
+
+        worker_threads = worker_threads or self.bootstrap_threads or 1
+        bootstrap_start = time.time()
+        clc = None
         # Create the CLC first in order to use it as an ssh proxy if one was not provided..
         for machine_dict in machine_dicts:
             if 'clc' in machine_dict['components']:
-                clc = create_cloud_machine(machine_dict, self.ssh_proxy)
+                if worker_threads > 1:
+                    clc = connect_cloud_machine(machine_dict, self.ssh_proxy)
+                else:
+                    clc = create_cloud_machine(machine_dict, self.ssh_proxy)
                 machine_dicts.remove(machine_dict)
                 machines.append(clc)
         # Now create the other machine objects...
-        for machine_dict in machine_dicts:
-            cloud_machine = create_cloud_machine(machine_dict, self.ssh_proxy or clc)
-            machines.append(cloud_machine)
+        if worker_threads > 1:
+            with ThreadPoolExecutor(max_workers=worker_threads) as executor:
+                futures = [executor.submit(connect_cloud_machine, machine_dict, self.ssh_proxy or clc)
+                           for machine_dict in machine_dicts]
+            # Keep the machine order of the config file
+            for future in futures:
+                machines.append(future.result())
+            self.show_machine_connect_times(elapsed=time.time() - bootstrap_start)
+        else:
+            for machine_dict in machine_dicts:
+                cloud_machine = create_cloud_machine(machine_dict, self.ssh_proxy or clc)
+                machines.append(cloud_machine)
 
         ### LOOK for network mode in config file if not found then set it unknown
         for param in ["network", "managed_ips", "subnet_ip"]:
@@ -782,6 +953,23 @@ class Eucaops(EC2ops,S3ops,IAMops,STSops,CWops, ASops, ELBops, CFNops):
         return config_hash
 
 
+    def show_machine_connect_times(self, elapsed=None, printmethod=None):
+        """
+        Prints a table of the per host connect times recorded by read_config()
+
+        :param elapsed: optional total elapsed time to include in the table
+        :param printmethod: optional method used to print the table, default self.debug
+        """
+        printmethod = printmethod or self.debug
+        pt = PrettyTable(['HOSTNAME', 'CONNECT TIME (sec)'])
+        pt.align['HOSTNAME'] = 'l'
+        for hostname, connect_time in sorted(self.machine_connect_times.iteritems(),
+                                             key=lambda x: x[1], reverse=True):
+            pt.add_row([hostname, "{0:.2f}".format(connect_time)])
+        if elapsed is not None:
+            pt.add_row(['TOTAL ELAPSED', "{0:.2f}".format(elapsed)])
+        printmethod("\n" + str(pt))
+
     def update_property_manager(self,machine=None):
         machine = machine or self.clc
         if not machine:
@@ -39,11 +39,14 @@ import hashlib
 import base64
 import json
 import time
+import random
 import types
 import traceback
+import threading
 from datetime import datetime, timedelta
 from subprocess import Popen, PIPE
 from prettytable import PrettyTable, ALL
+from concurrent.futures import ThreadPoolExecutor
 from boto.ec2.address import Address
 from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
 from boto.ec2.bundleinstance import BundleInstanceTask
@@ -65,11 +68,13 @@ import boto
 
 from eutester import Eutester
 import eutester
+from eutester.timer import metrics, TokenBucket
 from eutester.euinstance import EuInstance
 from eutester.windows_instance import WinInstance
 from eutester.euvolume import EuVolume
 from eutester.eusnapshot import EuSnapshot
 from eutester.euzone import EuZone
+from eutester.sec_group_rules import CompiledRuleSet, cidr_to_range, ip_to_int
 from testcases.cloud_user.images.conversiontask import ConversionTask
 
 class EucaSubnet(BotoSubnet):
@@ -119,6 +124,19 @@ class EC2ops(Eutester):
 
     enable_root_user_data = """#cloud-config
 disable_root: false"""
+    # Max number of resource ids included in a single filtered describe request by the batch updaters
+    max_describe_ids = 200
+    # Max number of instances checked concurrently by monitor_euinstances_to_running()
+    instance_monitor_threads = 10
+    # Seconds describe responses used by the get_* helpers are cached for, 0 disables the cache. See describe()
+    describe_cache_ttl = 0
+    # Defaults used by issue_requests() for the concurrent create_volumes()/create_snapshots() modes
+    issue_threads = 10
+    issue_rate = None
+    issue_max_retries = 5
+    issue_max_backoff = 30
+    throttle_error_codes = ['RequestLimitExceeded', 'Throttling', 'ThrottlingException',
+                            'RequestThrottled', 'SlowDown', 'ServiceUnavailable']
 
     @Eutester.printinfo
     def __init__(self,
@@ -211,12 +229,79 @@ disable_root: false"""
             self.debug("Attempting to create ec2 connection to " + ec2_region.endpoint + ':' + str(port) + path)
             self.ec2 = boto.connect_vpc(**ec2_connection_args)
             #self.ec2 = boto.connect_ec2(**ec2_connection_args)
+            metrics.instrument_boto_connection(self.ec2, 'ec2')
+            self.setup_describe_cache()
         except Exception, e:
             self.critical("Was unable to create ec2 connection because of exception: " + str(e))
 
         #Source ip on local test machine used to reach instances
         self.ec2_source_ip = None
 
+    def setup_describe_cache(self, ttl=None):
+        """
+        Initializes the describe response cache used by describe() and hooks the ec2 connection so any
+        non-describe request (run, terminate, create, delete, attach, etc..) invalidates the cache.
+        :param ttl: seconds to cache describe responses, 0 disables caching. Defaults to EC2ops.describe_cache_ttl
+        """
+        if ttl is not None:
+            self.describe_cache_ttl = ttl
+        self._describe_cache = {}
+        self._describe_cache_lock = threading.Lock()
+        self.describe_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        if getattr(self.ec2, '_eutester_describe_cache', None):
+            return
+        make_request = self.ec2.make_request
+        def make_request_with_invalidation(action, *args, **kwargs):
+            if not str(action).startswith('Describe'):
+                self.invalidate_describe_cache()
+            return make_request(action, *args, **kwargs)
+        self.ec2.make_request = make_request_with_invalidation
+        self.ec2._eutester_describe_cache = True
+
+    def invalidate_describe_cache(self):
+        """
+        Drops all cached describe responses
+        """
+        if not getattr(self, '_describe_cache', None):
+            return
+        with self._describe_cache_lock:
+            self._describe_cache = {}
+            self.describe_cache_stats['invalidations'] += 1
+
+    def describe(self, method_name, *args, **kwargs):
+        """
+        Calls self.ec2.<method_name>(*args, **kwargs), ie: describe('get_all_volumes', filters=filters).
+        When describe_cache_ttl is set, responses are cached for that many seconds keyed by the call and its
+        arguments, and the cache is invalidated by any mutating request made on self.ec2.
+        Note cached responses return the same boto objects to each caller.
+        """
+        ttl = self.describe_cache_ttl
+        method = getattr(self.ec2, method_name)
+        if not ttl or getattr(self, '_describe_cache', None) is None:
+            return method(*args, **kwargs)
+        key = (method_name, repr(args), repr(sorted(kwargs.items())))
+        now = time.time()
+        with self._describe_cache_lock:
+            cached = self._describe_cache.get(key)
+            if cached and now - cached[0] < ttl:
+                self.describe_cache_stats['hits'] += 1
+                return list(cached[1])
+            self.describe_cache_stats['misses'] += 1
+        response = method(*args, **kwargs)
+        with self._describe_cache_lock:
+            self._describe_cache[key] = (now, response)
+        return list(response)
+
+    def show_describe_cache_stats(self, printmethod=None):
+        stats = getattr(self, 'describe_cache_stats', None) or {'hits': 0, 'misses': 0, 'invalidations': 0}
+        total = stats['hits'] + stats['misses']
+        pt = PrettyTable(['TTL', 'HITS', 'MISSES', 'HIT RATE', 'INVALIDATIONS', 'CACHED'])
+        pt.add_row([self.describe_cache_ttl, stats['hits'], stats['misses'],
+                    "{0:.1f}%".format(100.0 * stats['hits'] / (total or 1)), stats['invalidations'],
+                    len(getattr(self, '_describe_cache', None) or {})])
+        printmethod = printmethod or self.debug
+        printmethod("\n" + str(pt) + "\n")
+
     def setup_ec2_resource_trackers(self):
         """
         Setup keys in the test_resources hash in order to track artifacts created
@@ -1008,6 +1093,108 @@ disable_root: false"""
         return aggregate_result
     
     
+    def is_throttle_error(self, error):
+        """
+        Returns True if 'error' is a request throttling/service busy response which can be retried
+        """
+        return bool(getattr(error, 'error_code', None) in self.throttle_error_codes or
+                    getattr(error, 'status', None) == 503)
+
+    def issue_requests(self, request_method, count, worker_threads=None, request_rate=None,
+                       max_retries=None, eof=True):
+        """
+        Calls request_method(order) for order in 0..count-1 from up to 'worker_threads' threads, paced to
+        'request_rate' requests per second by a shared token bucket. Requests failing with a throttle error
+        (see is_throttle_error()) are retried with exponential backoff up to 'max_retries' times.
+
+        :param request_method: method called with the request's order, returns the created resource
+        :param count: number of requests to issue
+        :param worker_threads: max requests in flight, defaults to EC2ops.issue_threads
+        :param request_rate: target requests per second, None or 0 for no pacing. Defaults to EC2ops.issue_rate
+        :param max_retries: retries per request on throttle errors. Defaults to EC2ops.issue_max_retries
+        :param eof: boolean, if True requests not yet issued are cancelled after the first failure
+        :returns: list of dicts, one per request in order, with keys: order, result, error, cmdstart (time of
+                  the first attempt), cmdtime (seconds from first attempt to response), retries
+        """
+        worker_threads = worker_threads or self.issue_threads
+        request_rate = self.issue_rate if request_rate is None else request_rate
+        max_retries = self.issue_max_retries if max_retries is None else max_retries
+        bucket = TokenBucket(rate=request_rate)
+        cancelled = threading.Event()
+
+        def issue(order):
+            record = {'order': order, 'result': None, 'error': None,
+                      'cmdstart': None, 'cmdtime': None, 'retries': 0}
+            while not cancelled.is_set():
+                bucket.consume()
+                if record['cmdstart'] is None:
+                    record['cmdstart'] = time.time()
+                try:
+                    record['result'] = request_method(order)
+                    record['cmdtime'] = time.time() - record['cmdstart']
+                    return record
+                except Exception, e:
+                    if self.is_throttle_error(e) and record['retries'] < max_retries:
+                        record['retries'] += 1
+                        backoff = min(self.issue_max_backoff, 2 ** record['retries']) * random.uniform(0.5, 1)
+                        self.debug('Request #' + str(order) + ' throttled, retry ' + str(record['retries']) +
+                                   '/' + str(max_retries) + ' in ' + "{0:.2f}".format(backoff) +
+                                   ' seconds. Err:' + str(e))
+                        time.sleep(backoff)
+                        continue
+                    record['error'] = e
+                    record['cmdtime'] = time.time() - record['cmdstart']
+                    if eof:
+                        cancelled.set()
+                    return record
+            record['error'] = Exception('Request #' + str(order) + ' cancelled after an earlier request failed')
+            return record
+
+        start = time.time()
+        if count <= 0:
+            return []
+        with ThreadPoolExecutor(max_workers=max(1, min(worker_threads, count))) as executor:
+            records = list(executor.map(issue, xrange(0, count)))
+        elapsed = time.time() - start
+        failures = [r for r in records if r['error']]
+        self.debug('Issued ' + str(count) + ' requests in ' + "{0:.2f}".format(elapsed) + ' seconds (' +
+                   "{0:.2f}".format(count / (elapsed or 1)) + '/sec, target:' + str(request_rate or 'none') +
+                   '), throttle retries:' + str(sum([r['retries'] for r in records])) +
+                   ', rate limit wait:' + "{0:.2f}".format(bucket.waited) + ', failures:' + str(len(failures)))
+        return records
+
+    def show_issue_report(self, resources, state=None, printmethod=None, printme=True):
+        """
+        Displays a table of issue latency vs time to reach 'state' for a list of EuVolumes or EuSnapshots
+        created by create_volumes()/create_snapshots()
+        :param resources: list of EuVolume or EuSnapshot objs
+        :param state: the state the resources were monitored to, ie 'available' or 'completed'
+        :param printme: boolean, if True the table will be printed, else the PrettyTable obj is returned
+        """
+        pt = PrettyTable(['ID', 'ORDER', 'ISSUE LATENCY', 'RETRIES', 'TIME TO ' + str(state or 'STATE').upper(),
+                          'STATUS'])
+        issue_times = []
+        ready_times = []
+        for resource in sorted(resources, key=lambda x: x.eutest_createorder):
+            ready = None
+            if state and resource.eutest_laststatus == state:
+                ready = float(resource.eutest_ageatstatus)
+                ready_times.append(ready)
+            if resource.eutest_cmdtime is not None:
+                issue_times.append(float(resource.eutest_cmdtime))
+            pt.add_row([resource.id, resource.eutest_createorder, resource.eutest_cmdtime,
+                        getattr(resource, 'eutest_issue_retries', 0),
+                        "{0:.2f}".format(ready) if ready is not None else None,
+                        resource.eutest_laststatus])
+        for label, method in [('MEAN', lambda x: sum(x) / len(x)), ('MAX', max)]:
+            pt.add_row(['', label,
+                        "{0:.2f}".format(method(issue_times)) if issue_times else None, '',
+                        "{0:.2f}".format(method(ready_times)) if ready_times else None, ''])
+        if not printme:
+            return pt
+        printmethod = printmethod or self.debug
+        printmethod("\n" + str(pt) + "\n")
+
     @Eutester.printinfo
     def create_volume(self, zone, size=1, eof=True, snapshot=None, timeout=0, poll_interval=10,timepergig=120):
         """
@@ -1039,11 +1226,17 @@ disable_root: false"""
                        snapshot = None, 
                        timeout=0, 
                        poll_interval = 10,
-                       timepergig = 120 ):
+                       timepergig = 120,
+                       concurrent = False,
+                       worker_threads = None,
+                       request_rate = None,
+                       max_retries = None):
         """
         Definition:
                     Create a multiple new EBS volumes then wait for them to go to available state, 
                     size or snapshot is mandatory
+                    In concurrent mode the create requests are issued from worker_threads threads at up to
+                    request_rate requests/sec, retrying throttled requests, see issue_requests()
 
         :param zone: Availability zone to create the volume in
         :param size: Size of the volume to be created
@@ -1055,6 +1248,10 @@ disable_root: false"""
         :param timeout: Time to wait before failing. timeout of 0 results in size of volume * timepergig seconds
         :param poll_interval: How often in seconds to poll volume state
         :param timepergig: Time to wait per gigabyte size of volume, used when timeout is set to 0
+        :param concurrent: boolean, if True issue the create requests concurrently, 'delay' is ignored
+        :param worker_threads: max create requests in flight in concurrent mode
+        :param request_rate: target create requests per second in concurrent mode, None for no pacing
+        :param max_retries: retries per throttled create request in concurrent mode
         :return: list of volumes
         """
         start = time.time()
@@ -1073,30 +1270,53 @@ disable_root: false"""
         
         if snapshot and not hasattr(snapshot,'eutest_volumes'):
                 snapshot = self.get_snapshot(snapshot.id)
+        def create_volume_request(x):
+            cmdstart = time.time()
+            vol = self.ec2.create_volume(size, zone, snapshot)
+            cmdtime =  time.time() - cmdstart
+            if vol:
+                vol = EuVolume.make_euvol_from_vol(vol, tester=self, cmdstart=cmdstart)
+                vol.eutest_cmdstart = cmdstart
+                vol.eutest_createorder = x
+                vol.eutest_cmdtime = "{0:.2f}".format(cmdtime)
+                vol.size = size
+            return vol
+
         self.debug( "Sending create volume request, count:"+str(count) )
-        for x in xrange(0,count):
-            vol = None
-            try:
-                cmdstart = time.time()
-                vol = self.ec2.create_volume(size, zone, snapshot)
-                cmdtime =  time.time() - cmdstart 
+        if concurrent:
+            for record in self.issue_requests(create_volume_request, count, worker_threads=worker_threads,
+                                              request_rate=request_rate, max_retries=max_retries, eof=eof):
+                vol = record['result']
                 if vol:
-                    vol = EuVolume.make_euvol_from_vol(vol, tester=self, cmdstart=cmdstart)
-                    vol.eutest_cmdstart = cmdstart
-                    vol.eutest_createorder = x
-                    vol.eutest_cmdtime = "{0:.2f}".format(cmdtime)
-                    vol.size = size
+                    #Issue latency includes time spent in throttle retries
+                    vol.eutest_cmdstart = record['cmdstart']
+                    vol.eutest_cmdtime = "{0:.2f}".format(record['cmdtime'])
+                    vol.eutest_issue_retries = record['retries']
                     volumes.append(vol)
-            except Exception, e:
-                if eof:
-                    #Clean up any volumes from this operation and raise exception
-                    for vol in volumes:
-                        vol.delete()
-                    raise e
-                else:
-                    self.debug("Caught exception creating volume,eof is False, continuing. Error:"+str(e))
-            if delay:
-                time.sleep(delay)
+                elif record['error']:
+                    self.debug("Caught exception creating volume #" + str(record['order']) + ". Error:" +
+                               str(record['error']))
+            if eof and len(volumes) < count:
+                #Clean up any volumes from this operation and raise exception
+                for vol in volumes:
+                    vol.delete()
+                raise Exception("Created "+str(len(volumes))+"/"+str(count)+' volumes with eof set')
+        else:
+            for x in xrange(0,count):
+                try:
+                    vol = create_volume_request(x)
+                    if vol:
+                        volumes.append(vol)
+                except Exception, e:
+                    if eof:
+                        #Clean up any volumes from this operation and raise exception
+                        for vol in volumes:
+                            vol.delete()
+                        raise e
+                    else:
+                        self.debug("Caught exception creating volume,eof is False, continuing. Error:"+str(e))
+                if delay:
+                    time.sleep(delay)
         if len(volumes) < mincount:
              #Clean up any volumes from this operation and raise exception
             for vol in volumes:
@@ -1113,6 +1333,8 @@ disable_root: false"""
             if snapshot:
                 snapshot.eutest_volumes.extend(volumes)
             return volumes
+        #The monitor method consumes the list passed, keep the created list for the issue report
+        created = copy.copy(volumes)
         #If we begain the creation of the min volumes, monitor till completion, otherwise cleanup and fail out
         retlist = self.monitor_created_euvolumes_to_state(volumes,
                                                           eof=eof,
@@ -1120,12 +1342,15 @@ disable_root: false"""
                                                           state=monitor_to_state,
                                                           poll_interval=poll_interval,
                                                           timepergig=timepergig)
+        if concurrent:
+            self.show_issue_report(created, state=monitor_to_state)
         self.test_resources["volumes"].extend(retlist)
         if snapshot:
             snapshot.eutest_volumes.extend(retlist)
         return retlist
     
     
+    @metrics.timed('monitor_created_euvolumes_to_state')
     @Eutester.printinfo
     def monitor_created_euvolumes_to_state(self,
                                            volumes,
@@ -1172,8 +1397,8 @@ disable_root: false"""
         self.debug( "Polling "+str(len(volumes))+" volumes for status:\""+str(state)+"\"...")
         start = time.time()
         while volumes:
+            self.update_euvolumes(volumes)
             for volume in volumes:
-                volume.update()
                 voltimeout = timepergig * (volume.size or size)
                 elapsed = time.time()-start
                 self.debug("Volume #"+str(volume.eutest_createorder)+" ("+volume.id+") State("+volume.status+
@@ -1241,6 +1466,7 @@ disable_root: false"""
         self.show_volumes(origlist)
         return retlist
 
+    @metrics.timed('monitor_euvolumes_to_status')
     @Eutester.printinfo
     def monitor_euvolumes_to_status(self,
                                    euvolumes,
@@ -1305,9 +1531,10 @@ disable_root: false"""
         self.show_volumes(monitor)
         while monitor and (elapsed < timeout):
             elapsed = int(time.time()-start)
+            last_attached_statuses = dict((vol.id, vol.eutest_attached_status) for vol in monitor)
+            self.update_euvolumes(monitor)
             for vol in monitor:
-                last_attached_status = vol.eutest_attached_status
-                vol.update()
+                last_attached_status = last_attached_statuses[vol.id]
                 if vol.eutest_attached_instance_id:
                     instance_debug_str = ', (att_instance'+str(vol.eutest_attached_instance_id)+")"
                 else:
@@ -1356,7 +1583,54 @@ disable_root: false"""
         return good
 
 
-                
+    def update_euvolumes(self, euvolumes, max_ids=None):
+        """
+        Updates a list of EuVolumes using one filtered DescribeVolumes request per 'max_ids' volumes
+        instead of one request per volume. Volumes missing from the describe response are marked 'deleted'.
+
+        :param euvolumes: list of EuVolume objs to update
+        :param max_ids: max number of volume ids per describe request, defaults to self.max_describe_ids
+        :returns: list of updated EuVolumes
+        """
+        max_ids = max_ids or self.max_describe_ids
+        euvolumes = [vol for vol in euvolumes if isinstance(vol, EuVolume)]
+        ids = list(set(vol.id for vol in euvolumes))
+        described = {}
+        for index in xrange(0, len(ids), max_ids):
+            for vol in self.ec2.get_all_volumes(filters={'volume-id': ids[index:index + max_ids]}):
+                described[vol.id] = vol
+        for euvolume in euvolumes:
+            if euvolume.id in described:
+                euvolume.update(updated_volume=described[euvolume.id])
+            else:
+                euvolume.status = 'deleted'
+                euvolume.set_last_status()
+        return euvolumes
+
+    def update_eusnapshots(self, eusnapshots, max_ids=None):
+        """
+        Updates a list of EuSnapshots using one filtered DescribeSnapshots request per 'max_ids' snapshots
+        instead of one request per snapshot. Snapshots missing from the describe response are marked 'deleted'.
+
+        :param eusnapshots: list of EuSnapshot objs to update
+        :param max_ids: max number of snapshot ids per describe request, defaults to self.max_describe_ids
+        :returns: list of updated EuSnapshots
+        """
+        max_ids = max_ids or self.max_describe_ids
+        eusnapshots = [snap for snap in eusnapshots if isinstance(snap, EuSnapshot)]
+        ids = list(set(snap.id for snap in eusnapshots))
+        described = {}
+        for index in xrange(0, len(ids), max_ids):
+            for snap in self.ec2.get_all_snapshots(filters={'snapshot-id': ids[index:index + max_ids]}):
+                described[snap.id] = snap
+        for eusnapshot in eusnapshots:
+            if eusnapshot.id in described:
+                eusnapshot.update(updated_snapshot=described[eusnapshot.id])
+            else:
+                eusnapshot.status = 'deleted'
+                eusnapshot.set_last_status()
+        return eusnapshots
+
     def show_volumes(self,euvolumelist=None, printme=True):
         """
         Creates and displays a table of volumes with summary information
@@ -1377,13 +1651,8 @@ disable_root: false"""
             if not isinstance(volume, EuVolume):
                 self.debug("object not of type EuVolume. Found type:"+str(type(volume)))
                 volume = EuVolume.make_euvol_from_vol(volume=volume, tester=self)
-            else:
-                try:
-                    volume.update()
-                except EC2ResponseError as ER:
-                    if ER.status == 400 and ER.error_code == 'InvalidVolume.NotFound':
-                        volume.status = 'deleted'
             euvolumes.append(volume)
+        self.update_euvolumes(euvolumes)
         if not euvolumes:
             return
         first = euvolumes.pop(0)
@@ -1421,9 +1690,8 @@ disable_root: false"""
             if not isinstance(snapshot, EuSnapshot):
                 self.debug("object not of type EuSnapshot. Found type:"+str(type(snapshot)))
                 snapshot = EuSnapshot.make_eusnap_from_snap(snapshot=snapshot, tester=self)
-            else:
-                snapshot.update()
             plist.append(snapshot)
+        self.update_eusnapshots(plist)
         first = plist.pop(0)
         maintable = first.printself(printme=False)
         maintable.hrules = 1
@@ -1854,12 +2122,18 @@ disable_root: false"""
                          timeout=0, 
                          monitor_to_completed=True,
                          delete_failed = True, 
-                         description="Created by eutester"):
+                         description="Created by eutester",
+                         concurrent=False,
+                         worker_threads=None,
+                         request_rate=None,
+                         max_retries=None):
         """
         Create a new EBS snapshot from an existing volume then wait for it to go to the created state.
         By default will poll for poll_count.  If wait_on_progress is specified than will wait on "wait_on_progress"
         overrides # of poll_interval periods, using wait_on_progress # of periods of poll_interval length in seconds
         w/o progress before failing
+        In concurrent mode the create requests are issued from worker_threads threads at up to request_rate
+        requests/sec, retrying throttled requests, see issue_requests()
 
         :param volume: (mandatory Volume object) Volume to create snapshot from
         :parram count: (optional Integer) Specify how many snapshots to attempt to create
@@ -1874,6 +2148,10 @@ disable_root: false"""
         :param timeout: (optional integer) over all time to wait before exiting as failure
         :param delete_failed: (optional boolean) automatically delete failed volumes
         :param description: (optional string) string used to describe the snapshot
+        :param concurrent: (optional boolean) If true issue the create requests concurrently, 'delay' is ignored
+        :param worker_threads: (optional integer) max create requests in flight in concurrent mode
+        :param request_rate: (optional number) target create requests per second in concurrent mode
+        :param max_retries: (optional integer) retries per throttled create request in concurrent mode
         :return: EuSnapshot list
         """
         #Fix EuSnapshot for isinstance() use later...
@@ -1883,6 +2161,7 @@ disable_root: false"""
         snapshots = []
         retlist = []
         failed = []
+        errors = 0
         mincount = mincount or count
         if mincount > count:
             raise Exception('Mincount can not be greater than count')
@@ -1895,59 +2174,84 @@ disable_root: false"""
         polls = 0
         self.debug('Create_snapshots count:'+str(count)+", mincount:"+str(mincount)+', wait_on_progress:'+
                     str(wait_on_progress)+",eof:"+str(eof))
-        for x in xrange(0,count):
-            try:
-                start = time.time()
-                snapshot = self.ec2.create_snapshot( volume_id, description=str(description))
-                cmdtime = time.time()-start
-                if snapshot:
-                    self.debug("Attempting to create snapshot #"+str(x)+ ", id:"+str(snapshot.id))
-                    snapshot = EuSnapshot().make_eusnap_from_snap(snapshot,
-                                                                  tester=self ,
-                                                                  cmdstart=start)
-                    #Append some attributes for tracking snapshot through creation and test lifecycle.
-                    snapshot.eutest_polls = 0
-                    snapshot.eutest_poll_count = poll_count
-                    snapshot.eutest_last_progress = 0
-                    snapshot.eutest_failmsg = "FAILED"
-                    snapshot.eutest_laststatus = None
-                    snapshot.eutest_timeintest = 0
-                    snapshot.eutest_createorder = x
-                    snapshot.eutest_cmdtime = "{0:.2f}".format(cmdtime)
-                    snapshot.eutest_volume_md5 = volume.md5
-                    snapshot.eutest_volume_md5len = volume.md5len
-                    snapshot.eutest_volume_zone = volume.zone
-                    
-                    snapshot.update()
-                    if description and (not re.match(str(snapshot.description), str(description)) ):
-                        raise Exception('Snapshot Description does not match request: Snap.description:"'+
-                                        str(snapshot.description)+'" -vs- "'+str(description)+'"')
+        def create_snapshot_request(x):
+            start = time.time()
+            snapshot = self.ec2.create_snapshot( volume_id, description=str(description))
+            cmdtime = time.time()-start
+            if snapshot:
+                self.debug("Attempting to create snapshot #"+str(x)+ ", id:"+str(snapshot.id))
+                snapshot = EuSnapshot().make_eusnap_from_snap(snapshot,
+                                                              tester=self ,
+                                                              cmdstart=start)
+                #Append some attributes for tracking snapshot through creation and test lifecycle.
+                snapshot.eutest_polls = 0
+                snapshot.eutest_poll_count = poll_count
+                snapshot.eutest_last_progress = 0
+                snapshot.eutest_failmsg = "FAILED"
+                snapshot.eutest_laststatus = None
+                snapshot.eutest_timeintest = 0
+                snapshot.eutest_createorder = x
+                snapshot.eutest_cmdtime = "{0:.2f}".format(cmdtime)
+                snapshot.eutest_volume_md5 = volume.md5
+                snapshot.eutest_volume_md5len = volume.md5len
+                snapshot.eutest_volume_zone = volume.zone
 
+                snapshot.update()
+                if description and (not re.match(str(snapshot.description), str(description)) ):
+                    failed.append(snapshot)
+                    raise Exception('Snapshot Description does not match request: Snap.description:"'+
+                                    str(snapshot.description)+'" -vs- "'+str(description)+'"')
+            return snapshot
+
+        if concurrent:
+            records = self.issue_requests(create_snapshot_request, count, worker_threads=worker_threads,
+                                          request_rate=request_rate, max_retries=max_retries, eof=eof)
+            for record in records:
+                snapshot = record['result']
+                if snapshot:
+                    #Issue latency includes time spent in throttle retries
+                    snapshot.eutest_cmdstart = record['cmdstart']
+                    snapshot.eutest_cmdtime = "{0:.2f}".format(record['cmdtime'])
+                    snapshot.eutest_issue_retries = record['retries']
+                    snapshots.append(snapshot)
+                elif record['error']:
+                    self.debug("Caught exception creating snapshot #" + str(record['order']) + ". Error:" +
+                               str(record['error']))
+            if len(snapshots) < count and (eof or len(snapshots) < mincount):
+                if delete_failed:
+                    try:
+                        self.delete_snapshots(snapshots + failed)
+                    except: pass
+                raise Exception('Created ' + str(len(snapshots)) + '/' + str(count) + ' snapshots from volume:' +
+                                str(volume_id) + ', eof:' + str(eof) + ', mincount:' + str(mincount))
+        else:
+            for x in xrange(0,count):
+                try:
+                    snapshot = create_snapshot_request(x)
                     if snapshot:
                         snapshots.append(snapshot)
-            except Exception, e:
-                self.debug("Caught exception creating snapshot,eof is False, continuing. Error:"+str(e))
-                if eof:
-                    if delete_failed:
-                        try:
-                            self.delete_snapshots(snapshots)
-                        except: pass
-                    raise e
-                else:
-                    failed.append(snapshot)
-                    #Check to see if our min count of snapshots succeeded, we allow this for specific tests. 
-                    #If not clean up all snapshots from this system created from this operation
-                    if (count - len(failed)) > mincount:
-                        if delete_failed: 
-                            snapshots.extend(failed)
+                except Exception, e:
+                    self.debug("Caught exception creating snapshot,eof is False, continuing. Error:"+str(e))
+                    if eof:
+                        if delete_failed:
                             try:
-                                self.delete_snapshots(snapshots)
-                            except:pass
+                                self.delete_snapshots(snapshots + failed)
+                            except: pass
+                        raise e
+                    else:
+                        errors += 1
+                        #Check to see if our min count of snapshots succeeded, we allow this for specific tests. 
+                        #If not clean up all snapshots from this system created from this operation
+                        if (count - errors) < mincount:
+                            if delete_failed: 
+                                try:
+                                    self.delete_snapshots(snapshots + failed)
+                                except:pass
                             raise Exception('Failed to created mincount('+str(mincount)+
                                             ') number of snapshots from volume:'+str(volume_id))
-            #If a delay was given, wait before next snapshot gets created
-            if delay:
-                time.sleep(delay)
+                #If a delay was given, wait before next snapshot gets created
+                if delay:
+                    time.sleep(delay)
         #If we have failed snapshots,
         # but still met our minimum clean up the failed and continue (this might be better as a thread?)...
         if failed and delete_failed:
@@ -1958,6 +2262,7 @@ disable_root: false"""
         # otherwise just return the list of newly created
         #snapshots. 
         if monitor_to_completed:
+            created = copy.copy(snapshots)
             snapshots = self.monitor_eusnaps_to_completed(snapshots, 
                                                         mincount=mincount, 
                                                         eof=eof, 
@@ -1966,9 +2271,12 @@ disable_root: false"""
                                                         timeout=timeout, 
                                                         delete_failed=delete_failed
                                                         )
+            if concurrent:
+                self.show_issue_report(created, state='completed')
         return snapshots
         
         
+    @metrics.timed('monitor_eusnaps_to_completed')
     @Eutester.printinfo
     def monitor_eusnaps_to_completed(self,
                                      snaps,
@@ -2024,12 +2332,15 @@ disable_root: false"""
         
         while (timeout == 0 or elapsed <= timeout) and snapshots:
             self.debug("Waiting for "+str(len(snapshots))+" snapshots to complete creation")
+            try:
+                self.update_eusnapshots(snapshots)
+            except EC2ResponseError, ER:
+                self.debug('Error updating snapshots, using last known status this poll. Err:' + str(ER))
             for snapshot in snapshots:
                 try:
                     snapshot.eutest_polls += 1
-                    snapshot.update()
                     snapshot.eutest_laststatus = snapshot.status
-                    if snapshot.status == 'failed':
+                    if snapshot.status == 'failed' or snapshot.status == 'deleted':
                         raise Exception(str(snapshot) + " failed after Polling("+str(snapshot.eutest_polls)+
                                         ") ,Waited("+str(elapsed)+" sec), last reported (status:" + snapshot.status+
                                         " progress:"+snapshot.progress+")")
@@ -2137,7 +2448,7 @@ disable_root: false"""
         snapshot_list = []
         if snapid:
             snapshot_list.append(snapid)
-        ec2_snaps =  self.ec2.get_all_snapshots(snapshot_ids=snapshot_list, filters=filters, owner=owner_id)
+        ec2_snaps =  self.describe('get_all_snapshots', snapshot_ids=snapshot_list, filters=filters, owner=owner_id)
         for snap in ec2_snaps:
             if snap not in snapshots:
                 snapshots.append(snap)
@@ -2551,7 +2862,7 @@ disable_root: false"""
         if name is None and emi is None:
              emi = "mi-"
         self.debug('Get images using filters:' + str(filters))
-        images = self.ec2.get_all_images(filters=filters)
+        images = self.describe('get_all_images', filters=filters)
         self.debug("Got " + str(len(images)) + " total images " + str(emi) + ", now filtering..." )
         # Note: the following can likely be removed now that Euca supports filters for requests
         for image in images:
@@ -3037,7 +3348,7 @@ disable_root: false"""
         retlist = []
         if (attached_instance is not None) or (attached_dev is not None):
             status='in-use'
-        volumes = self.ec2.get_all_volumes(filters=filters)
+        volumes = self.describe('get_all_volumes', filters=filters)
         for volume in volumes:
             if not hasattr(volume,'md5'):
                 volume = EuVolume.make_euvol_from_vol(volume, tester=self)
@@ -3550,10 +3861,24 @@ disable_root: false"""
                                ' from instance:' + str(instance.id) + " block dev map, err:" + str(e))
 
 
+    @metrics.timed('monitor_euinstances_to_running')
     @Eutester.printinfo 
-    def monitor_euinstances_to_running(self,instances, poll_interval=10, timeout=480):
+    def monitor_euinstances_to_running(self,instances, poll_interval=10, timeout=480, worker_threads=None):
+        """
+        Monitors instances to the running state, waits for valid ips and then checks each instance for
+        readiness: ping, then a tcp connect to the ssh (or rdp/winrm) port, and only once the port is open
+        an ssh (or winrm) connection. Instances are checked concurrently using up to 'worker_threads'
+        threads so one unresponsive guest does not hold up the checks of the others.
+
+        :param instances: list of euinstances to monitor
+        :param poll_interval: seconds to wait between readiness check rounds
+        :param timeout: seconds to wait for each stage before failing
+        :param worker_threads: max number of instances checked at once, defaults to self.instance_monitor_threads
+        :returns: list of instances which are ready
+        """
         if not isinstance(instances, types.ListType):
             instances = [instances]
+        worker_threads = worker_threads or self.instance_monitor_threads or 1
         self.debug("("+str(len(instances))+") Monitor_instances_to_running starting...")
         ip_err = ""
         #Wait for instances to go to running state...
@@ -3570,50 +3895,29 @@ disable_root: false"""
         good = []
         elapsed = 0
         start = time.time()
+        timings = {}
+        for instance in instances:
+            timings[instance.id] = {'ping': None, 'port': None, 'ssh': None, 'checked_groups': False}
         self.debug("Instances in running state and wait_for_valid_ip complete, attempting connections...")
         while waiting and (elapsed < timeout):
             self.debug("Checking "+str(len(waiting))+" instance ssh connections...")
             elapsed = int(time.time()-start)
-            for instance in waiting:
-                self.debug('Checking instance:'+str(instance.id)+" ...")
-                if instance.auto_connect:
-                    try:
-                        if isinstance(instance, WinInstance):
-                            #First try checking the RDP and WINRM ports for access...
-                            self.debug('Do Security group rules allow winrm from this test machine:'+
-                                       str(self.does_instance_sec_group_allow(instance, protocol='tcp', port=instance.winrm_port)))
-                            self.debug('Do Security group rules allow winrm from this test machine:'+
-                                       str(self.does_instance_sec_group_allow(instance, protocol='tcp', port=instance.rdp_port)))
-                            instance.poll_for_ports_status(timeout=1)
-                            instance.connect_to_instance(timeout=15)
-                            self.debug("Connected to instance:"+str(instance.id))
-                            good.append(instance)
-                        else:
-                            #First try ping
-                            self.debug('Do Security group rules allow ping from this test machine:'+
-                                       str(self.does_instance_sec_group_allow(instance, protocol='icmp', port=0)))
-                            self.ping(instance.ip_address, 2)
-                            #now try to connect ssh or winrm
-                            allow = "None"
-                            try:
-                                allow=str(self.does_instance_sec_group_allow(instance, protocol='tcp', port=22))
-                            except:
-                                pass
-                            self.debug('Do Security group rules allow ssh from this test machine:'+str(allow))
-                            instance.connect_to_instance(timeout=15)
-                            self.debug("Connected to instance:"+str(instance.id))
-                            good.append(instance)
-                    except :
-                        self.debug(self.get_traceback())
-                        pass
-                else:
+            if worker_threads > 1 and len(waiting) > 1:
+                with ThreadPoolExecutor(max_workers=min(worker_threads, len(waiting))) as executor:
+                    futures = [(instance, executor.submit(self.check_euinstance_ready, instance,
+                                                          timings[instance.id], start))
+                               for instance in waiting]
+                results = [(instance, future.result()) for instance, future in futures]
+            else:
+                results = [(instance, self.check_euinstance_ready(instance, timings[instance.id], start))
+                           for instance in waiting]
+            for instance, ready in results:
+                if ready:
                     good.append(instance)
-            for instance in good:
-                if instance in waiting:
                     waiting.remove(instance)
             if waiting:
                 time.sleep(poll_interval)
-                
+        self.show_euinstance_ready_times(instances, timings)
         if waiting:
             buf = "Following Errors occurred while waiting for instances:\n"
             buf += 'Errors while waiting for valid ip:'+ ip_err + "\n"
@@ -3623,8 +3927,71 @@ disable_root: false"""
             raise Exception(buf)
         self.show_instances(good)
         return good
-    
 
+    def check_euinstance_ready(self, instance, timings, start):
+        """
+        Single readiness check of an instance used by monitor_euinstances_to_running(). Pings the instance
+        until it responds, then probes the ssh port (rdp/winrm ports for windows) and only attempts an
+        ssh/winrm connection once a port has accepted a tcp connection. Stage times relative to 'start'
+        are recorded in the 'timings' dict under 'ping', 'port' and 'ssh'.
+
+        :param instance: euinstance to check
+        :param timings: dict used to store this instance's stage times between checks
+        :param start: time.time() the monitor started, used to calc stage times
+        :returns: True if the instance is ready, else False
+        """
+        self.debug('Checking instance:'+str(instance.id)+" ...")
+        if not instance.auto_connect:
+            return True
+        try:
+            if isinstance(instance, WinInstance):
+                ports = [instance.rdp_port, instance.winrm_port]
+            else:
+                ports = [22]
+            if not timings['checked_groups']:
+                timings['checked_groups'] = True
+                for port in ports:
+                    try:
+                        self.debug('Do Security group rules allow port:' + str(port) + ' from this test machine:' +
+                                   str(self.does_instance_sec_group_allow(instance, protocol='tcp', port=port)))
+                    except:
+                        pass
+            if timings['port'] is None:
+                if timings['ping'] is None and not isinstance(instance, WinInstance):
+                    if self.ping(instance.ip_address, 1):
+                        timings['ping'] = time.time() - start
+                #Short circuit on the first port to accept a connection, don't try ssh until then
+                for port in ports:
+                    try:
+                        self.test_port_status(instance.ip_address, int(port), timeout=5, verbose=False)
+                        timings['port'] = time.time() - start
+                        break
+                    except socket.error, se:
+                        self.debug('Instance:' + str(instance.id) + ', port:' + str(port) +
+                                   ' not open yet, err:' + str(se))
+                if timings['port'] is None:
+                    return False
+            instance.connect_to_instance(timeout=15)
+            timings['ssh'] = time.time() - start
+            self.debug("Connected to instance:"+str(instance.id))
+            return True
+        except :
+            self.debug(self.get_traceback())
+        return False
+
+    def show_euinstance_ready_times(self, instances, timings, printmethod=None):
+        """
+        Prints a table of the time to ping, time to port open and time to ssh/winrm recorded per instance
+        by monitor_euinstances_to_running()
+        """
+        printmethod = printmethod or self.debug
+        pt = PrettyTable(['INSTANCE', 'IP', 'TIME TO PING', 'TIME TO PORT', 'TIME TO SSH'])
+        format_time = lambda x: "{0:.2f}".format(x) if x is not None else None
+        for instance in instances:
+            times = timings.get(instance.id, {})
+            pt.add_row([instance.id, instance.ip_address, format_time(times.get('ping')),
+                        format_time(times.get('port')), format_time(times.get('ssh'))])
+        printmethod("\n" + str(pt) + "\n")
 
 
     @Eutester.printinfo
@@ -3669,19 +4036,17 @@ disable_root: false"""
                 self.debug('Using src_addr:'+str(src_addr))
             else:
                 raise ValueError('Was not able to find local src ip')
-            groups = self.get_instance_security_groups(instance)
-            for group in groups:
-                if self.does_sec_group_allow(group,
-                                             src_addr=src_addr,
-                                             src_group=src_group,
-                                             protocol=protocol,
-                                             port=port):
-                    self.debug("Sec allows from test source addr: " +
-                               str(src_addr) + ", src_group:" +
-                               str(src_group) + ", protocol:" +
-                               str(protocol) + ", port:" + str(port))
-                    #Security group allows from the src/proto/port
-                    return True
+            groups = [self.get_security_group(id=group.id, name=group.name)
+                      for group in self.get_instance_security_groups(instance)]
+            ruleset = CompiledRuleSet.from_security_groups([group for group in groups if group])
+            if self._compiled_rules_allow(ruleset, src_addr=src_addr, src_group=src_group,
+                                          protocol=protocol, port=port):
+                self.debug("Sec allows from test source addr: " +
+                           str(src_addr) + ", src_group:" +
+                           str(src_group) + ", protocol:" +
+                           str(protocol) + ", port:" + str(port))
+                #Security group allows from the src/proto/port
+                return True
             #Security group does not allow from the src/proto/port
             return False
         except Exception, e:
@@ -3802,7 +4167,7 @@ disable_root: false"""
             ids = [id]
         if name:
             names.append(name)
-        groups = self.ec2.get_all_security_groups(groupnames=names, group_ids=ids)
+        groups = self.describe('get_all_security_groups', groupnames=names, group_ids=ids)
         for group in groups:
             if not id or (id and group.id == id):
                 if not name or (name and group.name == name):
@@ -3832,45 +4197,19 @@ disable_root: false"""
                    ", proto:" + str(protocol) + ", port:" + str(port))
         group = self.get_security_group(id=group.id, name=group.name)
         for rule in group.rules:
-            g_buf =""
-            if str(rule.ip_protocol).strip().lower() == protocol:
-                for grant in rule.grants:
-                    g_buf += str(grant)+","
-                self.debug("rule#{0}: ports:{1}-{2}, grants:{3}"
-                           .format(str(group.rules.index(rule)),
-                                   str(rule.from_port),
-                                   str(rule.to_port),
-                                   str(g_buf)))
-                from_port = int(rule.from_port)
-                to_port= int(rule.to_port)
-                if (to_port == 0 ) or (to_port == -1) or \
-                        (port >= from_port and port <= to_port):
-                    for grant in rule.grants:
-                        grantgroupid = (getattr(grant, 'groupId', None) or
-                                        getattr(grant, 'group_id', None))
-                        if src_addr and grant.cidr_ip:
-                            if self.is_address_in_network(src_addr, str(grant)):
-                                self.debug('sec_group DOES allow: group:"{0}"'
-                                           ', src:"{1}", proto:"{2}", port:"{3}"'
-                                           .format(group.name,
-                                                   src_addr,
-                                                   protocol,
-                                                   port))
-                                return True
-                        if src_group:
-                            src_group_id = str(src_group.name) + \
-                                           "-" + (src_group.owner_id)
-                            if ( src_group.id == grantgroupid ) or \
-                                    ( grant.group_id == src_group_id ):
-                                self.debug('sec_group DOES allow: group:"{0}"'
-                                           ', src_group:"{1}"/"{2}", '
-                                           'proto:"{3}", ''port:"{4}"'
-                                           .format(group.name,
-                                                   src_group.id,
-                                                   src_group.name,
-                                                   protocol,
-                                                   port))
-                                return True
+            self.debug("rule#{0}: proto:{1}, ports:{2}-{3}, grants:{4}"
+                       .format(str(group.rules.index(rule)),
+                               str(rule.ip_protocol),
+                               str(rule.from_port),
+                               str(rule.to_port),
+                               ",".join(str(grant) for grant in rule.grants)))
+        ruleset = CompiledRuleSet.from_security_groups([group], name=group.name)
+        if self._compiled_rules_allow(ruleset, src_addr=src_addr, src_group=src_group,
+                                      protocol=protocol, port=port):
+            self.debug('sec_group DOES allow: group:"{0}", src:"{1}", src_group:"{2}", '
+                       'proto:"{3}", port:"{4}"'.format(group.name, src_addr, src_group,
+                                                        protocol, port))
+            return True
 
         self.debug('sec_group:"{0}" DOES NOT allow from: src_ip:"{1}", '
                    'src_group:"{2}", proto:"{3}", port:"{4}"'
@@ -3886,17 +4225,67 @@ disable_root: false"""
         :param network: Ip network in cidr notation ie: 192.168.1.0/24
         :return: boolean true if ip is found to be in network/mask, else false
         """
-        ip_addr = str(ip_addr)
-        network = str(network)
-        # Check for 0.0.0.0/0 network first...
-        rem_zero = network.replace('0','')
-        if not re.search('\d', rem_zero):
+        first, last = cidr_to_range(network)
+        return first <= ip_to_int(ip_addr) <= last
+
+    def _compiled_rules_allow(self, ruleset, src_addr=None, src_group=None, protocol='tcp', port=22):
+        if ruleset.allows(src_addr=src_addr, protocol=protocol, port=port):
             return True
-        ipaddr = int(''.join([ '%02x' % int(x) for x in ip_addr.split('.') ]), 16)
-        netstr, bits = network.split('/')
-        netaddr = int(''.join([ '%02x' % int(x) for x in netstr.split('.') ]), 16)
-        mask = (0xffffffff << (32 - int(bits))) & 0xffffffff
-        return (ipaddr & mask) == (netaddr & mask)
+        if src_group:
+            #Grants may reference the group by id or by 'name-owner_id'
+            for src_group_id in [src_group.id, str(src_group.name) + "-" + str(src_group.owner_id)]:
+                if ruleset.allows(protocol=protocol, port=port, src_group=src_group_id):
+                    return True
+        return False
+
+    def get_compiled_rules_for_instances(self, instances):
+        """
+        Compiles the security group rules for each instance, fetching all referenced groups in one request.
+        :param instances: list of instance objs
+        :returns dict of instance id -> CompiledRuleSet, instances using the same groups share a rule set
+        """
+        instance_groups = {}
+        group_ids = set()
+        for instance in instances:
+            ids = tuple(sorted(set(str(group.id) for group in self.get_instance_security_groups(instance))))
+            instance_groups[instance.id] = ids
+            group_ids.update(ids)
+        groups = {}
+        if group_ids:
+            for group in self.describe('get_all_security_groups', group_ids=sorted(group_ids)):
+                groups[str(group.id)] = group
+        rulesets = {}
+        ret = {}
+        for instance_id, ids in instance_groups.iteritems():
+            if ids not in rulesets:
+                rulesets[ids] = CompiledRuleSet.from_security_groups(
+                    [groups[group_id] for group_id in ids if group_id in groups], name=",".join(ids))
+            ret[instance_id] = rulesets[ids]
+        return ret
+
+    def do_instances_sec_groups_allow(self, queries):
+        """
+        Batched form of does_instance_sec_group_allow(). Evaluates many
+        (src_addr, instance, protocol, port) or (src_addr, instance, protocol, port, src_group) queries,
+        where src_group is an optional boto SecurityGroup, against compiled rule sets built with one
+        security group request for all instances.
+        :param queries: list of query tuples
+        :returns list of booleans in query order
+        """
+        queries = list(queries)
+        instances = {}
+        for query in queries:
+            instances[query[1].id] = query[1]
+        rulesets = self.get_compiled_rules_for_instances(instances.values())
+        results = []
+        for query in queries:
+            src_addr, instance, protocol, port = query[:4]
+            src_group = query[4] if len(query) > 4 else None
+            results.append(self._compiled_rules_allow(rulesets[instance.id], src_addr=src_addr,
+                                                      src_group=src_group, protocol=protocol, port=port))
+        self.debug('Evaluated ' + str(len(queries)) + ' security group queries for ' + str(len(instances)) +
+                   ' instances, allowed:' + str(results.count(True)))
+        return results
     
     def get_instance_security_groups(self,instance):
         """
@@ -3919,7 +4308,7 @@ disable_root: false"""
                 res = self.get_reservation_for_instance(instance)
             groups = res.groups
         for group in groups:
-            secgroups.extend(self.ec2.get_all_security_groups(
+            secgroups.extend(self.describe('get_all_security_groups',
                 groupnames=[str(group.name)]))
         return secgroups
     
@@ -3931,7 +4320,7 @@ disable_root: false"""
         :return: :raise:
         """
         if hasattr(self.ec2, 'get_all_reservations'):
-            res = self.ec2.get_all_reservations(instance_ids=instance.id)
+            res = self.describe('get_all_reservations', instance_ids=instance.id)
             if res and isinstance(res, types.ListType):
                 return res[0]
         for res in self.ec2.get_all_instances():
@@ -3942,6 +4331,7 @@ disable_root: false"""
                     return res
         raise Exception('No reservation found for instance:'+str(instance.id))
     
+    @metrics.timed('monitor_euinstances_to_state')
     @Eutester.printinfo    
     def monitor_euinstances_to_state(self,
                                      instance_list,
@@ -4365,7 +4755,7 @@ disable_root: false"""
 
         :return: list of zone names
         """
-        zone_objects = self.ec2.get_all_zones()
+        zone_objects = self.describe('get_all_zones')
         zone_names = []
         for zone in zone_objects:
             zone_names.append(zone.name)
@@ -4410,7 +4800,7 @@ disable_root: false"""
         else:
             instance_ids = idstring
         
-        reservations = self.ec2.get_all_instances(instance_ids=instance_ids, filters=filters)
+        reservations = self.describe('get_all_instances', instance_ids=instance_ids, filters=filters)
         for res in reservations:
             if ( reservation is None ) or (re.search(str(reservation), str(res.id))):
                 for i in res.instances:
@@ -40,9 +40,14 @@ from boto.s3.deletemarker import DeleteMarker
 from boto.s3.bucket import Bucket, Key, DeleteMarker
 import boto.s3
 from eutester import Eutester
+from eutester.timer import metrics
 import hashlib
+import base64
 import os
 import time
+import threading
+from cStringIO import StringIO
+from concurrent.futures import ThreadPoolExecutor
 
 
 
@@ -65,6 +70,13 @@ class S3ops(Eutester):
              "authenticated_users":"http://acs.amazonaws.com/groups/global/AuthenticatedUsers",
              "log_delivery":"http://acs.amazonaws.com/groups/s3/LogDelivery"
              }
+    #Defaults for multipart_upload_file() and download_object_parallel()
+    transfer_part_size = 8 * 1024 * 1024
+    transfer_threads = 4
+    #Files larger than this are uploaded by upload_object() using multipart_upload_file(), None to disable
+    multipart_threshold = None
+    #List of dicts recorded per parallel transfer, see show_transfer_stats()
+    transfer_stats = None
 
     def __init__(self, endpoint=None, credpath=None, aws_access_key_id=None, aws_secret_access_key = None, is_secure=False, path="/", port=80, boto_debug=0):
         self.aws_access_key_id = aws_access_key_id
@@ -91,6 +103,7 @@ class S3ops(Eutester):
                                    }
             self.debug("Attempting to create S3 connection to " + endpoint + ':' + str(port) + path)
             self.s3 = boto.connect_s3(**s3_connection_args)
+            metrics.instrument_boto_connection(self.s3, 's3')
         except Exception, e:
             raise Exception("Was unable to create S3 connection because of exception: " + str(e))
 
@@ -177,13 +190,18 @@ class S3ops(Eutester):
         else:
             return None
     
-    def upload_object(self, bucket_name, key_name, path_to_file=None, contents=None):
+    def upload_object(self, bucket_name, key_name, path_to_file=None, contents=None, multipart_threshold=None):
         """
         Write the contents of a local file to walrus
         bucket_name   The name of the walrus Bucket.
         key_name      The name of the object containing the data in walrus.
         path_to_file  Fully qualified path to local file.
+        multipart_threshold  Files larger than this many bytes are uploaded in parallel parts with
+                             multipart_upload_file(). Defaults to S3ops.multipart_threshold (None, disabled)
         """
+        multipart_threshold = multipart_threshold or self.multipart_threshold
+        if path_to_file and multipart_threshold and os.path.getsize(path_to_file) > multipart_threshold:
+            return self.multipart_upload_file(bucket_name, key_name, path_to_file)['key']
         bucket = self.get_bucket_by_name(bucket_name)
         if bucket == None:
             raise S3opsException("Could not find bucket " + bucket_name + " to upload file")
@@ -202,6 +220,213 @@ class S3ops(Eutester):
         self.test_resources["keys"].append(key)
         return key
     
+    @staticmethod
+    def get_multipart_etag(part_digests):
+        """
+        Returns the ETag S3 reports for a multipart object given the binary md5 digest of each part
+        """
+        return '"' + hashlib.md5("".join(part_digests)).hexdigest() + '-' + str(len(part_digests)) + '"'
+
+    def record_transfer_stats(self, operation, key_name, size, parts, part_size, worker_threads, elapsed,
+                              md5, etag):
+        stats = {'operation': operation,
+                 'key': key_name,
+                 'size': size,
+                 'parts': parts,
+                 'part_size': part_size,
+                 'threads': worker_threads,
+                 'elapsed': elapsed,
+                 'mb_per_sec': (size / (1024.0 * 1024.0)) / (elapsed or 1e-6),
+                 'md5': md5,
+                 'etag': etag}
+        if self.transfer_stats is None:
+            self.transfer_stats = []
+        self.transfer_stats.append(stats)
+        metrics.record('s3.' + operation, elapsed)
+        self.debug(str(operation) + " of '" + str(key_name) + "' done, " + str(size) + " bytes in " +
+                   str(parts) + " parts, " + "{0:.2f}s, {1:.2f} MB/s".format(elapsed, stats['mb_per_sec']))
+        return stats
+
+    def show_transfer_stats(self, transfer_stats=None, printmethod=None, printme=True):
+        """
+        Prints a table of throughput for the parallel transfers recorded in self.transfer_stats
+        """
+        transfer_stats = transfer_stats or self.transfer_stats or []
+        pt = PrettyTable(['OPERATION', 'KEY', 'SIZE', 'PARTS', 'PART SIZE', 'THREADS', 'ELAPSED', 'MB/s', 'ETAG'])
+        for stats in transfer_stats:
+            pt.add_row([stats['operation'], stats['key'], stats['size'], stats['parts'], stats['part_size'],
+                        stats['threads'], "{0:.2f}".format(stats['elapsed']),
+                        "{0:.2f}".format(stats['mb_per_sec']), stats['etag']])
+        if not printme:
+            return pt
+        printmethod = printmethod or self.debug
+        printmethod("\n" + str(pt) + "\n")
+
+    def multipart_upload_file(self, bucket_name, key_name, path_to_file, part_size=None, worker_threads=None,
+                              verify=True):
+        """
+        Uploads a local file as a multipart upload, with up to worker_threads parts in flight at once.
+        The file is read once, in order. Each part's md5 is computed as it is read and passed along
+        with the part, and the whole-file md5 is computed from the same reads. If verify is set, the
+        ETag returned on completion is checked against the expected multipart ETag built from the part
+        md5s. On any failure the multipart upload is cancelled.
+
+        :param bucket_name: name of existing bucket to upload to
+        :param key_name: name of the key to create
+        :param path_to_file: local file to upload
+        :param part_size: bytes per part, default S3ops.transfer_part_size. S3 requires >= 5MB except the last part
+        :param worker_threads: number of concurrent part uploads, default S3ops.transfer_threads
+        :param verify: boolean, verify the completed upload's ETag
+        :returns: dict of transfer stats including 'key', 'md5', 'etag', 'elapsed' and 'mb_per_sec'
+        """
+        part_size = int(part_size or self.transfer_part_size)
+        worker_threads = worker_threads or self.transfer_threads
+        bucket = self.get_bucket_by_name(bucket_name)
+        if bucket == None:
+            raise S3opsException("Could not find bucket " + bucket_name + " to upload file")
+        size = os.path.getsize(path_to_file)
+        num_parts = max(1, (size + part_size - 1) / part_size)
+        start = time.time()
+        mpu = bucket.initiate_multipart_upload(key_name)
+        self.debug("Initiated MPU:" + str(mpu.id) + " for '" + str(key_name) + "', size:" + str(size) +
+                   ", parts:" + str(num_parts) + ", threads:" + str(worker_threads))
+        file_md5 = hashlib.md5()
+        part_digests = []
+        #Bound the number of parts held in memory to those being uploaded plus one waiting per thread
+        in_flight = threading.BoundedSemaphore(worker_threads * 2)
+
+        def upload_part(part_num, data, digest):
+            try:
+                mpu.upload_part_from_file(StringIO(data), part_num,
+                                          md5=(digest.encode('hex'), base64.b64encode(digest)),
+                                          size=len(data))
+            finally:
+                in_flight.release()
+
+        try:
+            futures = []
+            with ThreadPoolExecutor(max_workers=worker_threads) as executor:
+                with open(path_to_file, 'rb') as local_file:
+                    for part_num in xrange(1, num_parts + 1):
+                        in_flight.acquire()
+                        data = local_file.read(part_size)
+                        file_md5.update(data)
+                        digest = hashlib.md5(data).digest()
+                        part_digests.append(digest)
+                        futures.append(executor.submit(upload_part, part_num, data, digest))
+                        del data
+                        #Stop reading early if a part has already failed
+                        for future in futures:
+                            if future.done() and future.exception():
+                                raise future.exception()
+            for future in futures:
+                future.result()
+            completed = mpu.complete_upload()
+        except Exception, e:
+            self.debug("Multipart upload of '" + str(key_name) + "' failed, cancelling MPU:" + str(mpu.id) +
+                       ", err:" + str(e))
+            try:
+                mpu.cancel_upload()
+            except Exception, ce:
+                self.debug('Failed to cancel MPU:' + str(mpu.id) + ', err:' + str(ce))
+            raise
+        elapsed = time.time() - start
+        etag = getattr(completed, 'etag', None)
+        expected_etag = self.get_multipart_etag(part_digests)
+        if verify and etag and etag.strip('"') != expected_etag.strip('"'):
+            raise S3opsException("Multipart ETag mismatch for '" + str(key_name) + "': returned " + str(etag) +
+                                 ", expected " + str(expected_etag))
+        key = bucket.new_key(key_name)
+        self.test_resources["keys"].append(key)
+        stats = self.record_transfer_stats('multipart_upload', key_name, size, num_parts, part_size,
+                                           worker_threads, elapsed, file_md5.hexdigest(), etag or expected_etag)
+        stats['key'] = key
+        return stats
+
+    def download_object_parallel(self, bucket_name, key_name, path_to_file, part_size=None, worker_threads=None,
+                                 verify=True, upload_part_size=None):
+        """
+        Downloads an object to a local file using concurrent ranged GETs, with up to worker_threads ranges
+        in flight at once. Ranges are written and hashed in order as they arrive so the file is never re-read.
+        If verify is set the md5 is checked against the object's ETag, for multipart ETags this is only
+        possible when upload_part_size, the part size used to upload the object, is provided.
+
+        :param bucket_name: name of the bucket containing the object
+        :param key_name: name of the object to download
+        :param path_to_file: local file to write to
+        :param part_size: bytes per ranged GET, default S3ops.transfer_part_size
+        :param worker_threads: number of concurrent ranged GETs, default S3ops.transfer_threads
+        :param verify: boolean, verify the downloaded data against the object's ETag
+        :param upload_part_size: bytes per part used to upload a multipart object, needed to verify its ETag
+        :returns: dict of transfer stats including 'md5', 'etag', 'elapsed' and 'mb_per_sec'
+        """
+        part_size = int(part_size or self.transfer_part_size)
+        upload_part_size = int(upload_part_size or 0)
+        worker_threads = worker_threads or self.transfer_threads
+        bucket = self.get_bucket_by_name(bucket_name)
+        if bucket == None:
+            raise S3opsException("Could not find bucket " + bucket_name + " to download from")
+        key = bucket.get_key(key_name)
+        if key is None:
+            raise S3opsException("Could not find key " + str(key_name) + " in bucket " + str(bucket_name))
+        size = int(key.size)
+        num_parts = max(1, (size + part_size - 1) / part_size)
+        start = time.time()
+
+        def get_range(part_index):
+            range_start = part_index * part_size
+            range_end = min(size, range_start + part_size) - 1
+            if range_end < range_start:
+                return ""
+            #Each range uses its own Key object as boto keys hold per request response state
+            return Key(bucket, key_name).get_contents_as_string(
+                headers={'Range': 'bytes=' + str(range_start) + '-' + str(range_end)})
+
+        file_md5 = hashlib.md5()
+        #Digests of the data split at the upload's part boundaries, and the md5/length of the current part
+        part_digests = []
+        upload_part = [hashlib.md5(), 0]
+        with ThreadPoolExecutor(max_workers=worker_threads) as executor:
+            with open(path_to_file, 'wb') as local_file:
+                #Keep a window of ranges in flight, consuming them in order
+                window = []
+                next_part = 0
+                while next_part < num_parts or window:
+                    while next_part < num_parts and len(window) < worker_threads * 2:
+                        window.append(executor.submit(get_range, next_part))
+                        next_part += 1
+                    data = window.pop(0).result()
+                    local_file.write(data)
+                    file_md5.update(data)
+                    offset = 0
+                    while upload_part_size and offset < len(data):
+                        chunk = data[offset:offset + upload_part_size - upload_part[1]]
+                        upload_part[0].update(chunk)
+                        upload_part[1] += len(chunk)
+                        offset += len(chunk)
+                        if upload_part[1] == upload_part_size:
+                            part_digests.append(upload_part[0].digest())
+                            upload_part = [hashlib.md5(), 0]
+        if upload_part[1]:
+            part_digests.append(upload_part[0].digest())
+        elapsed = time.time() - start
+        etag = str(key.etag or "").strip('"')
+        if verify and etag:
+            if '-' in etag:
+                if upload_part_size:
+                    expected_etag = self.get_multipart_etag(part_digests).strip('"')
+                else:
+                    expected_etag = None
+                    self.debug("Can not verify multipart ETag:" + str(etag) + " without the part size used to "
+                               "upload it, see upload_part_size")
+            else:
+                expected_etag = file_md5.hexdigest()
+            if expected_etag and expected_etag != etag:
+                raise S3opsException("Downloaded '" + str(key_name) + "' does not match ETag:" + str(etag) +
+                                     ", got:" + str(expected_etag))
+        return self.record_transfer_stats('parallel_download', key_name, size, num_parts, part_size,
+                                          worker_threads, elapsed, file_md5.hexdigest(), key.etag)
+
     def get_objects_by_prefix(self, bucket_name, prefix):
         """
         Get keys in the specified bucket that match the prefix if no prefix is passed all objects are returned
@@ -226,67 +451,137 @@ class S3ops(Eutester):
         except Exception, e:
             return
         
-    def clear_bucket(self, bucket_name=None):
+    def clear_bucket(self, bucket_name=None, worker_threads=4):
         """Deletes the contents of the bucket specified and the bucket itself
             THIS WILL DELETE EVERYTHING!
            bucket       bucket name to clear
+           See purge_bucket()
         """
         try :
             bucket = self.s3.get_bucket(bucket_name=bucket_name)      
         except S3ResponseError as e:
             self.debug('No bucket' + bucket_name + ' found: ' + e.message)
             raise Exception('Not found')
-        
         try:
-            self.debug( "Getting bucket listing for " + bucket.name )     
-            self.debug(  "Iterating throught the bucket" )
-            key_list = bucket.list()        
-            self.debug(  "Starting loop" )
-            for k in key_list:
+            self.purge_bucket(bucket, delete_bucket=True, worker_threads=worker_threads)
+        except S3ResponseError as e:
+            self.debug('Got ' + e.message + ' and status ' + str(e.status))
+
+    def purge_bucket(self, bucket, prefix='', delete_bucket=True, batch_size=1000, worker_threads=4):
+        """
+        Deletes all keys, versions and delete markers (optionally only those under 'prefix') and aborts any
+        in progress multipart uploads in a bucket, then optionally deletes the bucket.
+        Keys are listed lazily a page at a time and deleted with Multi-Object Delete in batches of up to
+        'batch_size', with up to worker_threads batches in flight. If the service rejects Multi-Object
+        Delete, the batch is deleted key by key.
+
+        :param bucket: bucket name or boto bucket object
+        :param prefix: only delete keys starting with this prefix
+        :param delete_bucket: boolean, delete the bucket once empty (ignored if prefix is given)
+        :param batch_size: keys per Multi-Object Delete request, max 1000
+        :param worker_threads: number of delete batches run concurrently
+        :returns: dict with 'deleted', 'errors', 'uploads_aborted', 'elapsed' and 'keys_per_sec'
+        """
+        if not isinstance(bucket, Bucket):
+            bucket = self.s3.get_bucket(str(bucket))
+        batch_size = max(1, min(int(batch_size), 1000))
+        start = time.time()
+        counts = {'deleted': 0, 'errors': 0}
+        lock = threading.Lock()
+
+        def delete_batch(batch):
+            errors = []
+            try:
+                result = bucket.delete_keys(batch, quiet=True)
+                errors = result.errors
+            except S3ResponseError, se:
+                self.debug('Multi-Object Delete failed (' + str(se.status) + '), deleting ' + str(len(batch)) +
+                           ' keys individually')
+                for k in batch:
+                    try:
+                        bucket.delete_key(k.name, version_id=getattr(k, 'version_id', None))
+                    except S3ResponseError, de:
+                        errors.append(de)
+            for error in errors[:10]:
+                self.debug('Failed to delete key:' + str(getattr(error, 'key', error)) + ', err:' +
+                           str(getattr(error, 'message', '')))
+            with lock:
+                counts['deleted'] += len(batch) - len(errors)
+                counts['errors'] += len(errors)
+
+        def list_keys():
+            #Prefer version listings so old versions and delete markers go too, walrus may not support them
+            try:
+                versions = iter(bucket.list_versions(prefix=prefix))
+                first = versions.next()
+            except StopIteration:
+                return
+            except S3ResponseError, se:
+                self.debug('Version listing not available (' + str(se.status) + '), listing keys only')
+                for k in bucket.list(prefix=prefix):
+                    yield k
+                return
+            yield first
+            for k in versions:
+                yield k
+
+        uploads_aborted = 0
+        with ThreadPoolExecutor(max_workers=worker_threads) as executor:
+            try:
+                uploads = [upload for upload in bucket.list_multipart_uploads()
+                           if str(upload.key_name).startswith(prefix)]
+            except S3ResponseError, se:
+                self.debug('Could not list multipart uploads (' + str(se.status) + '), skipping')
+                uploads = []
+            for future in [executor.submit(upload.cancel_upload) for upload in uploads]:
+                try:
+                    future.result()
+                    uploads_aborted += 1
+                except S3ResponseError, se:
+                    self.debug('Failed to abort multipart upload, err:' + str(se))
+            pending = []
+            batch = []
+            for k in list_keys():
                 if isinstance(k, boto.s3.prefix.Prefix):
-                    self.debug(  "Skipping prefix" )
                     continue
-                self.debug(  "Deleting key: " + k.name )
-                bucket.delete_key(k)
+                batch.append(k)
+                if len(batch) >= batch_size:
+                    pending.append(executor.submit(delete_batch, batch))
+                    batch = []
+                    #Limit listed keys held in memory while deletes catch up
+                    if len(pending) >= worker_threads * 2:
+                        pending.pop(0).result()
+                        self.debug('purge_bucket ' + str(bucket.name) + ': deleted ' + str(counts['deleted']) +
+                                   ' keys, ' + "{0:.1f}".format(counts['deleted'] / (time.time() - start)) +
+                                   ' keys/sec')
+            if batch:
+                pending.append(executor.submit(delete_batch, batch))
+            for future in pending:
+                future.result()
+        if delete_bucket and not prefix:
             bucket.delete()
-        except S3ResponseError as e:
-            self.debug(  "Exception caught doing bucket cleanup." + e.message )
-            #Todo: need to make this work with Walrus's non-S3-compliant error codes
-            if e.status == 409:
-                #Do version cleanup
-                self.debug(  "Cleaning up versioning artifacts" )
-                try:
-                    keys = bucket.get_all_versions()
-                    for k in keys:
-                        if isinstance(k, Key):
-                            self.debug(  "Got version: " + k.name + "--" + k.version_id + "-- Delete marker? " + str(k.delete_marker) )
-                            self.debug(  "Deleting key: " + k.name )
-                            bucket.delete_key(key_name=k.name,version_id=k.version_id)
-                        elif isinstance(k, DeleteMarker):
-                            self.debug(  "Got marker: " + k.name + "--" + k.version_id + "--" + str(k.is_latest) )
-                            self.debug(  "Deleting delete marker" )
-                            bucket.delete_key(key_name=k.name,version_id=k.version_id)
-                    self.debug(  "Deleting bucket " + bucket.name )
-                    bucket.delete()
-                except Exception as e:
-                    self.debug(  "Exception deleting versioning artifacts: " + e.message )
-            else:
-                self.debug('Got ' + e.message + ' and status ' + str(e.status))
-                    
+        elapsed = time.time() - start
+        metrics.record('s3.purge_bucket', elapsed)
+        stats = {'deleted': counts['deleted'],
+                 'errors': counts['errors'],
+                 'uploads_aborted': uploads_aborted,
+                 'elapsed': elapsed,
+                 'keys_per_sec': counts['deleted'] / (elapsed or 1e-6)}
+        self.debug('purge_bucket ' + str(bucket.name) + ' done, deleted:' + str(stats['deleted']) + ', errors:' +
+                   str(stats['errors']) + ', uploads aborted:' + str(uploads_aborted) + ', elapsed:' +
+                   "{0:.2f}s, {1:.1f} keys/sec".format(elapsed, stats['keys_per_sec']))
+        return stats
+
     def clear_keys_with_prefix(self, bucket, prefix):
+        """
+        Purges and deletes every bucket whose name starts with 'prefix', see purge_bucket()
+        """
         try :
-            listing = self.walrus.get_all_buckets()        
+            listing = self.s3.get_all_buckets()        
             for bucket in listing:
                 if bucket.name.startswith(prefix):
-                    self.debug( "Getting bucket listing for " + bucket.name)
-                    key_list = bucket.list()
-                    for k in key_list:
-                        if isinstance(k, boto.s3.prefix.Prefix):
-                            self.debug( "Skipping prefix" )
-                            continue
-                        self.debug( "Deleting key: " + k.name )
-                        bucket.delete_key(k)
-                    bucket.delete()
+                    self.debug( "Purging bucket " + bucket.name)
+                    self.purge_bucket(bucket, delete_bucket=True)
                 else:
                     self.debug( "skipping bucket: " + bucket.name )
         except S3ResponseError as e:
@@ -51,7 +51,14 @@ import fcntl
 import struct
 import subprocess
 import termios
+import threading
+import select
+import errno
+import resource
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+from concurrent.futures import wait as wait_futures
+from eutester.timer import metrics
 
 
 class TimeoutFunctionException(Exception): 
@@ -292,20 +299,133 @@ class Eutester(object):
             buf += '\n'
         return buf
 
-    def scan_port_range(self, ip, start, stop, timeout=1, tcp=True):
+    def scan_port_range(self, ip, start, stop, timeout=1, tcp=True, max_in_flight=1000):
         '''
         Attempts to connect to ports, returns list of ports which accepted a connection
+        (for udp, ports which responded). See scan_ports().
         '''
-        ret = []
-        for x in xrange(start,stop+1):
-            try:
-                sys.stdout.write("\r\x1b[K"+str('scanning:'+str(x)))
-                sys.stdout.flush()
-                self.test_port_status(ip, x, timeout=timeout,tcp=tcp, verbose=False)
-                ret.append(x)
-            except socket.error, se:
-                pass
-        return ret
+        results = self.scan_ports(ip, xrange(start, stop + 1), timeout=timeout, tcp=tcp,
+                                  max_in_flight=max_in_flight)
+        return sorted([port for port, status in results[ip].iteritems() if status == 'open'])
+
+    def scan_ports(self, ips, ports, timeout=1, tcp=True, max_in_flight=1000, send_buf=None):
+        '''
+        Scans 'ports' on each ip in 'ips' using non-blocking sockets, keeping up to max_in_flight probes
+        outstanding at once across all ips.
+        TCP: 'open' if the connect completes, 'closed' if refused, 'filtered' if it times out or is
+        otherwise rejected (ie: host unreachable).
+        UDP: 'send_buf' is sent to each port. 'open' if any data is returned, 'closed' if refused
+        (icmp port unreachable), otherwise 'filtered' (no response, the port may be open or filtered).
+
+        :param ips: ip string or list of ip strings to scan
+        :param ports: list (or xrange) of ports to scan on each ip
+        :param timeout: seconds to wait for each probe
+        :param tcp: boolean, scan tcp if True, else udp
+        :param max_in_flight: max number of sockets open at once, capped by the process open file limit
+        :param send_buf: udp payload to send, default "--TEST LINE--"
+        :returns: dict of ip to dict of port to status string 'open', 'closed' or 'filtered'
+        '''
+        if isinstance(ips, types.StringTypes):
+            ips = [ips]
+        send_buf = send_buf or "--TEST LINE--"
+        try:
+            fd_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+            if fd_limit > 0:
+                max_in_flight = min(max_in_flight, max(1, fd_limit - 64))
+        except (ValueError, resource.error):
+            pass
+        use_poll = hasattr(select, 'poll')
+        if not use_poll:
+            #select() can not watch descriptors beyond FD_SETSIZE
+            max_in_flight = min(max_in_flight, 512)
+        results = dict((ip, {}) for ip in ips)
+        probes = ((ip, port) for ip in ips for port in ports)
+        in_flight = {}
+        poller = select.poll() if use_poll else None
+        start = time.time()
+
+        def finish(fd, status):
+            sock, ip, port, deadline = in_flight.pop(fd)
+            if poller:
+                poller.unregister(fd)
+            sock.close()
+            results[ip][port] = status
+
+        def get_status(err):
+            if not err:
+                return 'open'
+            if err == errno.ECONNREFUSED:
+                return 'closed'
+            return 'filtered'
+
+        exhausted = False
+        while in_flight or not exhausted:
+            #Start new probes until the in flight limit is reached
+            while not exhausted and len(in_flight) < max_in_flight:
+                try:
+                    ip, port = probes.next()
+                except StopIteration:
+                    exhausted = True
+                    break
+                if tcp:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.setblocking(0)
+                    err = sock.connect_ex((ip, port))
+                    if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                        sock.close()
+                        results[ip][port] = get_status(err)
+                        continue
+                else:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+                    sock.setblocking(0)
+                    try:
+                        #Connected udp sockets report icmp port unreachable as ECONNREFUSED
+                        sock.connect((ip, port))
+                        sock.send(send_buf)
+                    except socket.error, se:
+                        sock.close()
+                        results[ip][port] = get_status(se[0])
+                        continue
+                fd = sock.fileno()
+                in_flight[fd] = (sock, ip, port, time.time() + timeout)
+                if poller:
+                    poller.register(fd, (select.POLLOUT if tcp else select.POLLIN) | select.POLLERR | select.POLLHUP)
+            if not in_flight:
+                continue
+            wait = max(0, min([probe[3] for probe in in_flight.itervalues()]) - time.time())
+            if poller:
+                ready = [fd for fd, event in poller.poll(wait * 1000)]
+            else:
+                fds = in_flight.keys()
+                if tcp:
+                    readable, writable, errored = select.select([], fds, fds, wait)
+                else:
+                    readable, writable, errored = select.select(fds, [], fds, wait)
+                ready = set(readable + writable + errored)
+            for fd in ready:
+                if fd not in in_flight:
+                    continue
+                sock = in_flight[fd][0]
+                if tcp:
+                    finish(fd, get_status(sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)))
+                else:
+                    try:
+                        sock.recv(1024)
+                        finish(fd, 'open')
+                    except socket.error, se:
+                        finish(fd, get_status(se[0]))
+            #Anything past its deadline got no answer
+            now = time.time()
+            for fd in [fd for fd, probe in in_flight.iteritems() if probe[3] <= now]:
+                finish(fd, 'filtered')
+        summary = []
+        for ip in ips:
+            statuses = results[ip].values()
+            summary.append(str(ip) + " open:" + str(statuses.count('open')) + ", closed:" +
+                           str(statuses.count('closed')) + ", filtered:" + str(statuses.count('filtered')))
+        self.debug('scan_ports (' + ('TCP' if tcp else 'UDP') + ') done in ' +
+                   "{0:.2f}".format(time.time() - start) + 's, ' + "; ".join(summary))
+        return results
     
     def test_port_status(self,
                          ip,
@@ -394,7 +514,8 @@ class Eutester(object):
     def sleep(self, seconds=1):
         """Convinience function for time.sleep()"""
         self.debug("Sleeping for " + str(seconds) + " seconds")
-        time.sleep(seconds)
+        with metrics.span('eutester.sleep'):
+            time.sleep(seconds)
 
     @staticmethod
     def render_file_template(src, dest, **kwargs):
@@ -553,18 +674,21 @@ class Eutester(object):
         self.debug( "Beginning poll loop for result " + str(callback.func_name) + " to go to " + str(result) )
         start = time.time()
         elapsed = 0
-        current_state =  callback(**callback_kwargs)
-        ### If the instance changes state or goes to the desired state before my poll count is complete
-        while( elapsed <  timeout and not oper(current_state,result) ):
-            self.debug(  str(callback.func_name) + ' returned: "' + str(current_state) + '" after '
-                       + str(elapsed/60) + " minutes " + str(elapsed%60) + " seconds.")
-            self.sleep(poll_wait)
-            try:
-                current_state = callback(**callback_kwargs)
-            except allowed_exception_types as AE:
-                self.debug('Caught allowed exception:' + str(AE))
-                pass
-            elapsed = int(time.time()- start)
+        try:
+            current_state =  callback(**callback_kwargs)
+            ### If the instance changes state or goes to the desired state before my poll count is complete
+            while( elapsed <  timeout and not oper(current_state,result) ):
+                self.debug(  str(callback.func_name) + ' returned: "' + str(current_state) + '" after '
+                           + str(elapsed/60) + " minutes " + str(elapsed%60) + " seconds.")
+                self.sleep(poll_wait)
+                try:
+                    current_state = callback(**callback_kwargs)
+                except allowed_exception_types as AE:
+                    self.debug('Caught allowed exception:' + str(AE))
+                    pass
+                elapsed = int(time.time()- start)
+        finally:
+            metrics.record('wait_for_result.' + str(callback.func_name), time.time() - start)
         self.debug(  str(callback.func_name) + ' returned: "' + str(current_state) + '" after '
                     + str(elapsed/60) + " minutes " + str(elapsed%60) + " seconds.")
         if not oper(current_state,result):
@@ -572,6 +696,118 @@ class Eutester(object):
                              "(" + str(result) + ") true after elapsed:"+str(elapsed))
         return current_state
 
+    @metrics.timed('wait_for_results')
+    def wait_for_results(self,
+                         items,
+                         timeout=60,
+                         poll_wait=1,
+                         max_poll_wait=30,
+                         backoff=1.5,
+                         jitter=0.2,
+                         quorum=None,
+                         worker_threads=10,
+                         allowed_exception_types=None):
+        """
+        Multi-target version of wait_for_result(). Polls many callbacks concurrently, each with its own
+        exponential backoff plus jitter between polls, and returns as soon as all (or 'quorum') items
+        have returned their expected result.
+
+        example:
+            items = [(instance.update, 'running', operator.eq) for instance in instances]
+            results = tester.wait_for_results(items, timeout=300)
+
+        :param items: list of tuples (callback, expected result, [oper], [callback kwargs dict]).
+                      oper defaults to operator.eq
+        :param timeout: Time in seconds to wait for all items before failure
+        :param poll_wait: initial seconds between polls of an item
+        :param max_poll_wait: max seconds between polls of an item after backoff
+        :param backoff: multiplier applied to an item's poll wait after each unsuccessful poll
+        :param jitter: random fraction (+/-) applied to each wait so polls do not line up
+        :param quorum: number of items which must succeed, defaults to all items
+        :param worker_threads: max number of callbacks polled at once
+        :param allowed_exception_types: list of exception types ignored while polling
+        :return: list of dicts (one per item, in order) with keys: 'callback', 'expected', 'result',
+                 'success', 'elapsed', 'polls'
+        :raise: WaitForResultException if quorum is not met within timeout
+        """
+        allowed_exception_types = tuple(allowed_exception_types or [])
+        quorum = len(items) if quorum is None else quorum
+        start = time.time()
+        deadline = start + timeout
+        results = []
+        for item in items:
+            item = list(item)
+            callback, expected = item[0], item[1]
+            oper = item[2] if len(item) > 2 and item[2] else operator.eq
+            callback_kwargs = item[3] if len(item) > 3 and item[3] else {}
+            results.append({'callback': callback, 'expected': expected, 'oper': oper,
+                            'kwargs': callback_kwargs, 'result': None, 'success': False,
+                            'elapsed': None, 'polls': 0})
+
+        def poll_item(result):
+            try:
+                result['polls'] += 1
+                result['result'] = result['callback'](**result['kwargs'])
+                if result['oper'](result['result'], result['expected']):
+                    result['success'] = True
+            except allowed_exception_types as AE:
+                self.debug('Caught allowed exception:' + str(AE))
+            result['elapsed'] = time.time() - start
+            return result
+
+        self.debug("Beginning concurrent poll loop for " + str(len(items)) + " results, quorum:" + str(quorum))
+        #Items are polled in rounds. Each task polls one item once and the item is then rescheduled after its
+        #backoff, so items beyond worker_threads are not left waiting for earlier items to succeed or time out
+        success_count = 0
+        workers = max(1, min(worker_threads, len(results)))
+        scheduled = dict((index, {'due': start, 'wait': poll_wait}) for index in xrange(len(results)))
+        in_flight = {}
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            while success_count < quorum:
+                now = time.time()
+                if now < deadline:
+                    due = sorted([index for index in scheduled if scheduled[index]['due'] <= now],
+                                 key=lambda index: scheduled[index]['due'])
+                    for index in due[:workers - len(in_flight)]:
+                        in_flight[executor.submit(poll_item, results[index])] = (index, scheduled.pop(index))
+                if not in_flight:
+                    if now >= deadline or not scheduled:
+                        break
+                    time.sleep(max(0, min([entry['due'] for entry in scheduled.values()] + [deadline]) - now))
+                    continue
+                if now >= deadline:
+                    #No more polls are started, wait for those in progress
+                    wait_time = None
+                elif len(in_flight) < workers and scheduled:
+                    wait_time = max(0, min([entry['due'] for entry in scheduled.values()] + [deadline]) - now)
+                else:
+                    wait_time = deadline - now
+                done, not_done = wait_futures(in_flight.keys(), timeout=wait_time, return_when=FIRST_COMPLETED)
+                for future in done:
+                    index, entry = in_flight.pop(future)
+                    if future.result()['success']:
+                        success_count += 1
+                        continue
+                    remaining = deadline - time.time()
+                    if remaining > 0:
+                        delay = min(entry['wait'] * (1 + random.uniform(-jitter, jitter)), remaining)
+                        scheduled[index] = {'due': time.time() + max(delay, 0),
+                                            'wait': min(entry['wait'] * backoff, max_poll_wait)}
+        finally:
+            executor.shutdown(wait=True)
+        for result in results:
+            self.debug(str(getattr(result['callback'], 'func_name', result['callback'])) + ' returned: "' +
+                       str(result['result']) + '", expected:"' + str(result['expected']) + '", success:' +
+                       str(result['success']) + ', polls:' + str(result['polls']) + ', elapsed:' +
+                       "{0:.2f}".format(result['elapsed'] or 0))
+            result.pop('oper')
+            result.pop('kwargs')
+        if success_count < quorum:
+            raise WaitForResultException(str(success_count) + "/" + str(len(items)) + " results succeeded, quorum:"
+                                         + str(quorum) + ", after elapsed:" + str(int(time.time() - start)))
+        return results
+
     def get_md5_for_file(self, filepath, machine=None):
         if machine:
             machinename = machine.hostname
@@ -52,6 +52,7 @@ from eutester import Eutester
 from eutester.euvolume import EuVolume
 from eutester import eulogger
 from eutester.taggedresource import TaggedResource
+from eutester.timer import metrics
 from boto.ec2.instance import InstanceState
 from boto.ec2.networkinterface import NetworkInterface
 from boto.exception import EC2ResponseError
@@ -113,6 +114,7 @@ class EuInstance(Instance, TaggedResource):
         newins.virtio_blk = False
         newins.bdm_root_vol = None
         newins.attached_vols = []
+        newins.dev_md5_cache = {}
         newins.scsidevs = []
         newins.ops = None
         newins.logger = None
@@ -459,6 +461,7 @@ class EuInstance(Instance, TaggedResource):
                                                     timeout=timeout,
                                                     retry=self.retry,
                                                     debugmethod=self.debugmethod,
+                                                    use_pool=getattr(self.tester, 'use_ssh_pool', None),
                                                     verbose=self.verbose)
         else:
             self.debug("keypath or username/password need to be populated "
@@ -840,7 +843,34 @@ class EuInstance(Instance, TaggedResource):
         for line in out:
             retlist.append(line.strip())
         return retlist
-    
+
+    def get_dev_dir_and_ids(self, match=None):
+        '''
+        Same as get_dev_dir() but also reads /dev/disk/by-id in the same command, returns a tuple of
+        (list of matching dev names, dict of dev name:list of by-id names). The by-id names usually contain
+        the disk serial, which on some hypervisors includes the volume id.
+        match - optional - string used in grep search of /dev dir on instance
+        '''
+        devs = []
+        ids = {}
+        if match is None:
+            match = '^sd\|^vd\|^xd\|^xvd'
+        out = self.sys("ls -1 /dev/ | grep '" + str(match) + "'; echo EUBYID; "
+                       "ls -l /dev/disk/by-id/ 2>/dev/null | awk '{print $9, $11}'", verbose=False)
+        in_ids = False
+        for line in out:
+            line = line.strip()
+            if line == 'EUBYID':
+                in_ids = True
+            elif not in_ids:
+                if line:
+                    devs.append(line)
+            else:
+                fields = line.split()
+                if len(fields) == 2:
+                    ids.setdefault(fields[1].split('/')[-1], []).append(fields[0])
+        return devs, ids
+
     def assertFilePresent(self,filepath):
         '''
         Method to check for the presence of a file at 'filepath' on the instance
@@ -1152,7 +1182,34 @@ class EuInstance(Instance, TaggedResource):
                 dev = None
         if dev is None:
             raise Exception("Could not find a free scsi dev on instance:"+self.id+", maxdevs:"+str(maxdevs)+"\nCloud_devs:"+str(in_use_cloud)+"\nGuest_devs:"+str(in_use_guest))
-        
+
+    def get_free_scsi_devs(self, count, prefix=None, maxdevs=100):
+        '''
+        Returns a list of 'count' free cloud device names using a single describe of the volumes attached
+        to this instance, for issuing several attach requests back to back. See get_free_scsi_dev()
+        count - mandatory - number of device names to return
+        optional - prefix - string, pre-pended to the the device search string
+        optional - maxdevs - number use to specify the max device names to iterate over.
+        '''
+        if prefix is None:
+            prefix = self.block_device_prefix
+        in_use = set([str(vol.attach_data.device) for vol in self.attached_vols if vol.attach_data])
+        for vol in self.tester.get_volumes(attached_instance=self.id):
+            if vol.attach_data is not None:
+                in_use.add(str(vol.attach_data.device))
+        letters = 'efghijklmnopqrstuvwxyz'
+        devs = []
+        for x in xrange(0, maxdevs):
+            #double up the letter identifier to avoid exceeding z
+            dev = "/dev/" + prefix + ('e' * (x / len(letters))) + letters[x % len(letters)]
+            if dev not in in_use:
+                devs.append(dev)
+                if len(devs) == count:
+                    self.debug("Instance:" + str(self.id) + " returning available cloud scsi devs:" + ", ".join(devs))
+                    return devs
+        raise Exception("Could not find " + str(count) + " free scsi devs on instance:" + self.id + ", maxdevs:" +
+                        str(maxdevs) + "\nIn use devs:" + ", ".join(sorted(in_use)))
+
     def zero_fill_volume(self,euvolume):
         '''
         zero fills the given euvolume with,returns dd's data/time stat
@@ -1532,6 +1589,47 @@ class EuInstance(Instance, TaggedResource):
         else:
             md5 = str(self.sys("head -c "+str(length)+" "+str(devpath)+" | md5sum")[0]).split(' ')[0].strip()
         return md5
+
+    def get_dev_md5s(self, devlist=None, length=32, timeout=120, use_cache=True):
+        '''
+        Returns a dict of '/dev/<name>':md5 for the block devices in devlist, hashing all of them
+        concurrently on the guest with a single command. By default all devices matched by
+        get_dev_dir() are hashed.
+        Results for the full device list are cached per md5 length until this instance's attached
+        volumes (or their md5s) change, see clear_dev_md5_cache().
+        devlist - optional - list of device names or paths to hash
+        length - optional - number of bytes from the head of each device to hash, 0 hashes the entire device
+        timeout - optional - command timeout in seconds
+        use_cache - optional - boolean, use/update the cached results
+        '''
+        cache_key = (int(length), tuple(sorted([(str(vol.id), str(vol.md5)) for vol in self.attached_vols])))
+        if devlist is None:
+            if use_cache and cache_key in self.dev_md5_cache:
+                return dict(self.dev_md5_cache[cache_key])
+            devs = "$(ls -1 /dev/ | grep '^sd\|^vd\|^xd\|^xvd' | sed 's|^|/dev/|')"
+        else:
+            devs = " ".join(['/dev/' + str(dev).replace('/dev/', '') for dev in devlist])
+        if int(length) == 0:
+            hash_cmd = 'md5sum $d'
+        else:
+            hash_cmd = 'head -c ' + str(length) + ' $d | md5sum'
+        cmd = ('for d in ' + devs + '; do ( [ -b $d ] && echo "EUMD5 $d $(' + hash_cmd + ' 2>/dev/null)" ) & done; wait')
+        md5s = {}
+        for line in self.sys(cmd, timeout=timeout, verbose=False):
+            fields = line.split()
+            if len(fields) >= 3 and fields[0] == 'EUMD5':
+                md5s[fields[1]] = fields[2]
+        self.debug('Got md5s for ' + str(len(md5s)) + ' devices, length:' + str(length))
+        if devlist is None:
+            #Only the full device list is cached, and only for the current set of attached volumes
+            self.dev_md5_cache = {cache_key: dict(md5s)}
+        return md5s
+
+    def clear_dev_md5_cache(self):
+        '''
+        Clears cached device md5s, ie: after writing to a guest device outside of the euvolume helpers
+        '''
+        self.dev_md5_cache = {}
         
     def reboot_instance_and_verify(self,
                                    waitconnect=30,
@@ -1625,7 +1723,7 @@ class EuInstance(Instance, TaggedResource):
                            'elapsed:{1}'
                            .format(self.id, int(time.time() - start)))
 
-    def attach_euvolume_list(self,list,intervoldelay=0, timepervol=90, md5len=32):
+    def attach_euvolume_list(self,list,intervoldelay=0, timepervol=90, md5len=32, pipelined=False):
         '''
         Attempts to attach a list of euvolumes. Due to limitations with KVM and detecting
         the location/device name of the volume as attached on the guest, MD5 sums are used...
@@ -1633,34 +1731,39 @@ class EuInstance(Instance, TaggedResource):
         before attempting to attach the next volume in the list. 
         -If the next volume in the list does not have an MD5, the next volume will not be
          attached until this volume is detected and an md5sum is populated in the euvolume.
+        -If pipelined is set, all attach requests are sent back to back instead and the volumes
+         are found and seeded on the guest in batches, see attach_euvolume_list_pipelined()
         
         :param list: List of volumes to be attached, if volumes are not of type
                      euvolume they will be converted
         :param intervoldelay : integer representing seconds between each volume attach attempt
         :param timepervol: time to wait for volume to attach before failing
         :param md5len: length from head of block device to read when calculating md5
-        
+        :param pipelined: boolean, attach the volumes as a pipeline rather than one at a time
+        :returns: the per volume stage records when pipelined, otherwise None
         '''
+        records = None
         for euvol in list:
             if not isinstance(euvol, EuVolume): # or not euvol.md5:
                 list[list.index(euvol)] = EuVolume.make_euvol_from_vol(euvol, self.tester)
-        for euvol in list:
-            dev = self.get_free_scsi_dev()
-            if euvol.md5:
-                # Monitor volume to attached, dont write/read head for md5 use existing.
-                # Check md5 sum later in get_unsynced_volumes.
-                if (self.tester.attach_volume(self, euvol, dev, pause=10,timeout=timepervol)):
-                    self.attached_vols.append(euvol)
+        if pipelined:
+            records = self.attach_euvolume_list_pipelined(list, timepervol=timepervol, md5len=md5len)
+        else:
+            for euvol in list:
+                dev = self.get_free_scsi_dev()
+                if euvol.md5:
+                    # Monitor volume to attached, dont write/read head for md5 use existing.
+                    # Check md5 sum later in get_unsynced_volumes.
+                    if (self.tester.attach_volume(self, euvol, dev, pause=10,timeout=timepervol)):
+                        self.attached_vols.append(euvol)
+                    else:
+                        raise Exception('attach_euvolume_list: {0} Test Failed to attach volume:{1}'
+                                        .format(self.id, euvol.id))
                 else:
-                    raise Exception('attach_euvolume_list: {0} Test Failed to attach volume:{1}'
-                                    .format(self.id, euvol.id))
-            else:
-                #monitor volume to attached and write unique string to head and record it's md5sum 
-                self.attach_euvolume(euvol, dev, timeout=timepervol)
-            if intervoldelay:
-                time.sleep(intervoldelay)
-        start = time.time()
-        elapsed = 0 
+                    #monitor volume to attached and write unique string to head and record it's md5sum 
+                    self.attach_euvolume(euvol, dev, timeout=timepervol)
+                if intervoldelay:
+                    time.sleep(intervoldelay)
         badvols = self.get_unsynced_volumes(list, md5length=md5len, timepervol=timepervol,
                                             check_md5=True)
         if badvols:
@@ -1668,8 +1771,281 @@ class EuInstance(Instance, TaggedResource):
             for bv in badvols:
                 buf += str(bv.id)+","
             raise Exception("Volume(s) were not found on guest:"+str(buf))
-        
-        
+        return records
+
+    def attach_euvolume_list_pipelined(self, euvolumes, timepervol=90, md5len=32, overwrite=False,
+                                       poll_interval=2):
+        '''
+        Attaches a list of euvolumes as a pipeline instead of one at a time, so cloud attach latency
+        overlaps with guest discovery and i/o:
+        -All attach requests are sent back to back, using free cloud devs found with one describe.
+        -Each poll updates all attaching volumes with one describe, and lists the guest's /dev and
+         /dev/disk/by-id with one command. New guest devices are matched to volumes by the volume id in
+         the disk serial, then by requested dev name (non virtio only), and lastly by elimination when
+         one volume and one device are left. If several volumes are left which can not be told apart,
+         they are detached and attached again one at a time with attach_euvolume().
+        -Volumes without an md5 that are found in the same poll are seeded together on the guest,
+         see seed_attached_euvolumes()
+        Volumes which already have an md5 are not written to, these are left for get_unsynced_volumes()
+        to find by md5.
+
+        :param euvolumes: list of EuVolumes to attach
+        :param timepervol: seconds per volume allowed for the pipeline to complete
+        :param md5len: length from head of block device to seed and read when calculating md5
+        :param overwrite: seed volumes even if the head of their device is not zero filled
+        :param poll_interval: seconds between polls
+        :returns: list of per volume dicts of: volume, dev, guestdev, error, and the issue, attached,
+                  found and seeded times in seconds from the start of the pipeline
+        '''
+        start = time.time()
+        md5len = md5len or 32
+        records = []
+        self.set_block_device_prefix()
+        dev_list_before = set(self.get_dev_dir())
+        for euvol, dev in zip(euvolumes, self.get_free_scsi_devs(len(euvolumes))):
+            record = {'volume': euvol, 'dev': dev, 'guestdev': None, 'status': None, 'error': None,
+                      'issue': None, 'attached': None, 'found': None, 'seeded': None, 'seed_attempts': 0,
+                      'serialize': None}
+            records.append(record)
+            self.debug("Sending attach for " + str(euvol.id) + " to be attached to " + str(self.id) +
+                       " at requested device " + str(dev))
+            try:
+                euvol.attach(self.id, dev)
+                record['issue'] = time.time() - start
+            except Exception, e:
+                record['error'] = 'attach request failed: ' + str(e)
+        metrics.record('attach_pipeline.issue', time.time() - start)
+        timeout = timepervol * len(records)
+        polls = 0
+        while True:
+            polls += 1
+            elapsed = time.time() - start
+            #Cloud stage, one describe for all volumes still attaching
+            attaching = [r for r in records if not r['error'] and r['attached'] is None]
+            if attaching:
+                self.tester.update_euvolumes([r['volume'] for r in attaching])
+                for record in attaching:
+                    euvol = record['volume']
+                    status = euvol.attach_data.status if euvol.attach_data else None
+                    if status and re.search('attached', str(status)):
+                        if euvol.attach_data.device != record['dev']:
+                            record['error'] = ('attached device:' + str(euvol.attach_data.device) +
+                                               ', does not equal requested dev:' + str(record['dev']))
+                            continue
+                        record['attached'] = time.time() - start
+                        metrics.record('attach_pipeline.cloud_attach', record['attached'] - record['issue'])
+                        if euvol.md5:
+                            self.attached_vols.append(euvol)
+                    elif status:
+                        record['status'] = status
+                    elif record['status']:
+                        record['error'] = 'reverted from attach status:' + str(record['status'])
+            #Guest stage, one listing of /dev for all attached volumes not yet found
+            discovering = [r for r in records if not r['error'] and r['attached'] is not None
+                           and not r['volume'].md5 and not r['guestdev'] and not r['serialize']]
+            if discovering:
+                self._find_pipelined_guest_devs(records, discovering, dev_list_before)
+                for record in discovering:
+                    if record['guestdev']:
+                        record['found'] = time.time() - start
+                        metrics.record('attach_pipeline.guest_found', record['found'] - record['attached'])
+                        record['volume'].guestdev = record['guestdev']
+                        self.attached_vols.append(record['volume'])
+            #Seed stage, one concurrent write and md5 on the guest for all volumes found
+            seeding = [r for r in records if not r['error'] and r['guestdev'] and r['seeded'] is None]
+            if seeding:
+                seed_start = time.time()
+                try:
+                    seeded = self.seed_attached_euvolumes([r['volume'] for r in seeding], length=md5len,
+                                                          overwrite=overwrite)
+                except Exception, e:
+                    self.debug('Error seeding volumes: ' + str(e))
+                    seeded = {}
+                metrics.record('attach_pipeline.seed', time.time() - seed_start)
+                for record in seeding:
+                    if record['volume'].id in seeded:
+                        record['seeded'] = time.time() - start
+                    else:
+                        record['seed_attempts'] += 1
+                        if record['seed_attempts'] >= 3:
+                            record['error'] = 'failed to seed guest dev:' + str(record['guestdev'])
+            in_progress = [r for r in records if not r['error'] and not r['serialize'] and
+                           (r['attached'] is None or (not r['volume'].md5 and r['seeded'] is None))]
+            if not in_progress:
+                break
+            if elapsed > timeout:
+                for record in in_progress:
+                    record['error'] = ('timed out, status:' + str(record['status']) +
+                                       ', guestdev:' + str(record['guestdev']))
+                break
+            self.debug('Attach pipeline poll:' + str(polls) + ', volumes in progress:' + str(len(in_progress)) +
+                       ', elapsed:' + str(int(elapsed)) + '/' + str(timeout))
+            time.sleep(poll_interval)
+        serial = [r for r in records if r['serialize'] and not r['error']]
+        if serial:
+            self._attach_pipelined_serially(serial, start, timepervol=timepervol, overwrite=overwrite)
+        metrics.record('attach_pipeline.total', time.time() - start)
+        self.show_attach_pipeline_report(records, polls=polls)
+        failed = [r for r in records if r['error']]
+        if failed:
+            raise Exception('attach_euvolume_list_pipelined: ' + str(self.id) + ' Failed to attach volume(s):' +
+                            "".join(['\n' + str(r['volume'].id) + ': ' + str(r['error']) for r in failed]))
+        return records
+
+    def _find_pipelined_guest_devs(self, records, discovering, dev_list_before):
+        '''
+        Lists the guest's devices once and sets 'guestdev' for the records in 'discovering' which can be
+        matched to a new device. See attach_euvolume_list_pipelined()
+        '''
+        devs, ids = self.get_dev_dir_and_ids()
+        assigned = set([str(r['guestdev']).replace('/dev/', '') for r in records if r['guestdev']])
+        new_devs = [dev for dev in devs if dev not in dev_list_before and dev not in assigned]
+        #Skip partitions of new devices, ie a volume created from a partitioned snapshot
+        new_devs = [dev for dev in new_devs if not [base for base in new_devs if base != dev and
+                                                    dev.startswith(base) and dev[len(base):].isdigit()]]
+        #Order devices as the guest names them, ie: vdz before vdaa
+        new_devs.sort(key=lambda dev: (len(dev), dev))
+        unmatched = list(discovering)
+
+        def assign(record, dev):
+            self.debug(str(record['volume'].id) + " Requested dev:" + str(record['dev']) +
+                       ", found on guest at device:/dev/" + str(dev))
+            record['guestdev'] = '/dev/' + dev
+            new_devs.remove(dev)
+            unmatched.remove(record)
+
+        for record in list(unmatched):
+            for dev in new_devs:
+                if [name for name in ids.get(dev, []) if str(record['volume'].id).lower() in name.lower()]:
+                    assign(record, dev)
+                    break
+        if not self.virtio_blk:
+            for record in list(unmatched):
+                requested = re.sub('^(sd|vd|xvd|xd)', '', str(record['dev']).replace('/dev/', ''))
+                for dev in new_devs:
+                    if re.sub('^(sd|vd|xvd|xd)', '', dev) == requested:
+                        assign(record, dev)
+                        break
+        if not unmatched or not new_devs:
+            return
+        #Devices of attached volumes that already have an md5 are found by md5, not assigned
+        md5_vols = [r['volume'] for r in records if not r['error'] and r['volume'].md5 and not r['guestdev']]
+        md5_found = 0
+        for length in set([vol.md5len for vol in md5_vols]):
+            dev_md5s = self.get_dev_md5s(new_devs, length=length, use_cache=False)
+            for vol in md5_vols:
+                for dev in list(new_devs):
+                    if vol.md5len == length and dev_md5s.get('/dev/' + dev) == vol.md5:
+                        new_devs.remove(dev)
+                        md5_found += 1
+                        break
+        #Otherwise a device can only be assigned by elimination, once every volume is attached and every
+        #volume with an md5 has been found. Guests do not name devices in attach order, so several volumes
+        #left unmatched can not be told apart and are marked to be attached again one at a time.
+        if [r for r in records if not r['error'] and r['attached'] is None] or len(md5_vols) != md5_found:
+            return
+        if len(unmatched) == 1 and len(new_devs) == 1:
+            self.debug('Matching guest dev:' + str(new_devs[0]) + ' to the only unmatched volume')
+            assign(unmatched[0], new_devs[0])
+        elif len(unmatched) > 1 and len(new_devs) == len(unmatched):
+            self.debug('Can not match guest devs:' + ", ".join(new_devs) + ' to volumes:' +
+                       ", ".join([str(r['volume'].id) for r in unmatched]))
+            for record in unmatched:
+                record['serialize'] = list(new_devs)
+
+    def _attach_pipelined_serially(self, records, start, timepervol=90, overwrite=False):
+        '''
+        Detaches the volumes of pipeline records whose guest devices could not be told apart, waits for
+        their devices to leave the guest, then attaches them again one at a time with attach_euvolume().
+        See attach_euvolume_list_pipelined()
+        '''
+        self.debug('Attaching volumes one at a time:' + ", ".join([str(r['volume'].id) for r in records]))
+        devs = set()
+        for record in records:
+            devs.update(record['serialize'])
+            try:
+                self.tester.detach_volume(record['volume'], timeout=timepervol)
+            except Exception, e:
+                record['error'] = 'detach before serial attach failed: ' + str(e)
+        #Wait for the devices to be removed so a re-used device name shows up as new on the next attach
+        wait_start = time.time()
+        while devs.intersection(self.get_dev_dir()):
+            if time.time() - wait_start > timepervol:
+                for record in records:
+                    if not record['error']:
+                        record['error'] = ('guest devs:' + ", ".join(sorted(devs.intersection(self.get_dev_dir()))) +
+                                           ' still present after detach before serial attach')
+                return
+            time.sleep(2)
+        for record in records:
+            if record['error']:
+                continue
+            euvol = record['volume']
+            try:
+                self.attach_euvolume(euvol, timeout=timepervol, overwrite=overwrite)
+            except Exception, e:
+                record['error'] = 'serial attach failed: ' + str(e)
+                continue
+            record['dev'] = euvol.attach_data.device
+            record['guestdev'] = euvol.guestdev
+            record['found'] = record['seeded'] = time.time() - start
+
+    def seed_attached_euvolumes(self, euvolumes, length=32, overwrite=False, timeout=120):
+        '''
+        Writes each euvolume's id followed by random data to the head of its guest device, then records
+        the md5 of the first 'length' bytes in the euvolume. All volumes are seeded concurrently on the guest
+        with a single command. The same as vol_write_random_data_get_md5() for each volume.
+        Returns a dict of volume id:md5 for the volumes seeded
+        euvolumes - mandatory - list of attached euvolumes with guestdev populated
+        length - optional - number of bytes at the head of each device to fill and hash
+        overwrite - optional - boolean. write to volumes regardless of whether existing data is found
+        timeout - optional - command timeout in seconds
+        '''
+        length = int(length)
+        vols = dict([(str(vol.id), vol) for vol in euvolumes])
+        specs = " ".join([str(vol.id) + ':' + str(vol.guestdev).strip() for vol in euvolumes])
+        if overwrite:
+            check = 'true'
+        else:
+            #check to see if there's existing data that we should avoid overwriting
+            check = '[ $(head -c ' + str(length) + ' $d | xargs -0 printf %s | wc -c) -eq 0 ]'
+        cmd = ('for s in ' + specs + '; do ( v=${s%%:*}; d=${s#*:}; [ -b $d ] || exit 1; '
+               'if ' + check + '; then echo $v | dd of=$d 2>/dev/null; n=$((' + str(length) + ' - ${#v} - 1)); '
+               'if [ $n -gt 0 ]; then head -c $n /dev/urandom | '
+               'dd of=$d bs=1 seek=$((${#v} + 1)) conv=notrunc 2>/dev/null; fi; fi; sync; '
+               'echo "EUSEED $v $(head -c ' + str(length) + ' $d | md5sum)" ) & done; wait')
+        md5s = {}
+        for line in self.sys(cmd, timeout=timeout, verbose=False):
+            fields = line.split()
+            if len(fields) >= 3 and fields[0] == 'EUSEED' and fields[1] in vols:
+                vol = vols[fields[1]]
+                vol.md5 = fields[2]
+                vol.md5len = length
+                md5s[vol.id] = vol.md5
+                self.debug("Filled Volume:" + str(vol.id) + " dev:" + str(vol.guestdev) + " md5:" + str(vol.md5))
+        return md5s
+
+    def show_attach_pipeline_report(self, records, polls=None, printmethod=None, printme=True):
+        '''
+        Displays the per volume stage timings returned by attach_euvolume_list_pipelined(), in seconds
+        from the start of the pipeline
+        '''
+        pt = PrettyTable(['VOLUME', 'CLOUD DEV', 'GUEST DEV', 'ISSUED', 'ATTACHED', 'GUEST FOUND', 'SEEDED',
+                          'ERROR'])
+        pt.align['ERROR'] = 'l'
+        fmt = lambda x: "{0:.2f}".format(x) if x is not None else None
+        for record in records:
+            euvol = record['volume']
+            guestdev = record['guestdev'] or ('(by md5)' if euvol.md5 and not record['error'] else None)
+            pt.add_row([euvol.id, record['dev'], guestdev, fmt(record['issue']), fmt(record['attached']),
+                        fmt(record['found']), fmt(record['seeded']), record['error']])
+        if polls is not None:
+            pt.add_row(['', '', 'POLLS:' + str(polls), '', '', '', '', ''])
+        if not printme:
+            return pt
+        printmethod = printmethod or self.debug
+        printmethod("\n" + str(pt) + "\n")
+
     def get_unsynced_volumes(self,euvol_list=None, md5length=32, timepervol=90,min_polls=2,
                              check_md5=False):
         '''
@@ -1733,16 +2109,19 @@ class EuInstance(Instance, TaggedResource):
                                 self.debug('Checking any new devs for md5:'+str(vol.md5))
                                 #Do some detective work to see what device name the previously
                                 # attached volume is using
-                                devlist = self.get_dev_dir()
-                                for vdev in devlist:
-                                    vdev = "/dev/"+str(vdev)
-                                    
+                                #Hash all guest devs in one command. Cached results are only
+                                # trusted on the first pass for this volume, and only if they match
+                                dev_md5s = self.get_dev_md5s(length=vol.md5len,
+                                                             use_cache=not checked_vdevs)
+                                if not checked_vdevs and vol.md5 not in dev_md5s.values():
+                                    dev_md5s = self.get_dev_md5s(length=vol.md5len, use_cache=False)
+                                for vdev in sorted(dev_md5s):
                                     #if we've already checked the md5 on this dev no need
                                     # to re-check it.
                                     if not vdev in checked_vdevs: 
                                         self.debug('Checking ' + str(vdev) +
                                                    " for match against euvolume:" + str(vol.id))
-                                        md5 = self.get_dev_md5(vdev, vol.md5len )
+                                        md5 = dev_md5s[vdev]
                                         self.debug('comparing ' + str(md5) + ' vs ' + str(vol.md5))
                                         if md5 == vol.md5:
                                             self.debug('Found match at dev:' + str(vdev))
@@ -1798,10 +2177,12 @@ class EuInstance(Instance, TaggedResource):
 
         md5 = md5 or euvolume.md5
         md5len = md5len or euvolume.md5len
-        for vdev in  self.get_dev_dir():
-            vdev = '/dev/'+ str(vdev).replace('/dev/','')
-            self.debug('Checking '+str(vdev)+" for a matching block device")
-            block_md5 = self.get_dev_md5(vdev, md5len )
+        dev_md5s = self.get_dev_md5s(length=md5len)
+        if md5 not in dev_md5s.values():
+            #Devices may have been added or written to since the cached scan
+            dev_md5s = self.get_dev_md5s(length=md5len, use_cache=False)
+        for vdev in sorted(dev_md5s):
+            block_md5 = dev_md5s[vdev]
             self.debug('comparing dev' + str(vdev) +': '+str(block_md5)+' vs vol:'+str(md5))
             if block_md5 == md5:
                 self.debug('Found match at dev:'+str(vdev))
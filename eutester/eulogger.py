@@ -45,8 +45,210 @@ import os
 import sys
 import logging
 import time
+import threading
+import Queue
+import atexit
+
+
+class Async_Log_Writer(object):
+    """
+    Single background writer shared by all Eulogger file handlers. Log lines are put on a bounded queue by the
+    logging thread and written by one writer thread, which holds one open file per log file path and flushes
+    once per batch rather than once per record.
+    When the queue is full, overflow_policy 'block' waits up to put_timeout seconds for room (back-pressure)
+    before dropping the record, 'drop' drops the record immediately.
+    The writer thread only runs in the process that created the writer. Forked children (ie multiprocessing
+    workers, which exit via os._exit() without running atexit) write their lines synchronously instead, so
+    nothing is left queued when they exit.
+    """
+    def __init__(self, max_queue=10000, batch_size=500, flush_interval=0.5, overflow_policy='block',
+                 put_timeout=5):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.put_timeout = put_timeout
+        self.queue = Queue.Queue(maxsize=max_queue)
+        self.files = {}
+        self.thread = None
+        self._lock = threading.Lock()
+        self._stop_marker = object()
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.batches = 0
+        self.pid = os.getpid()
+        self._sync_files = {}
+        self._sync_pid = None
+
+    def start(self):
+        with self._lock:
+            if self.thread and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._run, name='eulogger_writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def put(self, filepath, line):
+        """
+        Queue a formatted log line to be appended to filepath. Returns True if queued, False if dropped.
+        """
+        if os.getpid() != self.pid:
+            return self._write_sync(filepath, line)
+        if not self.thread or not self.thread.is_alive():
+            self.start()
+        try:
+            if self.overflow_policy == 'drop':
+                self.queue.put_nowait((filepath, line))
+            else:
+                self.queue.put((filepath, line), True, self.put_timeout)
+        except Queue.Full:
+            with self._lock:
+                self.dropped += 1
+            return False
+        with self._lock:
+            self.queued += 1
+        return True
+
+    def _write_sync(self, filepath, line):
+        """
+        Write a line directly to filepath from a forked child. Files are opened unbuffered, so lines are on
+        disk even if the child exits without cleanup. The queue and locks are not used, as they may have been
+        held by another thread at the time of the fork.
+        """
+        if self._sync_pid != os.getpid():
+            self._sync_files = {}
+            self._sync_pid = os.getpid()
+        try:
+            logfile = self._sync_files.get(filepath)
+            if logfile is None:
+                logfile = open(filepath, 'a', 0)
+                self._sync_files[filepath] = logfile
+            logfile.write(line + '\n')
+        except Exception, e:
+            sys.stderr.write('Eulogger failed to write to:' + str(filepath) + ', err:' + str(e) + '\n')
+            return False
+        return True
+
+    def _get_file(self, filepath):
+        logfile = self.files.get(filepath)
+        if logfile is None or logfile.closed:
+            logfile = open(filepath, 'a')
+            self.files[filepath] = logfile
+        return logfile
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self.queue.get(True, self.flush_interval)]
+            except Queue.Empty:
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            dirty = set()
+            stop = False
+            written = 0
+            for item in batch:
+                if item is self._stop_marker:
+                    stop = True
+                    continue
+                filepath, line = item
+                try:
+                    logfile = self._get_file(filepath)
+                    logfile.write(line + '\n')
+                    dirty.add(logfile)
+                    written += 1
+                except Exception, e:
+                    sys.stderr.write('Eulogger writer failed to write to:' + str(filepath) + ', err:' + str(e) + '\n')
+            for logfile in dirty:
+                try:
+                    logfile.flush()
+                except Exception:
+                    pass
+            with self._lock:
+                self.written += written
+                self.batches += 1
+            for item in batch:
+                self.queue.task_done()
+            if stop:
+                return
+
+    def flush(self):
+        """
+        Block until all log lines queued so far have been written and flushed
+        """
+        if os.getpid() != self.pid:
+            return
+        if self.thread and self.thread.is_alive():
+            self.queue.join()
+
+    def stop(self, timeout=10):
+        """
+        Write out any queued log lines, stop the writer thread and close all log files
+        """
+        if os.getpid() != self.pid:
+            #Only close files opened by this process, not those inherited from the writer's process
+            for logfile in self._sync_files.values():
+                try:
+                    logfile.close()
+                except Exception:
+                    pass
+            self._sync_files = {}
+            return
+        if self.thread and self.thread.is_alive():
+            self.queue.put(self._stop_marker)
+            self.thread.join(timeout)
+        for logfile in self.files.values():
+            try:
+                logfile.close()
+            except Exception:
+                pass
+        self.files = {}
+
+    def get_stats(self):
+        """
+        Returns dict of writer counters: queued, written, dropped, batches, pending and open_files
+        """
+        with self._lock:
+            return {'queued': self.queued,
+                    'written': self.written,
+                    'dropped': self.dropped,
+                    'batches': self.batches,
+                    'pending': self.queue.qsize(),
+                    'open_files': len(self.files)}
+
+#Writer shared by all Eulogger instances, see Eulogger.async_file_logging
+async_log_writer = Async_Log_Writer()
+atexit.register(async_log_writer.stop)
+
+
+class Queued_File_Handler(logging.Handler):
+    """
+    Logging handler that formats records on the logging thread and hands the line to the shared
+    Async_Log_Writer, rather than opening and writing the file itself.
+    """
+    def __init__(self, filepath, level=logging.NOTSET, writer=None):
+        logging.Handler.__init__(self, level)
+        self.filepath = os.path.abspath(filepath)
+        self.writer = writer or async_log_writer
+
+    def emit(self, record):
+        try:
+            self.writer.put(self.filepath, self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.writer.flush()
+
 
 class Eulogger(object):
+    #Log file output is written by the shared async_log_writer thread rather than by a FileHandler per child logger
+    async_file_logging = True
+
     #constructor for the Eulogger
     def __init__(self,
                  parent_logger_name = 'eutester',
@@ -58,7 +260,8 @@ class Eulogger(object):
                  make_log_file_global=True,
                  use_global_log_files=True,
                  file_format = None,
-                 clear_file = False):
+                 clear_file = False,
+                 async_file_logging = None):
         """
         This class basically sets up a child debugger for testing purposes.
         It allows the user to set up a new logger object and pass different logging formats and levels so different
@@ -77,6 +280,8 @@ class Eulogger(object):
                                      will attempt to create a handler that writes to this file as well.
         :param use_global_log_files: boolean, will query the parent logger for any file handlers and will attemp to
                                      create a handler for this child logger using the same file
+        :param async_file_logging: boolean, write log files through the shared background writer (see
+                                   Async_Log_Writer). Defaults to Eulogger.async_file_logging
 
         #Debug for init...
         print ( "-----------------------------------------------" \
@@ -93,6 +298,9 @@ class Eulogger(object):
         """
         self.logfile = os.path.join(logfile)
         self.clear_file = clear_file
+        if async_file_logging is None:
+            async_file_logging = self.async_file_logging
+        self.async_file_logging = async_file_logging
 
         #Create of fetch existing logger of name 'logger_name
         self.parent_logger_name = parent_logger_name
@@ -150,7 +358,10 @@ class Eulogger(object):
             if make_log_file_global:
                 self.add_muted_file_handler_to_parent_logger(self.logfile,self.logfile_level)
         for fileinfo in self.file_info_list:
-            file_hdlr = logging.FileHandler(fileinfo.filepath)
+            if self.async_file_logging:
+                file_hdlr = Queued_File_Handler(fileinfo.filepath)
+            else:
+                file_hdlr = logging.FileHandler(fileinfo.filepath)
             file_hdlr.setFormatter(self.file_format)
             file_hdlr.setLevel(fileinfo.level)
             #Add filter so only log records from this child logger are handled
@@ -159,9 +370,11 @@ class Eulogger(object):
             if file_hdlr not in self.log.handlers:
                 add = True
                 for h in self.log.handlers:
-                    if h.stream.name == file_hdlr.stream.name:
+                    if self.get_handler_filepath(h) == self.get_handler_filepath(file_hdlr):
                         add = False
-                        self.log.debug('File already has log handler:' + str(logfile.filepath))
+                        self.log.debug('File already has log handler:' + str(fileinfo.filepath))
+                        if not self.async_file_logging:
+                            file_hdlr.close()
                         break
                 if add:
                     self.log.addHandler(file_hdlr)
@@ -169,15 +382,28 @@ class Eulogger(object):
                 print "Not adding logfile handler for this eulogger:" +str(self.identifier)
 
     def add_muted_file_handler_to_parent_logger(self,filepath, level):
-        file_handler = logging.FileHandler(filepath)
+        if self.async_file_logging:
+            #Queued handlers only record the path here, no file is opened for the parent
+            file_handler = Queued_File_Handler(filepath)
+        else:
+            file_handler = logging.FileHandler(filepath)
         file_handler.setLevel(level)
         file_handler.addFilter(Mute_Filter())
 
+    @staticmethod
+    def get_handler_filepath(handler):
+        if isinstance(handler, Queued_File_Handler):
+            return handler.filepath
+        if isinstance(handler, logging.FileHandler):
+            return os.path.abspath(handler.stream.name)
+        return None
+
     def get_parent_logger_files(self):
         files = []
         for h in self.parent_logger.handlers:
-            if isinstance(h, logging.FileHandler):
-                files.append(File_Handler_Info(h.stream.name, h.level))
+            filepath = self.get_handler_filepath(h)
+            if filepath:
+                files.append(File_Handler_Info(filepath, h.level))
         return files
 
     def getChild(self, logger, suffix):
@@ -209,6 +435,18 @@ class Allow_Logger_By_Name(logging.Filter):
     def filter(self, record):
         return record.name == self.name
 
+class Allow_By_Thread(logging.Filter):
+    """
+    Only messages logged from the thread with the given ident are allowed through. Used to isolate the log
+    output of work running concurrently under the same loggers, ie: parallel test units.
+    """
+    def __init__(self, thread_ident, name=""):
+        logging.Filter.__init__(self, name)
+        self.thread_ident = thread_ident
+
+    def filter(self, record):
+        return record.thread == self.thread_ident
+
 class Mute_Filter(logging.Filter):
     def filter(self, record):
         return False
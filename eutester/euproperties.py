@@ -70,11 +70,16 @@ cat my_cloud.conf
         storage_properties = ep_mgr.get_properties(service_type='storage')
         partition1_properties = ep_mgr.get_properties(partition='partition1')
 
+    #Set multiple properties with a single remote command...
+        ep_mgr.set_properties({'PARTI00.storage.sanhost': '192.168.1.200',
+                               'walrus.storagemaxbucketsizeinmb': '5120'})
+
 '''
 
 import types
 import re
 import copy
+import time
 
 
 class Euproperty_Type():
@@ -123,9 +128,7 @@ class Euproperty():
         self.description = description
 
     def update(self):
-        newprop = self.prop_mgr.update_property_list(
-            property_name=self.property_string)[0]
-        self = newprop
+        self.prop_mgr.refresh_property(self)
 
     def get(self):
         return self.value
@@ -184,7 +187,11 @@ class Euproperty_Manager():
     debugmethod = None
 
     def __init__(self, tester, verbose=False, machine=None,
-                 service_url=None, debugmethod=None):
+                 service_url=None, debugmethod=None, cache_ttl=None):
+        '''
+        :param cache_ttl: seconds the property list is cached before a full
+                          refresh on the next lookup. None never expires.
+        '''
         self.tester = tester
         self.debugmethod = debugmethod or tester.debug
         self.verbose = verbose
@@ -197,6 +204,12 @@ class Euproperty_Manager():
         self.cmdpath = self.tester.eucapath+'/usr/sbin/'
         self.properties = []
         self.property_map = Property_Map()
+        self.cache_ttl = cache_ttl
+        self.last_updated = None
+        self._index_by_string = {}
+        self._index_by_name = {}
+        self._index_by_service = {}
+        self._index_by_partition = {}
         self.update_property_list()
         self.tester.property_manager = self
         self.zones = self.tester.get_zones()
@@ -365,15 +378,21 @@ class Euproperty_Manager():
                    ", value:" + str(value) + ", force_update:" +
                    str(force_update))
         ret_props = []
-        if not self.properties or force_update:
+        if not self.properties or force_update or self.is_cache_expired():
             self.update_property_list()
-        properties = copy.copy(self.properties)
-        if partition and properties:
-            properties = self.get_all_properties_for_partition(partition,
-                                                               list=properties)
-        if service_type and properties:
-            properties = self.get_all_properties_for_service(service_type,
-                                                             list=properties)
+        #Start with the smallest indexed list, then filter by the remaining attrs
+        candidates = [self.properties]
+        if partition:
+            candidates.append(self._index_by_partition.get(partition, []))
+        if service_type:
+            candidates.append(self._index_by_service.get(service_type, []))
+        properties = []
+        for prop in min(candidates, key=len):
+            if partition and prop.partition != partition:
+                continue
+            if service_type and prop.service_type != service_type:
+                continue
+            properties.append(prop)
         if search_string and properties:
             properties = self.get_all_properties_by_search_string(
                 search_string, list=properties)
@@ -387,15 +406,71 @@ class Euproperty_Manager():
         return ret_props
 
     def get_property(self, name, service_type, partition, force_update=False):
+        '''
+        Returns the property matching name, service_type and partition. If
+        force_update is set only this property is refreshed from the cloud.
+        '''
         self.debug('Get Property:' + str(name))
         ret_prop = None
-        list = self.get_properties(partition=partition,
-                                   service_type=service_type,
-                                   force_update=force_update)
-        if list:
-            ret_prop = self.get_euproperty_by_name(name, list=list)
+        if not self.properties or self.is_cache_expired():
+            self.update_property_list()
+        for prop in self._index_by_name.get(name, []):
+            if prop.service_type == service_type and \
+                    prop.partition == partition:
+                ret_prop = prop
+                break
+        if ret_prop is None:
+            #Cache miss, this may be a new property so refresh the whole list
+            list = self.get_properties(partition=partition,
+                                       service_type=service_type,
+                                       force_update=True)
+            if list:
+                ret_prop = self.get_euproperty_by_name(name, list=list)
+        elif force_update:
+            self.refresh_property(ret_prop)
         return ret_prop
 
+    def is_cache_expired(self):
+        '''
+        Returns True if cache_ttl is set and the property list is older
+        than cache_ttl seconds
+        '''
+        if self.cache_ttl is None or self.last_updated is None:
+            return False
+        return (time.time() - self.last_updated) > self.cache_ttl
+
+    def refresh_property(self, property):
+        '''
+        Refresh a single property from the cloud without re-fetching the
+        entire property list.
+        property - mandatory - Euproperty or property string to refresh
+        Returns the updated Euproperty
+        '''
+        if isinstance(property, Euproperty):
+            property_string = property.property_string
+        else:
+            property_string = str(property)
+        for prop in self.update_property_list(property_name=property_string):
+            if prop.property_string == property_string:
+                return prop
+        raise EupropertyNotFoundException('Property not found by string:' +
+                                          str(property_string))
+
+    def _index_property(self, prop):
+        self._index_by_string[prop.property_string] = prop
+        self._index_by_name.setdefault(prop.name, []).append(prop)
+        self._index_by_service.setdefault(prop.service_type, []).append(prop)
+        self._index_by_partition.setdefault(prop.partition, []).append(prop)
+
+    def _rebuild_property_indexes(self):
+        self._index_by_string = {}
+        self._index_by_name = {}
+        self._index_by_service = {}
+        self._index_by_partition = {}
+        for prop in self.properties:
+            if prop:
+                self._index_property(prop)
+
     def update_property_list(self, property_name=''):
         newlist = []
         newprop = None
@@ -423,18 +498,22 @@ class Euproperty_Manager():
             if newprop and not newprop in newlist:
                 newlist.append(newprop)
         if property_name:
+            #Existing properties were updated in place while parsing,
+            # add any properties which are new to the list
             for newprop in newlist:
-                if newprop:
-                    for oldprop in self.properties:
-                        if oldprop.property_string == newprop.property_string:
-                            oldprop = newprop
-                            self.create_dynamic_property_map_from_property(newprop)
+                if newprop and newprop.property_string not in \
+                        self._index_by_string:
+                    self.properties.append(newprop)
+                    self._index_property(newprop)
+                    self.create_dynamic_property_map_from_property(newprop)
         else:
             self.properties = newlist
             self.property_map = Property_Map()
             for prop in self.properties:
                 if prop:
                     self.create_dynamic_property_map_from_property(prop)
+            self._rebuild_property_indexes()
+            self.last_updated = time.time()
         return newlist
 
     def parse_euproperty_description(self, propstring):
@@ -466,12 +545,12 @@ class Euproperty_Manager():
         #get the property string, example: "walrus.storagemaxbucketsizeinmb"
         property_string = splitstring.pop(0)
         ret_value = " ".join(splitstring)
-        for prop in self.properties:
-            #if this property is in our list, update the value and return
-            if prop.property_string == property_string:
-                prop.lastvalue = prop.value
-                prop.value = ret_value
-                return prop
+        #if this property is in our list, update the value and return
+        prop = self._index_by_string.get(property_string)
+        if prop:
+            prop.lastvalue = prop.value
+            prop.value = ret_value
+            return prop
         ret_name = property_string
         #...otherwise this property is not in our list yet,
         # create a new property
@@ -534,6 +613,8 @@ class Euproperty_Manager():
 
     def get_euproperty_by_name(self, name, list=None):
         props = []
+        if list is None and self._index_by_name.get(name):
+            return self._index_by_name[name][0]
         list = list or self.properties
         for property in list:
             if property.name == name:
@@ -547,7 +628,7 @@ class Euproperty_Manager():
                                          verbose=False):
         self.debug('Get all properties for partition:' + str(partition))
         props = []
-        list = list or self.properties
+        list = list or self._index_by_partition.get(partition, [])
         for property in list:
             if property.partition == partition:
                 if verbose:
@@ -560,7 +641,7 @@ class Euproperty_Manager():
 
     def get_all_properties_for_service(self, service, list=None):
         props = []
-        list = list or self.properties
+        list = list or self._index_by_service.get(service, [])
         for property in list:
             if property.service_type == service:
                 props.append(property)
@@ -640,12 +721,62 @@ class Euproperty_Manager():
         return ret_value
 
     def get_property_by_string(self, property_string):
-        property = None
-        for prop in self.properties:
-            if prop.property_string == property_string:
+        return self._index_by_string.get(property_string)
+
+    def set_properties(self, prop_values):
+        '''
+        Sets many properties using a single remote command on the
+        work_machine instead of one command per property.
+        Returns dict of property string to new value
+        prop_values - mandatory - dict (or list of tuples) of Euproperty or
+                      property string to value
+        '''
+        if isinstance(prop_values, dict):
+            prop_values = prop_values.items()
+        properties = {}
+        cmds = []
+        for property, value in prop_values:
+            if not isinstance(property, Euproperty):
+                prop = self.get_property_by_string(str(property))
+                if not prop:
+                    raise EupropertyNotFoundException(
+                        'Could not fetch property to set. Using string:' +
+                        str(property))
                 property = prop
-                break
-        return property
+            value = str(value)
+            property.lastvalue = property.value
+            properties[property.property_string] = (property, value)
+            cmds.append(self.cmdpath + 'euca-modify-property -U ' +
+                        str(self.service_url) + ' -I ' +
+                        str(self.access_key) + ' -S ' +
+                        str(self.secret_key) + ' -p ' +
+                        str(property.property_string) + '=' + str(value))
+        if not cmds:
+            return {}
+        self.debug('Setting ' + str(len(cmds)) + ' properties:' +
+                   ", ".join(properties.keys()))
+        output = self.work_machine.sys("; ".join(cmds))
+        ret_values = {}
+        for line in output:
+            line = line.strip()
+            if re.search('^PROPERTY', line):
+                split = line.split()
+                if len(split) > 2:
+                    ret_values[split[1]] = split[2]
+        errors = ""
+        for property_string, (property, value) in properties.iteritems():
+            ret_value = ret_values.get(property_string)
+            if ret_value is None or ((ret_value != value) and
+                                     not (not value and ret_value == '{}')):
+                errors += "set property(" + property_string + \
+                          ") to value(" + value + ") failed. Ret Value (" + \
+                          str(ret_value) + ")\n"
+            if ret_value is not None:
+                property.value = ret_value
+        if errors:
+            raise EupropertiesException(
+                errors + "Ret String\n" + "\n".join(str(x) for x in output))
+        return ret_values
 
     def set_property_value_by_string(self, property_string, value):
         property = self.get_property_by_string(property_string)
@@ -81,8 +81,16 @@ class EuSnapshot(Snapshot, TaggedResource):
         newsnap.update()
         return newsnap
     
-    def update(self):
-        super(EuSnapshot, self).update()
+    def update(self, updated_snapshot=None):
+        '''
+        :param updated_snapshot: optional boto snapshot from an existing describe of this snapshot id. If
+                                 provided this snapshot is updated from it instead of issuing a new describe
+                                 request. See EC2ops.update_eusnapshots()
+        '''
+        if updated_snapshot is None:
+            super(EuSnapshot, self).update()
+        else:
+            self._update(updated_snapshot)
         self.set_last_status()
     
     def set_last_status(self,status=None):
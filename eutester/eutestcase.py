@@ -11,11 +11,15 @@ import types
 import traceback
 import random
 import string
-from eutester.eulogger import Eulogger
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from eutester.eulogger import Eulogger, Allow_By_Thread
 from eutester.euconfig import EuConfig
 import StringIO
 import copy
-from eutester.timer import Timer
+from eutester.timer import metrics
 import uuid
 
 '''
@@ -174,6 +178,10 @@ class EutesterTestUnit():
     
     type eof: boolean
     param eof: boolean to indicate whether a failure while running the given 'method' should end the test case exectution. 
+
+    type independent: boolean
+    param independent: boolean to indicate this unit does not depend on, or alter state used by, neighboring units
+                       and may be run concurrently with them when run_test_case_list is run with parallel=True
     '''
     def __init__(self,method, *args, **kwargs):
         self.method = method
@@ -195,6 +203,8 @@ class EutesterTestUnit():
             self.error_anchor_id = "ERROR_" + self.anchor_id
         self.description=self.get_test_method_description()
         self.eof=False
+        self.independent = False
+        self.logfile = None
         self.error = ""
         print "Creating testunit:" + str(self.name)+", args:"
         for count, thing in enumerate(args):
@@ -305,6 +315,7 @@ class EutesterTestUnit():
             else:
                 pass
         finally:
+            metrics.record('testunit.' + str(self.name), time.time() - start)
             self.time_to_run = int(time.time()-start)
         
                 
@@ -630,6 +641,10 @@ class EutesterTestCase(unittest.TestCase):
         
         :type autoarg: boolean
         :param autoarg: Boolean to indicate whether to autopopulate this testunit with values from global testcase.args
+
+        :type independent: boolean
+        :param independent: Boolean to indicate this testunit may be run concurrently with neighboring
+                            independent testunits. See run_test_case_list(parallel=True)
         
         :type args: list of positional arguments
         :param args: the positional arguments to be fed to the given testunit 'method'
@@ -642,6 +657,7 @@ class EutesterTestCase(unittest.TestCase):
         '''   
         eof=False
         autoarg=True
+        independent=False
         methvars = self.get_meth_arg_names(method)
         #Pull out value relative to this method, leave in any that are intended to be passed through
         if 'autoarg' in kwargs:
@@ -654,12 +670,18 @@ class EutesterTestCase(unittest.TestCase):
                 eof = kwargs['eof']
             else:
                 eof = kwargs.pop('eof')
+        if 'independent' in kwargs:
+            if 'independent' in methvars:
+                independent = kwargs['independent']
+            else:
+                independent = kwargs.pop('independent')
         ## Only pass the arg if we need it otherwise it will print with all methods/testunits
         if self.args.html_anchors:
             testunit = EutesterTestUnit(method, *args, html_anchors=self.args.html_anchors ,**kwargs)
         else:
             testunit = EutesterTestUnit(method, *args, **kwargs)
         testunit.eof = eof
+        testunit.independent = independent
         #if autoarg, auto populate testunit arguements from local testcase.args namespace values
         if autoarg:
             self.populate_testunit_with_args(testunit)
@@ -764,7 +786,8 @@ class EutesterTestCase(unittest.TestCase):
             buf += "---------------------\n"
         return buf
     
-    def run_test_case_list(self, list, eof=False, clean_on_exit=True, printresults=True):
+    def run_test_case_list(self, list, eof=False, clean_on_exit=True, printresults=True, parallel=False,
+                           worker_threads=4, unit_log_dir=None, metrics_file=None):
         '''
         Desscription: wrapper to execute a list of ebsTestCase objects
         
@@ -780,23 +803,52 @@ class EutesterTestCase(unittest.TestCase):
         
         :type printresults: boolean
         :param printresults: Flag to indicate whether or not to print a summary of results upon run_test_case_list completion. 
+
+        :type parallel: boolean
+        :param parallel: Flag to run consecutive testunits marked 'independent' concurrently. Units not marked
+                         independent still run alone, in list order, after all units before them have completed.
+
+        :type worker_threads: integer
+        :param worker_threads: max number of independent testunits run at once when parallel is set
+
+        :type unit_log_dir: string
+        :param unit_log_dir: local dir to write each concurrently run testunit's log to. Defaults to a new temp dir.
+
+        :type metrics_file: string
+        :param metrics_file: local path to export the operation timing metrics (see eutester.timer.Metrics)
+                             collected during the run to as json. Defaults to /tmp/eutester_metrics_<uuid>.json
         
         :rtype: integer
         :returns: integer exit code to represent pass/fail of the list executed. 
         '''
         self.testlist = list 
+        self.testlist_elapsed = None
         start = time.time()
         tests_ran=0
         test_count = len(list)
-        t = Timer("/tmp/eutester_" + str(uuid.uuid4()).replace("-", ""))
+        metrics_file = metrics_file or "/tmp/eutester_metrics_" + str(uuid.uuid4()).replace("-", "") + ".json"
+        if parallel and not unit_log_dir:
+            unit_log_dir = tempfile.mkdtemp(prefix='eutester_unit_logs_')
         try:
-            for test in list:
+            index = 0
+            while index < test_count:
+                test = list[index]
+                if parallel and test.independent:
+                    #Gather this and any following independent units into a single concurrent batch
+                    batch = []
+                    while index < test_count and list[index].independent:
+                        batch.append(list[index])
+                        index += 1
+                    tests_ran += len(batch)
+                    self.run_test_units_concurrently(batch, eof=eof, worker_threads=worker_threads,
+                                                     unit_log_dir=unit_log_dir)
+                    self.debug(self.print_test_list_short_stats(list))
+                    continue
+                index += 1
                 tests_ran += 1
                 self.print_test_unit_startmsg(test)
                 try:
-                    id = t.start()
                     test.run(eof=eof or test.eof)
-                    t.end(id, str(test.name))
                 except Exception, e:
                     self.debug('Testcase:'+ str(test.name)+' error:'+str(e))
                     if eof or (not eof and test.eof):
@@ -810,9 +862,16 @@ class EutesterTestCase(unittest.TestCase):
                         
         finally:
             elapsed = int(time.time()-start)
+            if parallel:
+                self.testlist_elapsed = elapsed
             msgout =  "RUN TEST CASE LIST DONE:\n"
             msgout += "Ran "+str(tests_ran)+"/"+str(test_count)+" tests in "+str(elapsed)+" seconds\n"
-            t.finish()
+            try:
+                metrics.export_json(metrics_file)
+                self.debug("Operation timing metrics:\n" + str(metrics.show_stats(printme=False)) +
+                           "\nExported to:" + str(metrics_file), linebyline=False)
+            except Exception, me:
+                self.debug("Failed to export timing metrics to:" + str(metrics_file) + ", err:" + str(me))
 
             if printresults:
                 try:
@@ -855,6 +914,66 @@ class EutesterTestCase(unittest.TestCase):
             else:
                 return(0)
 
+    def run_test_units_concurrently(self, units, eof=False, worker_threads=4, unit_log_dir=None):
+        '''
+        Description: Runs a list of independent EutesterTestUnits across a bounded pool of worker threads.
+        Each unit's log output is isolated to its own file in unit_log_dir, recorded in testunit.logfile,
+        and is replayed to the testcase debug log as a single block once the unit completes.
+        If any failing unit has eof set (or eof is set), the first such error is raised after all
+        units in the batch have completed.
+
+        :type units: list
+        :param units: list of EutesterTestUnit objects to be run
+
+        :type eof: boolean
+        :param eof: Flag to indicate a failure in any unit should end the test list
+
+        :type worker_threads: integer
+        :param worker_threads: max number of units to run at once
+
+        :type unit_log_dir: string
+        :param unit_log_dir: local dir to write each unit's log file to
+        '''
+        unit_log_dir = unit_log_dir or tempfile.mkdtemp(prefix='eutester_unit_logs_')
+        parent_logger = logging.getLogger('eutester')
+
+        def run_unit(test):
+            test.logfile = os.path.join(unit_log_dir, str(test.name) + "_" +
+                                        str(uuid.uuid4()).replace("-", "")[0:8] + ".log")
+            handler = logging.FileHandler(test.logfile)
+            handler.setFormatter(logging.Formatter('[%(asctime)s] [%(levelname)s]: %(message)s'))
+            handler.addFilter(Allow_By_Thread(threading.current_thread().ident))
+            parent_logger.addHandler(handler)
+            try:
+                self.print_test_unit_startmsg(test)
+                test.run(eof=eof or test.eof)
+            finally:
+                parent_logger.removeHandler(handler)
+                handler.close()
+
+        self.status("Running " + str(len(units)) + " independent testunits, worker_threads:" +
+                    str(worker_threads) + ", unit logs in:" + str(unit_log_dir))
+        errors = []
+        with ThreadPoolExecutor(max_workers=max(1, min(worker_threads, len(units)))) as executor:
+            futures = [(test, executor.submit(run_unit, test)) for test in units]
+        for test, future in futures:
+            try:
+                with open(test.logfile) as unit_log:
+                    self.debug("TESTUNIT LOG FOR: " + str(test.name) + " (" + str(test.logfile) + ")\n" +
+                               unit_log.read(), linebyline=False)
+            except Exception, le:
+                self.debug('Could not read log for testunit:' + str(test.name) + ', err:' + str(le))
+            error = future.exception()
+            if error or test.result == EutesterTestResult.failed:
+                self.endfailure(str(test.name))
+                if error:
+                    self.debug('Testcase:' + str(test.name) + ' error:' + str(error))
+                    errors.append(error)
+            else:
+                self.endtestunit(str(test.name))
+        if errors:
+            raise errors[0]
+
     def print_test_unit_startmsg(self,test):
         startbuf = ''
         if self.args.html_anchors:
@@ -973,6 +1092,8 @@ class EutesterTestCase(unittest.TestCase):
             test_summary_line = str(" ").ljust(20) + str("| RESULT: " + str(testunit.result)).ljust(20) + "\n" +\
                                 str(" ").ljust(20) + "| TEST NAME: " + str(testunit.name) + "\n" + \
                                 str(" ").ljust(20) + str("| TIME : " + str(testunit.time_to_run))
+            if testunit.logfile:
+                test_summary_line += "\n" + str(" ").ljust(20) + "| LOG: " + str(testunit.logfile)
 
 
             buf += pmethod(str(test_summary_line),printout=False)
@@ -994,6 +1115,11 @@ class EutesterTestCase(unittest.TestCase):
         buf += self.resultdefault("\n"+ self.getline(80)+"\n", printout=False)
         buf += str(self.print_test_list_short_stats(list))
         buf += "\n"
+        #Show how much wall clock time running independent units in parallel saved
+        if getattr(self, 'testlist_elapsed', None) is not None:
+            unit_time = sum([testunit.time_to_run for testunit in list])
+            buf += "SERIAL UNIT TIME: " + str(unit_time) + "s, WALL TIME: " + str(self.testlist_elapsed) + \
+                   "s, SPEEDUP: " + "{0:.2f}".format(float(unit_time) / (self.testlist_elapsed or 1)) + "x\n"
         if printout:
             printmethod(buf)
         else:
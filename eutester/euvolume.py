@@ -80,9 +80,17 @@ class EuVolume(Volume, TaggedResource):
         newvol.update()
         return newvol
     
-    def update(self):
+    def update(self, updated_volume=None):
+        '''
+        :param updated_volume: optional boto volume from an existing describe of this volume id. If provided
+                               this volume is updated from it instead of issuing a new describe request.
+                               See EC2ops.update_euvolumes()
+        '''
         try:
-            super(EuVolume, self).update()
+            if updated_volume is None:
+                super(EuVolume, self).update()
+            else:
+                self._update(updated_volume)
         except EC2ResponseError as ER:
             if ER.status == 400 and ER.error_code == 'InvalidVolume.NotFound':
                 self.status = 'deleted'
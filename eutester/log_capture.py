@@ -0,0 +1,307 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2014, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+'''
+Remote log capture for Machine.
+
+LogCapture tails any number of remote files with 'tail -F', each in its own channel multiplexed over the
+machine's single ssh transport, and reads all of them from one thread. Captured lines are kept in a
+bounded LogRingBuffer per file and can optionally be spilled to local rotating files. Regex watches
+invoke a callback for each matching line as it arrives. Example:
+
+    machine.start_log('/var/log/eucalyptus/cloud-output.log')
+    machine.add_log_watch('ERROR', lambda log_file, line, match: errors.append(line))
+    ...
+    machine.save_all_logs('logs')
+    machine.log_capture.show_stats()
+'''
+import os
+import re
+import time
+import select
+import socket
+import logging
+import threading
+import logging.handlers
+from collections import deque
+from prettytable import PrettyTable
+
+
+class LogRingBuffer(object):
+    """
+    Bounded, thread safe buffer of the most recent lines of a log. Once 'max_bytes' is exceeded the oldest
+    lines are dropped. Iterating returns a snapshot of the buffered lines.
+    """
+    def __init__(self, max_bytes=1048576):
+        self.max_bytes = max_bytes
+        self.lines = deque()
+        self.size = 0
+        self.dropped_bytes = 0
+        self._lock = threading.Lock()
+
+    def append(self, line):
+        with self._lock:
+            self.lines.append(line)
+            self.size += len(line)
+            while self.size > self.max_bytes and len(self.lines) > 1:
+                dropped = self.lines.popleft()
+                self.size -= len(dropped)
+                self.dropped_bytes += len(dropped)
+
+    def clear(self):
+        with self._lock:
+            self.lines.clear()
+            self.size = 0
+
+    def __iter__(self):
+        with self._lock:
+            return iter(list(self.lines))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __str__(self):
+        return "".join(self)
+
+
+class LogCapture(object):
+    # Default max bytes kept in memory per captured log
+    buffer_max_bytes = 1048576
+    # Max bytes per local spill file before it is rotated, and number of rotated files kept
+    spill_max_bytes = 10485760
+    spill_backup_count = 5
+    # Seconds the reader thread waits in select before checking for added/removed logs
+    select_timeout = 0.5
+    recv_size = 32768
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.logs = {}
+        self.watches = {}
+        self._watch_id = 0
+        self._lock = threading.RLock()
+        self._thread = None
+
+    def debug(self, msg):
+        self.machine.debug(msg)
+
+    def start(self, log_file, max_bytes=None, spill_dir=None):
+        """
+        Start tailing 'log_file' on the remote machine. A new channel is opened on the machine's existing ssh
+        transport and handed to the shared reader thread.
+        :param log_file: remote file path
+        :param max_bytes: max bytes of recent lines kept in memory for this log
+        :param spill_dir: optional local dir, if provided every captured line is also written to a rotating
+                          local file in this dir
+        :returns: the LogRingBuffer for this log
+        """
+        with self._lock:
+            log = self.logs.get(log_file)
+            if log and log['active']:
+                return log['buffer']
+        transport = self.machine.ssh.connection.get_transport()
+        channel = transport.open_session()
+        channel.exec_command('tail -n 0 -F ' + str(log_file) + ' 2>/dev/null')
+        spill = None
+        if spill_dir:
+            if not os.path.exists(spill_dir):
+                os.makedirs(spill_dir)
+            spill = logging.handlers.RotatingFileHandler(
+                os.path.join(spill_dir, str(log_file).strip('/').replace('/', '_')),
+                maxBytes=self.spill_max_bytes, backupCount=self.spill_backup_count)
+        log = {'channel': channel,
+               'buffer': LogRingBuffer(max_bytes=max_bytes or self.buffer_max_bytes),
+               'partial': '',
+               'spill': spill,
+               'active': True,
+               'bytes': 0,
+               'lines': 0,
+               'started': time.time(),
+               'stopped': None}
+        with self._lock:
+            if log_file in self.logs:
+                #Keep lines captured by a previous run of this log
+                log['buffer'] = self.logs[log_file]['buffer']
+            self.logs[log_file] = log
+            if not self._thread:
+                self._thread = threading.Thread(target=self._reader, name='logcapture:' +
+                                                                          str(self.machine.hostname))
+                self._thread.daemon = True
+                self._thread.start()
+        self.debug("Started capturing " + str(log_file))
+        return log['buffer']
+
+    def stop(self, log_file=None):
+        """
+        Stop tailing 'log_file', or all logs if None. Buffered lines are kept.
+        """
+        with self._lock:
+            log_files = [log_file] if log_file else self.logs.keys()
+            for name in log_files:
+                log = self.logs.get(name)
+                if log and log['active']:
+                    self._close_log(name, log)
+
+    def _close_log(self, log_file, log):
+        log['active'] = False
+        log['stopped'] = time.time()
+        if log['partial']:
+            self._handle_line(log_file, log, log['partial'])
+            log['partial'] = ''
+        try:
+            log['channel'].close()
+        except Exception, e:
+            self.debug('Error closing log channel for ' + str(log_file) + ': ' + str(e))
+        if log['spill']:
+            log['spill'].close()
+
+    def _reader(self):
+        while True:
+            with self._lock:
+                active = dict((log['channel'], (name, log)) for name, log in self.logs.iteritems() if log['active'])
+                if not active:
+                    self._thread = None
+                    return
+            try:
+                readable, w, x = select.select(active.keys(), [], [], self.select_timeout)
+            except (select.error, socket.error), e:
+                self.debug('Log capture select error: ' + str(e))
+                time.sleep(self.select_timeout)
+                continue
+            for channel in readable:
+                log_file, log = active[channel]
+                try:
+                    data = channel.recv(self.recv_size)
+                except Exception, e:
+                    self.debug('Error reading log ' + str(log_file) + ': ' + str(e))
+                    data = ''
+                with self._lock:
+                    if not log['active']:
+                        continue
+                    if not data:
+                        self.debug('Log channel for ' + str(log_file) + ' closed by remote')
+                        self._close_log(log_file, log)
+                        continue
+                    log['bytes'] += len(data)
+                    lines = (log['partial'] + data).split('\n')
+                    log['partial'] = lines.pop()
+                for line in lines:
+                    self._handle_line(log_file, log, line + '\n')
+
+    def _handle_line(self, log_file, log, line):
+        log['lines'] += 1
+        log['buffer'].append(line)
+        if log['spill']:
+            log['spill'].emit(logging.makeLogRecord({'msg': line.rstrip('\n')}))
+        for watch_id, watch in self.watches.items():
+            if watch['log_file'] and watch['log_file'] != log_file:
+                continue
+            match = watch['regex'].search(line)
+            if match:
+                watch['matches'] += 1
+                try:
+                    watch['callback'](log_file, line, match)
+                except Exception, e:
+                    self.debug('Error in log watch callback for "' + str(watch['regex'].pattern) + '": ' + str(e))
+
+    def add_watch(self, regex, callback, log_file=None):
+        """
+        Calls callback(log_file, line, match) for every captured line matching 'regex'. Callbacks run on
+        the reader thread so should return quickly.
+        :param regex: regex string or compiled pattern
+        :param log_file: only match lines from this log, None matches all captured logs
+        :returns: watch id used with remove_watch()
+        """
+        if isinstance(regex, basestring):
+            regex = re.compile(regex)
+        with self._lock:
+            self._watch_id += 1
+            self.watches[self._watch_id] = {'regex': regex, 'callback': callback,
+                                             'log_file': log_file, 'matches': 0}
+            return self._watch_id
+
+    def remove_watch(self, watch_id):
+        with self._lock:
+            self.watches.pop(watch_id, None)
+
+    def wait_for_match(self, regex, log_file=None, timeout=60):
+        """
+        Blocks until a line matching 'regex' is captured or timeout seconds have passed.
+        Only lines captured after this call are matched.
+        :returns: the matching line, or None on timeout
+        """
+        found = []
+        event = threading.Event()
+        def callback(name, line, match):
+            found.append(line)
+            event.set()
+        watch_id = self.add_watch(regex, callback, log_file=log_file)
+        try:
+            event.wait(timeout)
+        finally:
+            self.remove_watch(watch_id)
+        if found:
+            return found[0]
+        return None
+
+    def get_buffer(self, log_file):
+        log = self.logs.get(log_file)
+        if log:
+            return log['buffer']
+        return None
+
+    def get_stats(self):
+        """
+        Returns dict per log of: active, bytes, lines, buffered, dropped, elapsed and bytes_per_sec
+        """
+        stats = {}
+        with self._lock:
+            for log_file, log in self.logs.iteritems():
+                elapsed = (log['stopped'] or time.time()) - log['started']
+                stats[log_file] = {'active': log['active'],
+                                   'bytes': log['bytes'],
+                                   'lines': log['lines'],
+                                   'buffered': log['buffer'].size,
+                                   'dropped': log['buffer'].dropped_bytes,
+                                   'elapsed': elapsed,
+                                   'bytes_per_sec': log['bytes'] / (elapsed or 1)}
+        return stats
+
+    def show_stats(self, printmethod=None, printme=True):
+        pt = PrettyTable(['LOG', 'ACTIVE', 'BYTES', 'LINES', 'BUFFERED', 'DROPPED', 'ELAPSED', 'BYTES/SEC'])
+        pt.align['LOG'] = 'l'
+        stats = self.get_stats()
+        for log_file in sorted(stats):
+            log = stats[log_file]
+            pt.add_row([log_file, log['active'], log['bytes'], log['lines'], log['buffered'], log['dropped'],
+                        "{0:.1f}".format(log['elapsed']), "{0:.1f}".format(log['bytes_per_sec'])])
+        if not printme:
+            return pt
+        printmethod = printmethod or self.debug
+        printmethod("\n" + str(pt) + "\n")
@@ -29,8 +29,6 @@
 # POSSIBILITY OF SUCH DAMAGE.
 #
 # Author: vic.iglesias@eucalyptus.com
-import select
-import threading
 import time
 import eulogger
 from eutester import Eutester
@@ -41,6 +39,7 @@ import os
 import sys
 import tempfile
 from repoutils import RepoUtils
+from log_capture import LogCapture
 
 class DistroName:
     ubuntu = "ubuntu"
@@ -99,6 +98,7 @@ class Machine:
                  ssh_proxy_username=None,
                  ssh_proxy_password=None,
                  ssh_proxy_keypath=None,
+                 use_ssh_pool=None,
                  verbose = True ):
         
         self.hostname = hostname
@@ -114,14 +114,15 @@ class Machine:
         self.ssh_proxy_username=ssh_proxy_username
         self.ssh_proxy_password=ssh_proxy_password
         self.ssh_proxy_keypath=ssh_proxy_keypath
+        self.use_ssh_pool = use_ssh_pool
         self.timeout = timeout
         self.retry = retry
         self.debugmethod = debugmethod
         self.verbose = verbose
         self._distroname = distro
-        self.log_threads = {}
+        self.log_capture = LogCapture(self)
+        #Maps log file to its LogRingBuffer of captured lines, see start_log()
         self.log_buffers = {}
-        self.log_active = {}
         self.wget_last_status = 0
         if self.debugmethod is None:
             logger = eulogger.Eulogger(identifier= str(hostname) + ":" + str(components))
@@ -195,6 +196,7 @@ class Machine:
                     proxy_username=self.ssh_proxy_username,
                     proxy_password=self.ssh_proxy_password,
                     proxy_keypath=self.ssh_proxy_keypath,
+                    use_pool=self.use_ssh_pool,
                     verbose=True)
         return self._ssh
 
@@ -776,33 +778,47 @@ class Machine:
         return size/unit
     
     def poll_log(self, log_file="/var/log/messages"):
-        self.debug( "Starting to poll " + log_file )     
-        self.log_channel = self.ssh.connection.invoke_shell()
-        self.log_channel.send("tail -f " + log_file + " \n")
-        ### Begin polling channel for any new data
-        while self.log_active[log_file]:
-            ### CLOUD LOG
-            rl, wl, xl = select.select([self.log_channel],[],[],0.0)
-            if len(rl) > 0:
-                self.log_buffers[log_file] += self.log_channel.recv(1024)
-            time.sleep(1)
+        """Returns the lines captured so far for log_file as a string, see start_log()"""
+        return str(self.log_buffers.get(log_file, ""))
     
-    def start_log(self, log_file="/var/log/messages"):
-        """Start thread to poll logs"""
-        thread = threading.Thread(target=self.poll_log, args=log_file)
-        thread.daemon = True
-        self.log_threads[log_file]= thread.start()
-        self.log_active[log_file] = True
+    def start_log(self, log_file="/var/log/messages", max_bytes=None, spill_dir=None):
+        """
+        Start capturing new lines written to log_file. All logs on this machine are tailed over the
+        machine's ssh transport and read by a single thread, see eutester.log_capture.LogCapture
+        log_file - optional -string, remote log file path
+        max_bytes - optional -integer, max bytes of recent lines kept in memory for this log
+        spill_dir - optional -string, local dir to also write all captured lines to in rotating files
+        """
+        self.log_buffers[log_file] = self.log_capture.start(log_file, max_bytes=max_bytes, spill_dir=spill_dir)
+        return self.log_buffers[log_file]
         
     def stop_log(self, log_file="/var/log/messages"):
-        """Terminate thread that is polling logs"""
-        self.log_active[log_file] = False
+        """Stop capturing log_file, lines captured so far are kept in log_buffers"""
+        self.log_capture.stop(log_file)
+
+    def add_log_watch(self, regex, callback, log_file=None):
+        """
+        Calls callback(log_file, line, match) for every newly captured line matching regex.
+        log_file - optional -string, only watch this log, defaults to all captured logs
+        Returns the watch id to be used with remove_log_watch()
+        """
+        return self.log_capture.add_watch(regex, callback, log_file=log_file)
+
+    def remove_log_watch(self, watch_id):
+        self.log_capture.remove_watch(watch_id)
+
+    def wait_for_log(self, regex, log_file=None, timeout=60):
+        """
+        Waits for a line matching regex to be written to a captured log.
+        Returns the matching line, or None if timeout seconds pass first.
+        """
+        return self.log_capture.wait_for_match(regex, log_file=log_file, timeout=timeout)
         
     def save_log(self, log_file, path="logs"):
         """Save log buffer for log_file to the path to a file"""
         if not os.path.exists(path):
             os.mkdir(path)
-        FILE = open( path + '/' + log_file,"w")
+        FILE = open( path + '/' + log_file.strip('/').replace('/', '_'),"w")
         FILE.writelines(self.log_buffers[log_file])
         FILE.close()
         
@@ -13,6 +13,7 @@ from eutester import WaitForResultException
 from eutester.sshconnection import SshConnection
 from eutester.euinstance import EuInstance
 from eutester.eulogger import Eulogger
+from eutester.sec_group_rules import CompiledRuleSet
 from boto.ec2.group import Group as BotoGroup
 from boto.ec2.instance import Instance
 from boto.ec2.securitygroup import SecurityGroup,IPPermissions
@@ -61,9 +62,16 @@ class Midget(object):
     '''
     _CHAIN_JUMP = 107
     _ADDR_SPACING = 16
+    # Seconds topology fetched from the midonet api is cached and indexed for, 0 disables the cache.
+    # See get_topology()
+    topology_ttl = 15
+    # Seconds chain rules and ip address groups are cached for. These change with security group rules and
+    # membership and are what rule checks verify, so by default they are always fetched from the api.
+    rule_cache_ttl = 0
 
     def __init__(self, midonet_api_host, midonet_api_port='8080', midonet_username=None,
-                 midonet_password=None, eutester_config=None, eutester_password=None, tester=None):
+                 midonet_password=None, eutester_config=None, eutester_password=None, tester=None,
+                 topology_ttl=None):
         self.midonet_api_host = midonet_api_host
         self.midonet_api_port = midonet_api_port
         self.midonet_username = midonet_username
@@ -79,10 +87,109 @@ class Midget(object):
         self.default_indent = ""
         self._euca_instances = {}
         self._protocols = {}
+        if topology_ttl is not None:
+            self.topology_ttl = topology_ttl
+        self._topology = {}
+        self.topology_stats = {}
 
     def debug(self, msg):
         self.logger.log.debug(msg)
 
+    def get_topology(self, kind, key, fetch, ttl=None):
+        """
+        Returns the topology item 'kind' (ie: 'routers', 'chain_rules', 'port') for 'key', calling fetch()
+        to get it from the midonet api if it is not cached or older than 'ttl' (defaults to topology_ttl).
+        Each kind and key is cached and refreshed independently.
+        """
+        if ttl is None:
+            ttl = self.topology_ttl
+        stats = self.topology_stats.setdefault(kind, {'calls': 0, 'saved': 0})
+        if ttl:
+            entry = self._topology.get(kind, {}).get(key)
+            if entry and (time.time() - entry[0]) < ttl:
+                stats['saved'] += 1
+                return entry[1]
+        value = fetch()
+        stats['calls'] += 1
+        #Only found items are cached, a missing item may be created at any time
+        if ttl and value is not None:
+            self._topology.setdefault(kind, {})[key] = (time.time(), value)
+        return value
+
+    def invalidate_topology(self, kind=None):
+        """
+        Drops the cached topology for 'kind', or all cached topology if kind is None
+        """
+        if kind:
+            self._topology.pop(kind, None)
+        else:
+            self._topology = {}
+
+    def invalidate_rules(self):
+        """
+        Drops cached chain rules, ip address groups and compiled chains, see rule_cache_ttl. Called by the
+        rule verification methods so they always check the backend's current rules.
+        """
+        for kind in ['chain_rules', 'ip_addr_group', 'compiled_chain']:
+            self.invalidate_topology(kind)
+
+    def _index_resources(self, resources):
+        index = {'list': resources, 'by_id': {}, 'by_name': {}}
+        for resource in resources:
+            index['by_id'][str(resource.get_id()).strip()] = resource
+            index['by_name'][str(resource.get_name()).strip()] = resource
+        return index
+
+    def _lookup_index(self, kind, get_index, field, key):
+        """
+        Returns the resource for 'key' from the 'by_id' or 'by_name' 'field' of a cached index. On a miss the
+        index 'kind' is dropped and fetched once more, as the resource may have been created since it was cached.
+        """
+        resource = get_index()[field].get(str(key))
+        if resource is None and self.topology_ttl:
+            self.invalidate_topology(kind)
+            resource = get_index()[field].get(str(key))
+        return resource
+
+    def _get_router_index(self):
+        return self.get_topology('routers', None,
+                                 lambda: self._index_resources(self.mapi.get_routers(query=None)))
+
+    def _get_chain_index(self):
+        return self.get_topology('chains', None,
+                                 lambda: self._index_resources(self.mapi.get_chains(query=None)))
+
+    def _get_bridge_index(self):
+        return self.get_topology('bridges', None,
+                                 lambda: self._index_resources(self.mapi.get_bridges(query=None)))
+
+    def get_port(self, port_id):
+        return self.get_topology('port', str(port_id), lambda: self.mapi.get_port(port_id))
+
+    def get_router_ports(self, router):
+        return self.get_topology('router_ports', str(router.get_id()), router.get_ports)
+
+    def get_chain_rules(self, chain):
+        return self.get_topology('chain_rules', str(chain.get_id()), chain.get_rules, ttl=self.rule_cache_ttl)
+
+    def get_ip_addr_group(self, ip_addr_grp_id):
+        return self.get_topology('ip_addr_group', str(ip_addr_grp_id),
+                                 lambda: self.mapi.get_ip_addr_group(ip_addr_grp_id), ttl=self.rule_cache_ttl)
+
+    def show_topology_stats(self, printme=True):
+        pt = PrettyTable(['KIND', 'CACHED', 'API CALLS', 'CALLS SAVED', 'HIT RATE'])
+        pt.align['KIND'] = 'l'
+        for kind in sorted(self.topology_stats):
+            stats = self.topology_stats[kind]
+            total = stats['calls'] + stats['saved']
+            pt.add_row([kind, len(self._topology.get(kind, {})), stats['calls'], stats['saved'],
+                        "{0:.1f}%".format(100.0 * stats['saved'] / (total or 1))])
+        if printme:
+            self.debug('\nTOPOLOGY CACHE TTL:{0}, RULE CACHE TTL:{1}\n{2}\n'
+                       .format(self.topology_ttl, self.rule_cache_ttl, pt))
+        else:
+            return pt
+
     def _indent_table_buf(self, table, indent=None):
         if indent is None:
             indent = self.default_indent
@@ -224,7 +331,14 @@ class Midget(object):
         """
         Returns all routers that have attributes and attribute values as defined in 'search_dict'
         """
-        routers = self.mapi.get_routers(query=None)
+        routers = self._search_routers(list(self._get_router_index()['list']), search_dict, eval_op)
+        if not routers and search_dict and self.topology_ttl:
+            #The router may have been created since the index was cached
+            self.invalidate_topology('routers')
+            routers = self._search_routers(list(self._get_router_index()['list']), search_dict, eval_op)
+        return routers
+
+    def _search_routers(self, routers, search_dict, eval_op):
         remove_list = []
         for key in search_dict:
             for router in routers:
@@ -258,6 +372,8 @@ class Midget(object):
 
     def get_router_by_name(self, name):
         assert name
+        if self.topology_ttl:
+            return self._lookup_index('routers', self._get_router_index, 'by_name', name)
         search_string = "^{0}$".format(name)
         self.debug('search string:{0}'.format(search_string))
         routers =  self.get_all_routers(search_dict={'name':search_string}, eval_op=re.match)
@@ -346,13 +462,13 @@ class Midget(object):
         if showchains:
             if router.get_inbound_filter_id():
                 in_filter_id = str(router.get_inbound_filter_id())
-                in_filter = self.mapi.get_chain(in_filter_id)
+                in_filter = self._get_chain(in_filter_id)
                 buf += "\n" + self._bold("{0}ROUTER INBOUND FILTER ({1}):\n"
                                          .format(indent, in_filter_id), 4)
                 buf += self._indent_table_buf(self.show_chain(chain=in_filter, printme=False))
             if router.get_outbound_filter_id():
                 out_filter_id = str(router.get_outbound_filter_id())
-                out_filter = self.mapi.get_chain(out_filter_id)
+                out_filter = self._get_chain(out_filter_id)
                 buf += "\n" + self._bold("{0}ROUTER OUTBOUND FILTER ({1}):\n"
                                          .format(indent, out_filter_id), 4)
                 buf += self._indent_table_buf(self.show_chain(chain=out_filter, printme=False))
@@ -364,12 +480,13 @@ class Midget(object):
 
     def get_device_by_peer_id(self, peerid):
         device = None
-        port = self.mapi.get_port(peerid)
+        port = self.get_port(peerid)
         type = str(port.get_type()).upper()
+        device_id = str(port.get_device_id())
         if type == 'BRIDGE':
-            device = self.mapi.get_bridge(port.get_device_id())
+            device = self._get_bridge_index()['by_id'].get(device_id) or self.mapi.get_bridge(device_id)
         if type == 'ROUTER':
-            device = self.mapi.get_router(port.get_device_id())
+            device = self._get_router_index()['by_id'].get(device_id) or self.mapi.get_router(device_id)
         if not device:
             raise ValueError('Unknown device type for peerid:{0}, port:{1}, type:{2}'
                              .format(peerid, port.get_id(), port.get_type()) )
@@ -378,7 +495,7 @@ class Midget(object):
 
     def get_router_port_for_subnet(self, router, cidr):
         assert cidr
-        for port in router.get_ports():
+        for port in self.get_router_ports(router):
             network = "{0}/{1}".format(port.get_network_address(), port.get_network_length())
             if str(network) == str(cidr):
                 return port
@@ -387,6 +504,10 @@ class Midget(object):
 
     def get_bridge_for_instance(self, instance):
         instance = self._get_instance(instance)
+        return self.get_topology('bridge_for_instance', str(instance.id),
+                                 lambda: self._get_bridge_for_instance(instance))
+
+    def _get_bridge_for_instance(self, instance):
         router = self.get_router_for_instance(instance)
         if not router:
             raise ValueError('Did not find router for instance:{0}'.format(instance.id))
@@ -441,12 +562,12 @@ class Midget(object):
             buf += self._indent_table_buf(str(self.show_bgps(port.get_bgps() or [] )))
         if showchains:
             if port.get_inbound_filter_id():
-                in_filter = self.mapi.get_chain(str(port.get_inbound_filter_id()))
+                in_filter = self._get_chain(str(port.get_inbound_filter_id()))
                 buf += self._bold("{0}PORT INBOUND FILTER:".format(indent), 4)
                 buf += "\n"
                 buf += self._indent_table_buf(self.show_chain(chain=in_filter, printme=False))
             if port.get_outbound_filter_id():
-                out_filter = self.mapi.get_chain(str(port.get_outbound_filter_id()))
+                out_filter = self._get_chain(str(port.get_outbound_filter_id()))
                 buf += self._bold("{0}PORT OUTBOUND FILTER:".format(indent), 4)
                 buf += "\n"
                 buf += self._indent_table_buf(self.show_chain(chain=out_filter, printme=False))
@@ -699,7 +820,7 @@ class Midget(object):
             for m_entry in mac_table:
                 if m_entry.get_macaddr() == arp_entry.get_mac():
                     portid = m_entry.get_port_id()
-                    return self.mapi.get_port(portid)
+                    return self.get_port(portid)
             self.debug('ARP entry for instance found, but mac has not been learned on a port yet, '
                        'try pinging it?   ')
         return None
@@ -711,7 +832,7 @@ class Midget(object):
             iname = port.get_interface_name()
             lookfor_name = 'vn_' + str(instance.id)
             if re.search(lookfor_name, iname):
-                return self.mapi.get_port(port.get_port_id())
+                return self.get_port(port.get_port_id())
         return None
 
     def show_bridge_port_for_instance(self, instance, showchains=True, indent=None, printme=True):
@@ -740,18 +861,13 @@ class Midget(object):
             return pt
 
     def get_chain_by_name(self, name):
-        chains = self.mapi.get_chains(query=None)
-        for chain in chains:
-            if str(chain.get_name()).strip() == str(name):
-                return chain
-        return None
+        return self._lookup_index('chains', self._get_chain_index, 'by_name', name)
 
     def get_chain_by_id(self, id):
-        chains = self.mapi.get_chains(query=None)
-        for chain in chains:
-            if str(chain.get_id()).strip() == str(id):
-                return chain
-        return None
+        return self._lookup_index('chains', self._get_chain_index, 'by_id', id)
+
+    def _get_chain(self, id):
+        return self.get_chain_by_id(id) or self.mapi.get_chain(id)
 
     def show_chain(self, chain, printme=True):
         if chain and isinstance(chain, unicode) or isinstance(chain, str):
@@ -769,11 +885,11 @@ class Midget(object):
                                                               chain.dto.get('tenantId', ""))
         pt = PrettyTable([title])
         pt.align[title] = 'l'
-        rules = chain.get_rules()
+        rules = self.get_chain_rules(chain)
         if not rules:
             pt.add_row(['NO RULES'])
         else:
-            rulesbuf = str(self.show_rules(rules=chain.get_rules(), jump=True, printme=False))
+            rulesbuf = str(self.show_rules(rules=rules, jump=True, printme=False))
             pt.add_row([rulesbuf])
         if printme:
             self.debug('\n{0}\n'.format(pt))
@@ -841,27 +957,79 @@ class Midget(object):
                              'port:"{2}"'.format(src_addr, protocol, port))
         protocol = str(protocol).upper().strip()
         port = int(port)
-        for rule in chain.get_rules():
-            src_ip = str(rule.get_nw_src_address() or '0.0.0.0')
-            src_mask = str(rule.get_nw_src_length() or 0)
-            rule_cidr =  src_ip + "/" + src_mask
-            rule_protocol = self._get_protocol_name_by_number(rule.get_nw_proto())
-            port_dict = rule.get_tp_dst()
-            start_port = port_dict.get('start')
-            end_port = port_dict.get('end')
-            if protocol == str(rule_protocol).upper().strip():
-                if port >= start_port and port <= end_port:
-                    if rule_cidr == "0.0.0.0/0" or self.tester.is_address_in_network(src_addr,
-                                                                                     rule_cidr):
-                        self.debug('Found rule which allows src_addr:"{0}", protocol:"{1}", '
-                                   'port:"{2}"'.format(src_addr, protocol, port))
-                        self.show_rules(rules=[rule])
-                        return True
+        if self.get_compiled_chain(chain).allows(src_addr=src_addr, protocol=protocol, port=port):
+            self.debug('Found rule which allows src_addr:"{0}", protocol:"{1}", '
+                       'port:"{2}"'.format(src_addr, protocol, port))
+            return True
         self.debug('Chain does not allow: src_addr:"{0}", protocol:"{1}", port:"{2}"'
                    .format(src_addr, protocol, port))
         return False
 
+    def get_compiled_chain(self, chain):
+        """
+        Returns a CompiledRuleSet of the chain's rules. Rules using an ip address group as their source are
+        compiled against the group's addresses, and keyed by the security group id in the ip address group's
+        name when diffing against the cloud's rules. The compiled chain is cached for rule_cache_ttl,
+        see get_topology().
+        """
+        return self.get_topology('compiled_chain', str(chain.get_id()), lambda: self._compile_chain(chain),
+                                 ttl=self.rule_cache_ttl)
+
+    def _compile_chain(self, chain):
+        ruleset = CompiledRuleSet(name=chain.get_name())
+        for rule in self.get_chain_rules(chain):
+            protocol_number = rule.get_nw_proto()
+            if protocol_number is None:
+                continue
+            port_dict = rule.get_tp_dst() or {}
+            cidr = None
+            src_group = None
+            addresses = None
+            ip_addr_grp_id = rule.get_ip_addr_group_src()
+            if ip_addr_grp_id:
+                ip_addr_grp = self.get_ip_addr_group(ip_addr_grp_id)
+                if ip_addr_grp:
+                    match = re.search('sg-\w+', str(ip_addr_grp.get_name()))
+                    src_group = match.group(0) if match else str(ip_addr_grp.get_name())
+                    addresses = [str(ga.get_addr()) for ga in ip_addr_grp.get_addrs() if ga.get_addr()]
+            else:
+                cidr = "{0}/{1}".format(rule.get_nw_src_address() or '0.0.0.0',
+                                        rule.get_nw_src_length() or 0)
+            ruleset.add_rule(self._get_protocol_name_by_number(protocol_number),
+                             port_dict.get('start'), port_dict.get('end'),
+                             cidr=cidr, src_group=src_group, addresses=addresses)
+        return ruleset
+
+    def diff_security_groups_with_backend(self, groups, show=True):
+        """
+        Compares the ingress rules of each cloud security group against the rules of its midonet chain.
+        :param groups: list of boto SecurityGroups
+        :returns dict of group id -> {'missing': rules on the cloud not found on the backend,
+                                      'extra': rules on the backend not found on the cloud}
+                 as lists of (protocol, from_port, to_port, cidr or source group id) tuples
+        """
+        self.invalidate_rules()
+        diffs = {}
+        for group in groups:
+            cloud_rules = CompiledRuleSet.from_security_groups([group], name=group.id)
+            chain = self.get_chain_for_security_group(group)
+            backend_rules = self.get_compiled_chain(chain) if chain else CompiledRuleSet()
+            missing, extra = cloud_rules.diff(backend_rules)
+            diffs[group.id] = {'missing': missing, 'extra': extra}
+        if show:
+            pt = PrettyTable(['GROUP', 'NAME', 'MISSING ON BACKEND', 'EXTRA ON BACKEND'])
+            pt.align['MISSING ON BACKEND'] = 'l'
+            pt.align['EXTRA ON BACKEND'] = 'l'
+            for group in groups:
+                diff = diffs[group.id]
+                pt.add_row([group.id, group.name,
+                            "\n".join("{0}:{1}-{2} {3}".format(*rule) for rule in diff['missing']),
+                            "\n".join("{0}:{1}-{2} {3}".format(*rule) for rule in diff['extra'])])
+            self.debug('\n{0}\n'.format(pt))
+        return diffs
+
     def get_unsynced_rules_for_security_group(self, group, show_rules=True):
+        self.invalidate_rules()
         chain = self.get_chain_for_security_group(group)
         unsynced_rules = []
         for rule in group.rules:
@@ -901,6 +1069,7 @@ class Midget(object):
             'security_group_rule arg must be of type boto.IPPermissions, got:"{0}:{1}'\
                 .format(security_group_rule, type(security_group_rule))
         chain = self.get_chain_for_security_group(group)
+        chain_rules = self.get_chain_rules(chain)
         ip_grants = copy.copy(security_group_rule.grants)
         protocol = security_group_rule.ip_protocol and \
                    str(security_group_rule.ip_protocol).upper() or None
@@ -921,7 +1090,7 @@ class Midget(object):
                                           security_group_rule.ip_protocol,
                                           security_group_rule.from_port,
                                           security_group_rule.to_port)))
-            for rule in chain.get_rules():
+            for rule in chain_rules:
                 match = False
                 protocol_number = rule.get_nw_proto()
                 r_protocol = None
@@ -946,7 +1115,7 @@ class Midget(object):
                 ip_addr_grp_name = ""
                 self.debug('This rule has ipaddr group:"{0}"'.format(ip_addr_grp_id))
                 if ip_addr_grp_id:
-                    ip_addr_grp = self.mapi.get_ip_addr_group(ip_addr_grp_id)
+                    ip_addr_grp = self.get_ip_addr_group(ip_addr_grp_id)
                     if ip_addr_grp:
                         ip_addr_grp_name = str(ip_addr_grp.get_name())
                         self.debug('This rule has ipaddr group name:"{0}"'
@@ -975,6 +1144,25 @@ class Midget(object):
             self.show_rules(rules=ret_rules)
         return ret_rules
 
+    def do_instances_rules_allow(self, queries):
+        """
+        Batched form of do_instance_rules_allow() evaluated against the compiled chains of each instance's
+        security groups.
+        :param queries: list of (instance, src_addr, protocol, port) tuples
+        :returns list of booleans in query order
+        """
+        self.invalidate_rules()
+        rulesets = {}
+        results = []
+        for instance, src_addr, protocol, port in queries:
+            if instance.id not in rulesets:
+                rulesets[instance.id] = [self.get_compiled_chain(chain) for chain in
+                                         [self.get_chain_for_security_group(group) for group in instance.groups]
+                                         if chain]
+            results.append(any(ruleset.allows(src_addr=src_addr, protocol=protocol, port=port)
+                               for ruleset in rulesets[instance.id]))
+        return results
+
     def do_instance_rules_allow(self, instance, src_addr, protocol, port ):
         for group in instance.groups:
             chain = self.get_chain_for_security_group(group)
@@ -1031,7 +1219,7 @@ class Midget(object):
             targetstring = self._bold(",".join(targets))
             if rule.get_type().upper() == 'JUMP':
                 jump_chain_id = rule.get_jump_chain_id()
-                jump_chain = self.mapi.get_chain(jump_chain_id)
+                jump_chain = self._get_chain(jump_chain_id)
                 rule_type = self._bold(rule.get_type(), self._CHAIN_JUMP)
                 action = self._bold('to chain', self._CHAIN_JUMP)
                 targetstring = jump_chain_id
@@ -1123,7 +1311,7 @@ class Midget(object):
 
     def show_ip_addr_group_addrs(self, ipgroup, printme=True):
         if not isinstance(ipgroup, IpAddrGroup):
-            ipgroup = self.mapi.get_ip_addr_group(ipgroup)
+            ipgroup = self.get_ip_addr_group(ipgroup)
         if not ipgroup:
             raise ValueError('ipgroup not found or populated for show_ip_addr_group_addrs')
         addrs = []
@@ -1193,6 +1381,7 @@ class Midget(object):
         """
         Generic reset method not specific to a midonet backend, for tests to call...
         """
+        self.invalidate_topology()
         return self.reset_midolman_service_on_hosts(hosts=hosts)
 
     def reset_midolman_service_on_hosts(self,hosts=None):
@@ -33,13 +33,239 @@
 from eutester.eutestcase import EutesterTestCase
 from multiprocessing import Process
 from multiprocessing import Queue
+from multiprocessing import Array, Value, Pipe
+import Queue as queue_module
+import select
+import cPickle
 import inspect
+import os
+import time
+import traceback
 import uuid
 
+
+class ProcessTaskException(Exception):
+    """
+    Raised for a pool task which failed in its worker process. remote_traceback holds the worker's traceback.
+    """
+    def __init__(self, msg, remote_traceback=None):
+        self.msg = msg
+        self.remote_traceback = remote_traceback
+        Exception.__init__(self, msg)
+
+    def __str__(self):
+        if self.remote_traceback:
+            return str(self.msg) + "\nRemote traceback:\n" + str(self.remote_traceback)
+        return str(self.msg)
+
+
+class ProcessTaskTimeout(ProcessTaskException):
+    pass
+
+
+class ProcessTaskResult():
+    """
+    Result of a single task run by a ProcessWorkerPool
+    """
+    def __init__(self, task_id, args, kwargs, result=None, error=None, elapsed=None):
+        self.task_id = task_id
+        self.args = args
+        self.kwargs = kwargs
+        self.result = result
+        self.error = error
+        self.elapsed = elapsed
+
+
+def _pool_worker(task_queue, result_conn, methods, current_task, current_start):
+    """
+    Long lived worker loop run in each pool process. Methods in 'methods' were inherited when the worker was
+    forked so tasks only reference them by index, other callables are sent pickled with the task.
+    The running task id and start time are kept in shared memory so the parent can time out, or account
+    for, a task whose worker hangs or dies.
+    Results are pickled here, so an unpicklable result is reported as a task error rather than lost, and
+    are sent on this worker's own pipe, which unlike a Queue is written before the next task starts.
+    """
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        task_id, method_ref, args, kwargs = task
+        start = time.time()
+        current_start.value = start
+        current_task.value = task_id
+        try:
+            if isinstance(method_ref, int):
+                method = methods[method_ref]
+            else:
+                method = method_ref
+            result = cPickle.dumps(method(*args, **kwargs), cPickle.HIGHEST_PROTOCOL)
+            result_conn.send((task_id, 'done', result, time.time() - start))
+        except Exception, e:
+            result_conn.send((task_id, 'error', (repr(e), traceback.format_exc()), time.time() - start))
+        current_task.value = ''
+
+
+class ProcessWorkerPool():
+    """
+    Pool of long lived worker processes, reused across tasks.
+    Methods given in 'methods' are available to the workers without pickling (ie: bound methods of test
+    objects holding connections). Other callables must be picklable (ie: module level functions).
+    """
+    def __init__(self, workers=4, methods=None, poll_interval=0.5):
+        self.workers = workers
+        self.methods = list(methods or [])
+        self.poll_interval = poll_interval
+        self.task_queue = Queue()
+        self.processes = {}
+        self.tasks = {}
+        self.completed = {}
+
+    def start(self):
+        while len(self.processes) < self.workers:
+            self._start_worker()
+        return self
+
+    def _start_worker(self):
+        current_task = Array('c', 64)
+        current_start = Value('d', 0)
+        result_reader, result_writer = Pipe(duplex=False)
+        process = Process(target=_pool_worker, args=(self.task_queue, result_writer, self.methods,
+                                                     current_task, current_start))
+        process.daemon = True
+        process.start()
+        result_writer.close()
+        process.result_conn = result_reader
+        process.current_task = current_task
+        process.current_start = current_start
+        self.processes[process.pid] = process
+        return process
+
+    def _get_method_ref(self, method):
+        for index, registered in enumerate(self.methods):
+            if registered == method:
+                return index
+        try:
+            cPickle.dumps(method, cPickle.HIGHEST_PROTOCOL)
+        except Exception, e:
+            raise ValueError("Method:" + str(method) + " is not picklable, provide it in the pool's 'methods' "
+                             "when creating the pool. Err:" + str(e))
+        return method
+
+    def submit(self, method, *args, **kwargs):
+        """
+        Queue method(*args, **kwargs) to run in a worker, returns the task id
+        """
+        if not self.processes:
+            self.start()
+        task_id = uuid.uuid1().hex
+        self.tasks[task_id] = {'args': args, 'kwargs': kwargs, 'submitted': time.time()}
+        self.task_queue.put((task_id, self._get_method_ref(method), args, kwargs))
+        return task_id
+
+    def _finish_task(self, task_id, result=None, error=None, elapsed=None):
+        task = self.tasks.pop(task_id)
+        if elapsed is None:
+            elapsed = time.time() - task['submitted']
+        self.completed[task_id] = ProcessTaskResult(task_id, task['args'], task['kwargs'], result=result,
+                                                    error=error, elapsed=elapsed)
+
+    def _poll(self, timeout=None):
+        """
+        Process any messages from the workers, then fail tasks whose worker died or which exceeded 'timeout'
+        seconds, replacing their workers.
+        """
+        readers = dict((process.result_conn.fileno(), process.result_conn) for process in self.processes.values())
+        ready = select.select(readers.keys(), [], [], self.poll_interval)[0]
+        for fd in ready:
+            conn = readers[fd]
+            try:
+                while conn.poll():
+                    task_id, status, value, elapsed = conn.recv()
+                    if task_id not in self.tasks:
+                        continue
+                    if status == 'done':
+                        self._finish_task(task_id, result=cPickle.loads(value), elapsed=elapsed)
+                    else:
+                        self._finish_task(task_id, error=ProcessTaskException(value[0], remote_traceback=value[1]),
+                                          elapsed=elapsed)
+            except (EOFError, IOError):
+                #Worker exited, handled below
+                pass
+        now = time.time()
+        for pid, process in self.processes.items():
+            task_id = process.current_task.value
+            if task_id not in self.tasks:
+                if not process.is_alive():
+                    process.result_conn.close()
+                    self.processes.pop(pid)
+                    self._start_worker()
+                continue
+            elapsed = now - process.current_start.value
+            if timeout and elapsed > timeout:
+                error = ProcessTaskTimeout("Task:" + str(task_id) + " timed out after " + str(timeout) +
+                                           " seconds in worker:" + str(pid))
+            elif not process.is_alive():
+                error = ProcessTaskException("Worker:" + str(pid) + " exited (" + str(process.exitcode) +
+                                             ") while running task:" + str(task_id))
+            else:
+                continue
+            if process.is_alive():
+                process.terminate()
+            process.join(1)
+            process.result_conn.close()
+            self.processes.pop(pid)
+            self._start_worker()
+            self._finish_task(task_id, error=error, elapsed=elapsed)
+
+    def imap_unordered(self, method, arg_list, timeout=None, return_exceptions=False):
+        """
+        Runs method once per entry in arg_list across the pool's workers, yielding a ProcessTaskResult for each
+        task as soon as it completes. Entries may be a dict of kwargs, a tuple/list of positional args, or a
+        single positional arg.
+        timeout - optional - seconds a single task may run before its worker is killed and replaced
+        return_exceptions - optional - boolean, yield failed tasks with result.error set, otherwise the
+                            task's ProcessTaskException (including the remote traceback) is raised
+        """
+        pending = set()
+        for entry in arg_list:
+            if isinstance(entry, dict):
+                pending.add(self.submit(method, **entry))
+            elif isinstance(entry, (tuple, list)):
+                pending.add(self.submit(method, *entry))
+            else:
+                pending.add(self.submit(method, entry))
+        while pending:
+            self._poll(timeout=timeout)
+            for task_id in [task_id for task_id in pending if task_id in self.completed]:
+                pending.remove(task_id)
+                task_result = self.completed.pop(task_id)
+                if task_result.error and not return_exceptions:
+                    raise task_result.error
+                yield task_result
+
+    def close(self, timeout=10):
+        """
+        Stop the workers once queued tasks have run, terminating any still running after timeout seconds
+        """
+        for x in xrange(0, len(self.processes)):
+            self.task_queue.put(None)
+        for process in self.processes.values():
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        self.processes = {}
+
+    def terminate(self):
+        for process in self.processes.values():
+            process.terminate()
+        self.processes = {}
+
+
 class ProcessManager():
     def __init__(self):
         self.process_pool = {}
         self.queue_pool = {}
+        self.worker_pool = None
 
     def lookup_process(self, id):
         try:
@@ -111,7 +337,55 @@ class ProcessManager():
 
     def get_all_results(self):
         result_list = []
-        for process in self.process_pool:
+        for process in self.process_pool.keys():
                 result_list.append(self.wait_for_process(process))
         return result_list
 
+    def iter_results(self, poll_interval=0.5):
+        """
+        Yields (id, return value) for processes started with run_method_as_process in the order they
+        complete, rather than the order they were started
+        """
+        while self.process_pool:
+            for id in self.process_pool.keys():
+                try:
+                    return_value = self.queue_pool[id].get(True, poll_interval / len(self.process_pool))
+                except queue_module.Empty:
+                    continue
+                self.process_pool[id].join()
+                self.remove_process(id)
+                yield id, return_value
+
+    def start_worker_pool(self, workers=4, methods=None):
+        """
+        Starts a pool of long lived worker processes reused for imap_unordered() calls.
+        methods - optional - list of (possibly unpicklable, ie bound) methods the workers need to run
+        """
+        if self.worker_pool:
+            self.worker_pool.close()
+        self.worker_pool = ProcessWorkerPool(workers=workers, methods=methods).start()
+        return self.worker_pool
+
+    def stop_worker_pool(self):
+        if self.worker_pool:
+            self.worker_pool.close()
+            self.worker_pool = None
+
+    def imap_unordered(self, method, arg_list, workers=4, timeout=None, return_exceptions=False):
+        """
+        Runs method for each entry of arg_list in worker processes, yielding ProcessTaskResults as they complete.
+        Uses the pool from start_worker_pool() if running, otherwise a pool of 'workers' processes is created
+        for this call and closed once all results are consumed. See ProcessWorkerPool.imap_unordered()
+        """
+        pool = self.worker_pool
+        temp_pool = pool is None
+        if temp_pool:
+            pool = ProcessWorkerPool(workers=workers, methods=[method]).start()
+        try:
+            for task_result in pool.imap_unordered(method, arg_list, timeout=timeout,
+                                                   return_exceptions=return_exceptions):
+                yield task_result
+        finally:
+            if temp_pool:
+                pool.terminate()
+
@@ -0,0 +1,212 @@
+'''
+Compiled security group rule evaluation.
+
+A CompiledRuleSet holds ingress rules in integer form. Each protocol has a sorted table of non overlapping
+port segments, and each segment has sorted, merged integer source address ranges and a set of source group ids.
+"Is (src, protocol, port) allowed" is then two bisects rather than a walk of every rule with string cidr
+parsing per call, and many queries can be answered with allows_many(). Example:
+
+    from eutester.sec_group_rules import CompiledRuleSet
+
+    rules = CompiledRuleSet.from_security_groups(tester.get_instance_security_groups(instance))
+    results = rules.allows_many([('10.111.1.5', 'tcp', 22), ('10.111.1.5', 'udp', 53)])
+
+Rule sets built from different sources (ie the cloud's security groups and the backend's chains) can be
+compared with diff().
+'''
+import bisect
+import socket
+import struct
+
+# Protocol value matching any protocol
+ALL_PROTOCOLS = '-1'
+MIN_PORT = 0
+MAX_PORT = 65535
+
+_cidr_ranges = {}
+
+
+def ip_to_int(addr):
+    return struct.unpack('!I', socket.inet_aton(str(addr).strip()))[0]
+
+
+def int_to_ip(value):
+    return socket.inet_ntoa(struct.pack('!I', value))
+
+
+def cidr_to_range(cidr):
+    """
+    Returns the (first, last) integer addresses of 'cidr', ie: '10.0.0.0/8'. An address without a
+    mask is treated as /32. Results are cached.
+    """
+    cidr = str(cidr).strip()
+    cached = _cidr_ranges.get(cidr)
+    if cached:
+        return cached
+    if '/' in cidr:
+        network, bits = cidr.split('/')
+        bits = int(bits)
+    else:
+        network, bits = cidr, 32
+    mask = (0xffffffff << (32 - bits)) & 0xffffffff
+    first = ip_to_int(network) & mask
+    _cidr_ranges[cidr] = (first, first | (~mask & 0xffffffff))
+    return _cidr_ranges[cidr]
+
+
+def range_to_cidr(address_range):
+    first, last = address_range
+    size = last - first + 1
+    host_bits = 0
+    while size >> (host_bits + 1):
+        host_bits += 1
+    bits = 32 - host_bits
+    return '{0}/{1}'.format(int_to_ip(first), bits)
+
+
+def merge_ranges(ranges):
+    """
+    Merges overlapping and adjacent integer ranges, returns sorted lists of range starts and ends
+    """
+    starts = []
+    ends = []
+    for first, last in sorted(ranges):
+        if ends and first <= ends[-1] + 1:
+            ends[-1] = max(ends[-1], last)
+        else:
+            starts.append(first)
+            ends.append(last)
+    return starts, ends
+
+
+class CompiledRuleSet(object):
+
+    def __init__(self, name=None):
+        self.name = name
+        self.rules = []
+        self._tables = None
+
+    def add_rule(self, protocol, from_port=None, to_port=None, cidr=None, src_group=None,
+                 addresses=None):
+        """
+        Adds an ingress rule. Ports of None or -1, or a to_port of 0, match all ports.
+        :param protocol: protocol name or number, '-1' matches all protocols
+        :param cidr: source cidr allowed by this rule
+        :param src_group: source group id allowed by this rule
+        :param addresses: optional list of member addresses of src_group, matched as /32s
+        """
+        protocol = str(protocol).strip().lower()
+        if from_port in [None, -1, '-1'] or to_port in [None, -1, '-1', 0, '0']:
+            from_port, to_port = MIN_PORT, MAX_PORT
+        ranges = []
+        if cidr:
+            ranges.append(cidr_to_range(cidr))
+        for addr in addresses or []:
+            ranges.append(cidr_to_range(addr))
+        self.rules.append({'protocol': protocol,
+                           'from_port': int(from_port),
+                           'to_port': int(to_port),
+                           'cidr': range_to_cidr(cidr_to_range(cidr)) if cidr else None,
+                           'src_group': str(src_group) if src_group else None,
+                           'ranges': ranges})
+        self._tables = None
+
+    @classmethod
+    def from_security_groups(cls, groups, name=None):
+        """
+        Compiles the ingress rules of a list of boto SecurityGroups into one rule set
+        """
+        ruleset = cls(name=name)
+        for group in groups:
+            for rule in group.rules:
+                for grant in rule.grants:
+                    group_id = getattr(grant, 'groupId', None) or getattr(grant, 'group_id', None)
+                    ruleset.add_rule(rule.ip_protocol, rule.from_port, rule.to_port,
+                                     cidr=grant.cidr_ip, src_group=group_id)
+        return ruleset
+
+    def compile(self):
+        """
+        Builds the per protocol port segment tables, done on the first query after rules change
+        """
+        tables = {}
+        protocols = set([rule['protocol'] for rule in self.rules] + [ALL_PROTOCOLS])
+        for protocol in protocols:
+            rules = [rule for rule in self.rules if rule['protocol'] in [protocol, ALL_PROTOCOLS]]
+            bounds = sorted(set([rule['from_port'] for rule in rules] +
+                                [rule['to_port'] + 1 for rule in rules]))
+            segments = []
+            for index in xrange(0, len(bounds) - 1):
+                first, last = bounds[index], bounds[index + 1] - 1
+                ranges = []
+                groups = set()
+                for rule in rules:
+                    if rule['from_port'] <= first and rule['to_port'] >= last:
+                        ranges.extend(rule['ranges'])
+                        if rule['src_group']:
+                            groups.add(rule['src_group'])
+                starts, ends = merge_ranges(ranges)
+                segments.append((starts, ends, groups))
+            tables[protocol] = (bounds, segments)
+        self._tables = tables
+        return tables
+
+    def allows(self, src_addr=None, protocol='tcp', port=22, src_group=None):
+        """
+        Returns True if traffic from src_addr (or src_group id) using protocol to port is allowed.
+        A port of None or -1, ie: for icmp, matches rules for any port.
+        """
+        tables = self._tables or self.compile()
+        bounds, segments = tables.get(str(protocol).strip().lower()) or tables[ALL_PROTOCOLS]
+        if port in [None, -1, '-1']:
+            indexes = xrange(0, len(segments))
+        else:
+            index = bisect.bisect_right(bounds, int(port)) - 1
+            if index < 0 or index >= len(segments):
+                return False
+            indexes = [index]
+        addr = None
+        if src_addr is not None:
+            addr = src_addr if isinstance(src_addr, (int, long)) else ip_to_int(src_addr)
+        for index in indexes:
+            starts, ends, groups = segments[index]
+            if addr is not None and starts:
+                position = bisect.bisect_right(starts, addr) - 1
+                if position >= 0 and addr <= ends[position]:
+                    return True
+            if src_group and str(src_group) in groups:
+                return True
+        return False
+
+    def allows_many(self, queries):
+        """
+        Answers a batch of queries, each a tuple of (src_addr, protocol, port) or
+        (src_addr, protocol, port, src_group). Returns a list of booleans in query order.
+        """
+        addrs = {}
+        results = []
+        for query in queries:
+            src_addr = query[0]
+            if src_addr is not None and src_addr not in addrs:
+                addrs[src_addr] = ip_to_int(src_addr)
+            results.append(self.allows(addrs.get(src_addr), query[1], query[2],
+                                       query[3] if len(query) > 3 else None))
+        return results
+
+    def get_rule_keys(self):
+        """
+        Returns the set of (protocol, from_port, to_port, source) tuples for the rules in this set, where
+        source is the cidr or the source group id
+        """
+        return set([(rule['protocol'], rule['from_port'], rule['to_port'], rule['src_group'] or rule['cidr'])
+                    for rule in self.rules])
+
+    def diff(self, other):
+        """
+        Compares rules with another CompiledRuleSet
+        :returns: tuple of (rules only in self, rules only in other) as sorted lists of rule keys,
+                  see get_rule_keys()
+        """
+        mine = self.get_rule_keys()
+        theirs = other.get_rule_keys()
+        return sorted(mine - theirs), sorted(theirs - mine)
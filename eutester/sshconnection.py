@@ -87,6 +87,7 @@ example with proxy:
 
 
 import copy
+import hashlib
 import os
 import paramiko
 import re
@@ -96,8 +97,10 @@ import time
 import types
 import sys
 import termios
+import threading
 import tty
 from paramiko.sftp_client import SFTPClient
+from eutester.timer import metrics
 
 
 class SFTPifc(SFTPClient):
@@ -147,9 +150,202 @@ class SshCbReturn():
         self.buf = buf
 
 
+class SshConnectionPool():
+    """
+    Process wide pool of authenticated paramiko ssh clients shared between SshConnection objects.
+    Clients are keyed by host, port, username, credentials and proxy so Machine, Eunode and EuInstance
+    objects connecting to the same host with the same credentials reuse one live transport instead of
+    handshaking again. Connections with different credentials never share a client.
+
+    example usage:
+        from eutester.sshconnection import SshConnection, ssh_connection_pool
+        ssh1 = SshConnection('192.168.1.1', password='foobar', use_pool=True)
+        ssh2 = SshConnection('192.168.1.1', password='foobar', use_pool=True)  # reuses ssh1's transport
+        ssh_connection_pool.show_stats()
+    """
+    def __init__(self, max_sessions_per_host=10, keepalive=30, idle_timeout=600):
+        """
+        :param max_sessions_per_host: max number of cmd() channels open at once per host, 0 = no limit
+        :param keepalive: seconds between transport keepalive packets, 0 = disabled
+        :param idle_timeout: seconds an unreferenced client may stay in the pool before it is closed
+        """
+        self.max_sessions_per_host = max_sessions_per_host
+        self.keepalive = keepalive
+        self.idle_timeout = idle_timeout
+        self._lock = threading.RLock()
+        self._entries = {}
+        self._session_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.handshake_time = 0.0
+
+    @staticmethod
+    def get_key(host, port=22, username=None, proxy=None, proxy_username=None, keypath=None, password=None):
+        """
+        Returns the tuple used to index a client in the pool. The password is only included as a hash.
+        """
+        password_hash = hashlib.sha1(str(password)).hexdigest() if password is not None else ''
+        return (str(host).strip(), int(port), str(username), str(keypath or ''), password_hash,
+                str(proxy or ''), str(proxy_username if proxy else ''))
+
+    @staticmethod
+    def is_client_active(client):
+        """
+        Returns True if the paramiko ssh client's transport is up and usable
+        """
+        try:
+            tran = client.get_transport()
+            return bool(tran is not None and tran.is_active())
+        except Exception:
+            return False
+
+    def acquire(self, key, connect_method):
+        """
+        Returns a live client for 'key', reusing a pooled transport if one is active. On a miss
+        'connect_method' is called with no args to create and authenticate a new paramiko client.
+
+        :param key: pool key, see get_key()
+        :param connect_method: method returning a connected paramiko.SSHClient
+        :return: paramiko.SSHClient
+        """
+        with self._lock:
+            self._close_idle()
+            entry = self._entries.get(key)
+            if entry and self.is_client_active(entry['client']):
+                entry['refs'] += 1
+                entry['last_used'] = time.time()
+                self.hits += 1
+                return entry['client']
+            if entry:
+                self._remove(key)
+            self.misses += 1
+        #Handshake outside of the pool lock so connections to different hosts can proceed concurrently
+        start = time.time()
+        client = connect_method()
+        elapsed = time.time() - start
+        if self.keepalive:
+            client.get_transport().set_keepalive(self.keepalive)
+        with self._lock:
+            self.handshake_time += elapsed
+            entry = self._entries.get(key)
+            if entry and self.is_client_active(entry['client']):
+                #Another thread connected first, use its client and drop ours
+                client.close()
+                entry['refs'] += 1
+                entry['last_used'] = time.time()
+                return entry['client']
+            self._entries[key] = {'client': client, 'refs': 1, 'created': time.time(),
+                                  'last_used': time.time(), 'handshake_time': elapsed}
+        return client
+
+    def release(self, key, client):
+        """
+        Release a reference to a pooled client. The transport is kept open for reuse
+        until it goes idle for longer than idle_timeout.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry or entry['client'] is not client:
+                #Not in the pool (evicted or replaced), nobody else owns it
+                client.close()
+                return
+            entry['refs'] = max(0, entry['refs'] - 1)
+            entry['last_used'] = time.time()
+            if not self.is_client_active(client):
+                self._remove(key)
+
+    def evict(self, key, client=None):
+        """
+        Close and remove the pooled client for 'key'. If 'client' is provided it is only removed if
+        it is still the pooled client for this key.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and (client is None or entry['client'] is client):
+                self._remove(key)
+            elif client is not None:
+                client.close()
+
+    def get_session_lock(self, host):
+        """
+        Returns the semaphore used to cap the number of concurrently open cmd() sessions to 'host'
+        """
+        if not self.max_sessions_per_host:
+            return None
+        host = str(host).strip()
+        with self._lock:
+            if host not in self._session_locks:
+                self._session_locks[host] = threading.BoundedSemaphore(self.max_sessions_per_host)
+            return self._session_locks[host]
+
+    def close_all(self):
+        """
+        Close every pooled client
+        """
+        with self._lock:
+            for key in self._entries.keys():
+                self._remove(key)
+
+    def get_stats(self):
+        """
+        Returns dict of pool counters
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'open_clients': len(self._entries),
+                    'handshake_time': self.handshake_time,
+                    'avg_handshake_time': self.handshake_time / (self.misses or 1)}
+
+    def show_stats(self, printmethod=None):
+        """
+        Print the pool counters and each pooled client using 'printmethod', default print
+        """
+        stats = self.get_stats()
+        buf = "SSH POOL: hits:{0}, misses:{1}, evictions:{2}, open:{3}, handshake time:{4:.3f}s " \
+              "(avg:{5:.3f}s)\n".format(stats['hits'], stats['misses'], stats['evictions'],
+                                        stats['open_clients'], stats['handshake_time'],
+                                        stats['avg_handshake_time'])
+        with self._lock:
+            for key, entry in self._entries.iteritems():
+                buf += "  {0}@{1}:{2} proxy:'{3}' refs:{4} active:{5} handshake:{6:.3f}s\n".format(
+                    key[2], key[0], key[1], key[3], entry['refs'],
+                    self.is_client_active(entry['client']), entry['handshake_time'])
+        if printmethod:
+            printmethod(buf)
+        else:
+            print buf
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.evictions += 1
+            try:
+                entry['client'].close()
+            except Exception:
+                pass
+
+    def _close_idle(self):
+        if not self.idle_timeout:
+            return
+        now = time.time()
+        for key, entry in self._entries.items():
+            if entry['refs'] <= 0 and (now - entry['last_used']) > self.idle_timeout:
+                self._remove(key)
+
+#Process wide pool used by SshConnection objects created with use_pool set
+ssh_connection_pool = SshConnectionPool()
+
+
 class SshConnection():
     cmd_timeout_err_code = -100
     cmd_not_executed_code = -99
+    #Max number of bytes read from a channel per recv() in cmd()
+    recv_bufsize = 32768
+    #Default for sharing connections through the process wide ssh_connection_pool
+    use_pool = False
 
     def __init__(self,
                  host,
@@ -169,7 +365,8 @@ class SshConnection():
                  retry=1,
                  debugmethod=None,
                  verbose=False,
-                 debug_connect=False):
+                 debug_connect=False,
+                 use_pool=None):
         """
         :param host: -mandatory - string, hostname or ip address to establish ssh connection to
         :param username: - optional - string, username used to establish ssh session when keypath is not provided
@@ -188,6 +385,8 @@ class SshConnection():
         :param debugmethod: - method, used to handle debug msgs
         :param verbose: - optional - boolean to flag debug output on or off mainly for cmd execution
         :param debug_connect: - optional - boolean to flag debug output on or off for connection related operations
+        :param use_pool: - optional - boolean, share a pooled transport via ssh_connection_pool. Defaults to
+                           SshConnection.use_pool
         """
 
         self.host = host
@@ -211,6 +410,11 @@ class SshConnection():
             self.key_files = str(self.key_files).split(',')
         self.find_keys = find_keys
         self.debug_connect = debug_connect
+        if use_pool is None:
+            use_pool = SshConnection.use_pool
+        self.use_pool = use_pool
+        self.pool = ssh_connection_pool
+        self.connection = None
 
         #Used to store the last cmd attempted and it's exit code
         self.lastcmd = ""
@@ -237,17 +441,7 @@ class SshConnection():
         if self.find_keys or \
                 self.keypath is not None or \
                 ((self.username is not None) and (self.password is not None)):
-            self.connection = self.get_ssh_connection(self.host,
-                                                      username=self.username,
-                                                      password=self.password,
-                                                      keypath=self.keypath,
-                                                      proxy_username=self.proxy_username,
-                                                      proxy_password=self.proxy_password,
-                                                      proxy_keypath=self.proxy_keypath,
-                                                      enable_ipv6_dns=self.enable_ipv6_dns,
-                                                      timeout=self.timeout,
-                                                      retry=self.retry,
-                                                      verbose=self.debug_connect)
+            self.connection = self._connect()
         else:
             raise Exception("Need either a keypath or username+password to create ssh connection")
 
@@ -354,6 +548,7 @@ class SshConnection():
         return output
 
 
+    @metrics.timed('ssh.cmd')
     def cmd(self,
             cmd,
             verbose=None,
@@ -406,7 +601,15 @@ class SshConnection():
                 self.debug(msg)
         if verbose:
             self.debug("[" + self.username + "@" + str(self.host) + "]# " + cmd)
+        #Cap the number of open sessions per host when sharing pooled transports
+        session_lock = None
+        if self.use_pool:
+            session_lock = self.pool.get_session_lock(self.host)
+        if session_lock:
+            session_lock.acquire()
         try:
+            if self.connection is None:
+                self.refresh_connection()
             tran = self.connection.get_transport()
             if tran is None or not tran.active:
                 self.debug("SSH transport was None, attempting to restablish ssh to: "+str(self.host))
@@ -427,110 +630,108 @@ class SshConnection():
                     chan.send(cmd)
                 else:
                     chan.exec_command(cmd)
-                output = None
                 fd = chan.fileno()
             except:
                 if chan:
                     chan.close()
                 raise
+            #Collect output chunks in a list and join once at the end
+            output = []
             cmdstart = start = time.time()
-            newdebug = "\n"
+            newdebug = []
             while not chan.closed:
-                time.sleep(0.05)
+                #Block on the channel's readiness for up to the remaining time on the timer
+                remaining = timeout - (time.time() - start)
+                if remaining <= 0:
+                    raise CommandTimeoutException(
+                        "SSH Command timer fired after " + str(int(time.time() - start)) +
+                        " seconds. Cmd:'" + str(cmd) + "'")
                 try:
-                    rl, wl, xl = select.select([fd], [], [], timeout)
+                    rl, wl, xl = select.select([fd], [], [], remaining)
                 except select.error:
                     break
-                elapsed = int(time.time() - start)
-                if elapsed >= timeout and len(rl) < 1:
-                    raise CommandTimeoutException(
-                        "SSH Command timer fired after " + str(int(elapsed)) + " seconds. Cmd:'" + str(cmd) + "'")
-                if len(rl) > 0:
-                    cmddebug('ssh cmd: got input on recv channel')
-                    while chan.recv_ready():
-                        new = chan.recv(1024)
-                        if verbose:
-                            cmddebug('ssh cmd: got new data on channel:"' + str(new) + '"')
-                        if new is not None:
-                            #We have data to handle...
-                            #Run call back if there is one, let call back handle data read in
-                            if cb is not None:
-                                if enable_debug:
-                                    cbname = 'unknown'
-                                    try:
-                                        cbname = str(cb.im_func.func_code.co_name)
-                                    except: pass
-                                    self.debug('ssh cmd: sending new data to callback: ' + str(cbname))
-                                #If cb returns false break, end rx loop, return cmd outcome/output dict. 
-                                #cbreturn = SshCbReturn()
-                                cbreturn = cb(new, *cbargs)
-                                #Let the callback control whether or not to continue
-                                if cbreturn.stop:
-                                    cmddebug('ssh cmd: callback sent stop')
-                                    if cbreturn.buf:
-                                        if output is None:
-                                            output = cbreturn.buf
-                                        else:
-                                            output += cbreturn.buf
-                                    cbfired = True
-                                    chan.close()
-                                    #Let the callback dictate the return code, otherwise -1 for connection err may occur
-                                    if cbreturn.statuscode != -1:
-                                        status = cbreturn.statuscode
-                                    else:
-                                        status = self.lastexitcode = chan.recv_exit_status()
-                                    break
-                                else:
-
-                                    #Let the callback update its calling args if needed
-                                    if cbreturn.nextargs is not None:
-                                        cbargs = cbreturn.nextargs
-                                    #Let the callback update/reset the timeout if needed
-                                    if cbreturn.settimer > 0:
-                                        start = time.time()
-                                        timeout = cbreturn.settimer
-                                    #Let the callback update the output buffer to be returned
-                                    if cbreturn.buf:
-                                        cmddebug('ssh cmd: cb returned buf:"' + str(cbreturn.buf) + '"')
-                                        if output is None:
-                                            output = cbreturn.buf
-                                        else:
-                                            output += cbreturn.buf
-                                    #Change the callback to handle future output from this cmd
-                                    if cbreturn.nextcb:
-                                        cmddebug('ssh cmd: updating to new callback provided in cb return nextcb')
-                                        cb = cbreturn.nextcb
-                                    #Remove all callbacks
-                                    if cbreturn.removecb:
-                                        cmddebug('ssh cmd: removing all callbacks per cb return removecb value')
-                                        cb = None
-                                    #Send a string to the channel provided in callback (similar to expect)
-                                    if cbreturn.sendstring is not None:
-                                        if verbose:
-                                            cmddebug('Sending string:' + str(cbreturn.sendstring))
-                                        chan.send(s=str(cbreturn.sendstring))
-                                        cmddebug('channel status after sending string. Is closed = ' + str(chan.closed))
-                            else:
-                                #if no call back then append output to return dict and handle debug
-                                if output == None:
-                                    output = new
-                                else:
-                                    output += new
-                                if verbose:
-                                    #Dont print line by line output if cb is used, let cb handle that 
-                                    newdebug += new
-                        else:
-                            status = self.lastexitcode = chan.recv_exit_status()
+                if not rl:
+                    if enable_debug:
+                        self.debug('ssh cmd: len of rl was < 0')
+                    continue
+                cmddebug('ssh cmd: got input on recv channel')
+                eof = False
+                #Drain everything currently buffered on the channel in large reads
+                while True:
+                    try:
+                        new = chan.recv(self.recv_bufsize)
+                    except socket.timeout:
+                        #Nothing left to read right now, go back to waiting on select()
+                        break
+                    if not new:
+                        eof = True
+                        break
+                    if verbose:
+                        cmddebug('ssh cmd: got new data on channel:"' + str(new) + '"')
+                    #We have data to handle...
+                    #Run call back if there is one, let call back handle data read in
+                    if cb is not None:
+                        if enable_debug:
+                            cbname = 'unknown'
+                            try:
+                                cbname = str(cb.im_func.func_code.co_name)
+                            except: pass
+                            self.debug('ssh cmd: sending new data to callback: ' + str(cbname))
+                        #If cb returns false break, end rx loop, return cmd outcome/output dict.
+                        cbreturn = cb(new, *cbargs)
+                        #Let the callback control whether or not to continue
+                        if cbreturn.stop:
+                            cmddebug('ssh cmd: callback sent stop')
+                            if cbreturn.buf:
+                                output.append(cbreturn.buf)
+                            cbfired = True
                             chan.close()
+                            #Let the callback dictate the return code, otherwise -1 for connection err may occur
+                            if cbreturn.statuscode != -1:
+                                status = cbreturn.statuscode
+                            else:
+                                status = self.lastexitcode = chan.recv_exit_status()
                             break
-                    if newdebug and verbose:
-                        self.debug(str(newdebug))
-                        newdebug = ''
-                elif enable_debug:
-                    self.debug('ssh cmd: len of rl was < 0')
+                        #Let the callback update its calling args if needed
+                        if cbreturn.nextargs is not None:
+                            cbargs = cbreturn.nextargs
+                        #Let the callback update/reset the timeout if needed
+                        if cbreturn.settimer > 0:
+                            start = time.time()
+                            timeout = cbreturn.settimer
+                        #Let the callback update the output buffer to be returned
+                        if cbreturn.buf:
+                            cmddebug('ssh cmd: cb returned buf:"' + str(cbreturn.buf) + '"')
+                            output.append(cbreturn.buf)
+                        #Change the callback to handle future output from this cmd
+                        if cbreturn.nextcb:
+                            cmddebug('ssh cmd: updating to new callback provided in cb return nextcb')
+                            cb = cbreturn.nextcb
+                        #Remove all callbacks
+                        if cbreturn.removecb:
+                            cmddebug('ssh cmd: removing all callbacks per cb return removecb value')
+                            cb = None
+                        #Send a string to the channel provided in callback (similar to expect)
+                        if cbreturn.sendstring is not None:
+                            if verbose:
+                                cmddebug('Sending string:' + str(cbreturn.sendstring))
+                            chan.send(s=str(cbreturn.sendstring))
+                            cmddebug('channel status after sending string. Is closed = ' + str(chan.closed))
+                    else:
+                        #if no call back then append output to return list and handle debug
+                        output.append(new)
+                        if verbose:
+                            #Dont print line by line output if cb is used, let cb handle that
+                            newdebug.append(new)
+                if newdebug and verbose:
+                    self.debug("\n" + "".join(newdebug))
+                    newdebug = []
+                if eof and not chan.closed:
+                    #Remote side has sent EOF, no more output will arrive for this cmd
+                    status = self.lastexitcode = chan.recv_exit_status()
+                    chan.close()
             cmddebug('ssh cmd: channel closed')
-            if output is None:
-                output = ""
+            output = "".join(output)
             if listformat:
                 #return output as list of lines
                 output = output.splitlines()
@@ -552,6 +753,9 @@ class SshConnection():
             elapsed = str(int(time.time() - start))
             self.debug("Command (" + cmd + ") timeout exception after " + str(elapsed) + " seconds\nException")
             raise cte
+        finally:
+            if session_lock:
+                session_lock.release()
         return ret
 
     def refresh_connection(self):
@@ -560,18 +764,36 @@ class SshConnection():
         ssh obj.
         """
         if self.connection:
-            self.connection.close()
-        self.connection = self.get_ssh_connection(self.host,
-                                                  username=self.username,
-                                                  password=self.password,
-                                                  keypath=self.keypath,
-                                                  proxy_username=self.proxy_username,
-                                                  proxy_password=self.proxy_password,
-                                                  proxy_keypath=self.proxy_keypath,
-                                                  enable_ipv6_dns=self.enable_ipv6_dns,
-                                                  timeout=self.timeout,
-                                                  retry=self.retry,
-                                                  verbose=self.debug_connect)
+            if self.use_pool:
+                self.pool.evict(self.pool_key, self.connection)
+            else:
+                self.connection.close()
+        self.connection = self._connect()
+
+    @property
+    def pool_key(self):
+        return self.pool.get_key(self.host, username=self.username, proxy=self.proxy,
+                                 proxy_username=self.proxy_username, keypath=self.keypath,
+                                 password=self.password)
+
+    def _connect(self):
+        """
+        Returns a connected paramiko ssh client for this obj, from the ssh_connection_pool if use_pool is set
+        """
+        connect_method = lambda: self.get_ssh_connection(self.host,
+                                                         username=self.username,
+                                                         password=self.password,
+                                                         keypath=self.keypath,
+                                                         proxy_username=self.proxy_username,
+                                                         proxy_password=self.proxy_password,
+                                                         proxy_keypath=self.proxy_keypath,
+                                                         enable_ipv6_dns=self.enable_ipv6_dns,
+                                                         timeout=self.timeout,
+                                                         retry=self.retry,
+                                                         verbose=self.debug_connect)
+        if self.use_pool:
+            return self.pool.acquire(self.pool_key, connect_method)
+        return connect_method()
 
     def get_ssh_connection(self,
                            hostname,
@@ -999,7 +1221,12 @@ class SshConnection():
 
 
     def close(self):
-        self.connection.close()
+        if self.use_pool:
+            if self.connection:
+                self.pool.release(self.pool_key, self.connection)
+                self.connection = None
+        else:
+            self.connection.close()
 
 
 class CommandExitCodeException(Exception):
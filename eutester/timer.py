@@ -1,8 +1,223 @@
 #!/usr/bin/python
+'''
+Timing helpers.
 
+Metrics is a lightweight, thread safe, in memory span/metric recorder. Operations are timed with the
+span() context manager or the timed() decorator and aggregated per operation name into count, total,
+min, max and p50/p95/p99. Results can be shown as a table or exported as JSON.
+A shared instance is provided as eutester.timer.metrics, example:
+
+    from eutester.timer import metrics
+
+    with metrics.span('ssh.cmd'):
+        ssh.cmd('uptime')
+
+    @metrics.timed('ec2.monitor_instances')
+    def monitor(...):
+
+    metrics.show_stats()
+    metrics.export_json('/tmp/metrics.json')
+
+TokenBucket paces concurrent requests to a target rate, see EC2ops.issue_requests().
+
+Timer is the older per-call log file timer and is kept for compatibility, its timings are also recorded
+to the shared metrics instance.
+'''
+import sys
 import time
 import uuid
 import random
+import json
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from prettytable import PrettyTable
+
+
+class Metrics(object):
+    #Max samples kept per operation for percentiles, further samples are reservoir sampled
+    max_samples = 10000
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._ops = {}
+        self.created = time.time()
+
+    def record(self, name, elapsed):
+        """
+        Record a single timing sample of 'elapsed' seconds for operation 'name'
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            op = self._ops.get(name)
+            if op is None:
+                op = self._ops[name] = {'count': 0, 'total': 0.0, 'min': None, 'max': 0.0, 'samples': []}
+            op['count'] += 1
+            op['total'] += elapsed
+            if op['min'] is None or elapsed < op['min']:
+                op['min'] = elapsed
+            if elapsed > op['max']:
+                op['max'] = elapsed
+            samples = op['samples']
+            if len(samples) < self.max_samples:
+                samples.append(elapsed)
+            else:
+                index = random.randint(0, op['count'] - 1)
+                if index < self.max_samples:
+                    samples[index] = elapsed
+
+    @contextmanager
+    def span(self, name):
+        """
+        Context manager recording the time spent in the with block as operation 'name',
+        including when the block raises.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - start)
+
+    def timed(self, name=None):
+        """
+        Decorator recording each call of the decorated function as operation 'name',
+        default name is the function's name.
+        """
+        def decorator(func):
+            opname = name or func.__name__
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(opname, time.time() - start)
+            return wrapper
+        return decorator
+
+    def instrument_boto_connection(self, connection, prefix):
+        """
+        Records every request made through a boto connection as '<prefix>.<action>', ie: ec2.DescribeInstances,
+        s3.GET. Wraps the connection object's make_request, so all api calls made with it are timed.
+        """
+        if getattr(connection, '_eutester_metrics', None):
+            return connection
+        make_request = connection.make_request
+        @wraps(make_request)
+        def timed_make_request(*args, **kwargs):
+            action = args[0] if args else (kwargs.get('action') or kwargs.get('method'))
+            start = time.time()
+            try:
+                return make_request(*args, **kwargs)
+            finally:
+                self.record(str(prefix) + '.' + str(action), time.time() - start)
+        connection.make_request = timed_make_request
+        connection._eutester_metrics = self
+        return connection
+
+    @staticmethod
+    def get_percentile(sorted_samples, percent):
+        if not sorted_samples:
+            return None
+        index = int(round((percent / 100.0) * (len(sorted_samples) - 1)))
+        return sorted_samples[index]
+
+    def get_stats(self, name=None):
+        """
+        Returns dict of operation name to dict of count, total, mean, min, max, p50, p95 and p99 (seconds)
+        name - optional - only return stats for operations starting with this string
+        """
+        stats = {}
+        with self._lock:
+            ops = [(opname, dict(op, samples=list(op['samples']))) for opname, op in self._ops.iteritems()
+                   if not name or opname.startswith(name)]
+        for opname, op in ops:
+            samples = sorted(op['samples'])
+            stats[opname] = {'count': op['count'],
+                             'total': op['total'],
+                             'mean': op['total'] / (op['count'] or 1),
+                             'min': op['min'],
+                             'max': op['max'],
+                             'p50': self.get_percentile(samples, 50),
+                             'p95': self.get_percentile(samples, 95),
+                             'p99': self.get_percentile(samples, 99)}
+        return stats
+
+    def show_stats(self, name=None, printmethod=None, printme=True):
+        """
+        Print (or return) a table of operation stats sorted by total time spent
+        """
+        pt = PrettyTable(['OPERATION', 'COUNT', 'TOTAL', 'MEAN', 'P50', 'P95', 'P99', 'MAX'])
+        pt.align['OPERATION'] = 'l'
+        stats = self.get_stats(name=name)
+        for opname in sorted(stats, key=lambda x: stats[x]['total'], reverse=True):
+            op = stats[opname]
+            pt.add_row([opname, op['count']] +
+                       ["{0:.3f}".format(op[key]) for key in ['total', 'mean', 'p50', 'p95', 'p99', 'max']])
+        if not printme:
+            return pt
+        printmethod = printmethod or (lambda msg: sys.stdout.write(msg + "\n"))
+        printmethod("\n" + str(pt) + "\n")
+
+    def export_json(self, filepath=None, name=None):
+        """
+        Returns the operation stats as a json string, and writes it to 'filepath' if provided
+        """
+        output = json.dumps({'created': self.created,
+                             'exported': time.time(),
+                             'operations': self.get_stats(name=name)}, indent=2, sort_keys=True)
+        if filepath:
+            with open(filepath, 'w') as jsonfile:
+                jsonfile.write(output)
+        return output
+
+    def reset(self):
+        with self._lock:
+            self._ops = {}
+            self.created = time.time()
+
+#Shared metrics instance used by the eutester/eucaops instrumentation
+metrics = Metrics()
+span = metrics.span
+timed = metrics.timed
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket used to pace requests to a target rate.
+    Tokens are refilled at 'rate' per second up to 'burst', consume() blocks until a token is available.
+    A rate of None or 0 disables pacing.
+    """
+    def __init__(self, rate=None, burst=None):
+        self.rate = float(rate or 0)
+        self.burst = float(burst or max(1, self.rate))
+        self.tokens = self.burst
+        self.last = time.time()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def consume(self, tokens=1):
+        """
+        Blocks until 'tokens' are available, returns the time spent waiting
+        """
+        if not self.rate:
+            return 0
+        waited = 0
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + ((now - self.last) * self.rate))
+                self.last = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    self.waited += waited
+                    return waited
+                sleep_time = (tokens - self.tokens) / self.rate
+            time.sleep(sleep_time)
+            waited += sleep_time
+
 
 class TimeUnit:
     def __init__(self):
@@ -30,6 +245,7 @@ class Timer:
 
     def end(self, id, msg):
         self._timers[id].end()
+        metrics.record(msg, self._timers[id].elapsed())
         self._log.write(msg + "\tid: %s\t%fms\n" % (id, self._timers[id].elapsed()*1000))
         if self._debug:
             print("elapsed: " + self._timers[id].elapsed()*1000 + "ms")
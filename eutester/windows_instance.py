@@ -389,6 +389,8 @@ class WinInstanceLogicalDisk(WinInstanceDiskType):
 class WinInstance(EuInstance, TaggedResource):
     gigabyte = 1073741824
     megabyte = 1048576
+    # Fetch all disk info in one winrm round trip, see get_disk_inventory()
+    use_disk_inventory = True
 
     @classmethod
     def make_euinstance_from_instance(cls,
@@ -481,6 +483,7 @@ class WinInstance(EuInstance, TaggedResource):
         newins.disk_partitions = []
         newins.logicaldisks = []
         newins.cygwin_dev_map  = {}
+        newins.disk_inventory_stats = {'updates': 0, 'parsed': 0, 'reused': 0}
         #newins.set_block_device_prefix()
         if newins.root_device_type == 'ebs':
             try:
@@ -793,6 +796,18 @@ class WinInstance(EuInstance, TaggedResource):
             raise Exception("WinInstance winrm connection is None")
         return self.winrm.sys(command=cmd, include_stderr=include_stderr, timeout=timeout, verbose=verbose, code=code)
 
+    def sys_batch(self, cmds, verbose=True, code=None, timeout=None):
+        '''
+        Issues a list of commands in a single winrm round trip
+        Returns a list with the list of stdout lines of each command, in order
+        cmds - mandatory - list of command strings
+        code - optional - integer, expected exit code of every command
+        timeout - optional - timeout in seconds for the whole batch
+        '''
+        if (self.winrm is None):
+            raise Exception("WinInstance winrm connection is None")
+        return self.winrm.sys_batch(cmds, timeout=timeout, verbose=verbose, code=code)
+
 
 
 
@@ -1025,6 +1040,8 @@ class WinInstance(EuInstance, TaggedResource):
             if not forceupdate and (time.time() - self.diskdrives[0].last_updated) <= self.disk_update_interval:
                 return
         self.debug('Fetching updated disk info...')
+        if self.use_disk_inventory:
+            return self.update_disk_info_from_inventory()
         self.diskdrives = []
         self.disk_partitions = []
         self.logicaldisks = []
@@ -1034,6 +1051,88 @@ class WinInstance(EuInstance, TaggedResource):
         self.associate_diskdrives_to_partitions()
         self.associate_partitions_to_logicaldrives()
 
+    def get_disk_inventory(self, prefix='/dev/*', verbose=False):
+        '''
+        Fetches the diskdrive, partition, logicaldisk and partition to logicaldisk association info as well as
+        the cygwin to windows device mapping from the guest in a single winrm round trip. See sys_batch()
+        :param prefix: cygwin device glob used for the cygwin device mapping
+        :returns dict with 'diskdrives', 'partitions', 'logicaldisks' and 'associations' lists of the parsed
+                 wmic output (see iter_wmic_dicts()) and the 'cygwin_dev_map' dict.
+                 The wmic lists are generators, so are parsed as they are consumed.
+        '''
+        cmds = ['wmic diskdrive list full < NUL',
+                'wmic partition list brief /format:textvaluelist.xsl < NUL',
+                'wmic logicaldisk list /format:textvaluelist.xsl < NUL',
+                'wmic path Win32_LogicalDiskToPartition get Antecedent,Dependent /format:textvaluelist.xsl < NUL',
+                self.get_cygwin_path() + '\\bin\\bash.exe --login -c "for DEV in ' + prefix +
+                ' ; do printf $DEV=$(cygpath -w $DEV); echo \'\'; done"']
+        diskdrives, partitions, logicaldisks, associations, cygwin_output = \
+            self.sys_batch(cmds, code=0, verbose=verbose)
+        return {'diskdrives': self.iter_wmic_dicts(diskdrives),
+                'partitions': self.iter_wmic_dicts(partitions),
+                'logicaldisks': self.iter_wmic_dicts(logicaldisks),
+                'associations': self.iter_wmic_dicts(associations),
+                'cygwin_dev_map': self.parse_cygwin_device_map(cygwin_output, prefix=prefix)}
+
+    def update_disk_info_from_inventory(self):
+        '''
+        Updates self.diskdrives, self.disk_partitions and self.logicaldisks from a single get_disk_inventory()
+        request. Disk objects whose wmic info has not changed since the last update are reused rather than
+        re-created.
+        '''
+        inventory = self.get_disk_inventory()
+        self.cygwin_dev_map = inventory['cygwin_dev_map']
+        self.disk_inventory_stats['updates'] += 1
+        self.diskdrives = self.get_changed_disk_objects(WinInstanceDiskDrive, inventory['diskdrives'],
+                                                        self.diskdrives)
+        self.disk_partitions = self.get_changed_disk_objects(WinInstanceDiskPartition, inventory['partitions'],
+                                                             self.disk_partitions)
+        self.logicaldisks = self.get_changed_disk_objects(WinInstanceLogicalDisk, inventory['logicaldisks'],
+                                                          self.logicaldisks)
+        self.associate_diskdrives_to_partitions()
+        associations = list(inventory['associations'])
+        if associations or not self.disk_partitions:
+            self.associate_partitions_to_logicaldrives(associations=associations)
+        else:
+            self.associate_partitions_to_logicaldrives()
+        self.debug('Updated disk info from inventory, objects parsed:' +
+                   str(self.disk_inventory_stats['parsed']) + ', reused:' +
+                   str(self.disk_inventory_stats['reused']))
+
+    def get_changed_disk_objects(self, disk_class, wmic_dicts, existing):
+        '''
+        Creates disk_class objects from wmic_dicts, reusing the object from 'existing' when its wmic info
+        is unchanged
+        :param disk_class: WinInstanceDiskType subclass
+        :param wmic_dicts: iterable of parsed wmic dicts
+        :param existing: list of disk_class objects from the previous update
+        :returns list of disk_class objects
+        '''
+        existing = dict((disk.wmic_signature, disk) for disk in existing if hasattr(disk, 'wmic_signature'))
+        disks = []
+        for wmic_dict in wmic_dicts:
+            signature = hash(tuple(sorted(wmic_dict.items())))
+            disk = existing.pop(signature, None)
+            if disk:
+                self.disk_inventory_stats['reused'] += 1
+                disk.last_updated = time.time()
+                if isinstance(disk, WinInstanceDiskDrive) and not (disk.ebs_volume and disk.md5):
+                    #Attached volume info may have been updated since this drive was created
+                    disk.update_ebs_info()
+            else:
+                self.disk_inventory_stats['parsed'] += 1
+                try:
+                    disk = disk_class(self, wmic_dict)
+                except Exception, e:
+                    tb = self.tester.get_traceback()
+                    self.debug('Error attempting to create ' + str(disk_class.__name__) + ' from following dict:')
+                    self.print_dict(dict=wmic_dict)
+                    raise Exception(str(tb) + "\n Error attempting to create " + str(disk_class.__name__) +
+                                    ":" + str(e))
+                disk.wmic_signature = signature
+            disks.append(disk)
+        return disks
+
     def get_updated_diskdrive_info(self):
         '''
         Populate self.diskdrives with WinInstanceDisk objects containing info parsed from wmic command.
@@ -1106,7 +1205,26 @@ class WinInstance(EuInstance, TaggedResource):
                 if part.diskindex == disk.index:
                     disk.disk_partitions.append(part)
 
-    def associate_partitions_to_logicaldrives(self, verbose=False):
+    def associate_partitions_to_logicaldrives(self, verbose=False, associations=None):
+        '''
+        :param associations: optional list of parsed Win32_LogicalDiskToPartition wmic dicts, see
+                             get_disk_inventory(). If not provided each partition's logical disks are queried
+        '''
+        if associations is not None:
+            partitions = dict((str(part.deviceid), part) for part in self.disk_partitions)
+            logicaldisks = dict((str(disk.deviceid), disk) for disk in self.logicaldisks)
+            for part in self.disk_partitions:
+                part.logicaldisks = []
+            for association in associations:
+                part_id = re.search('DeviceID="([^"]+)"', association.get('antecedent', ''))
+                drive_id = re.search('DeviceID="([^"]+)"', association.get('dependent', ''))
+                if part_id and drive_id:
+                    part = partitions.get(part_id.group(1))
+                    disk = logicaldisks.get(drive_id.group(1))
+                    if part and disk:
+                        part.logicaldisks.append(disk)
+                        disk.partition = part
+            return
         for part in self.disk_partitions:
             drive_id = None
             part.logicaldisks = []
@@ -1172,14 +1290,21 @@ class WinInstance(EuInstance, TaggedResource):
 
         '''
         self.debug('get_parsed_wmic_command_output, command:' + str(wmic_command))
-        ret_dicts = []
         output = self.sys(wmic_command, verbose=verbose, code=0)
+        return list(self.iter_wmic_dicts(output))
+
+    def iter_wmic_dicts(self, output):
+        '''
+        Parses lines of wmic key value output, yielding a dict for each object as soon as it is complete.
+        Note keys will be in lowercase
+        :param output: iterable of lines
+        '''
         newdict = {}
         for line in output:
             if not re.match(r"^\w",line):
                 #If there is a blank line(s) then the previous object is complete
                 if newdict:
-                    ret_dicts.append(newdict)
+                    yield newdict
                     newdict = {}
             else:
                 splitline = line.split('=')
@@ -1192,7 +1317,8 @@ class WinInstance(EuInstance, TaggedResource):
                     else:
                         value = ''
                 newdict[key] = value
-        return ret_dicts
+        if newdict:
+            yield newdict
 
     def get_logicaldisk_ids(self, forceupdate=False):
         '''
@@ -1636,20 +1762,25 @@ class WinInstance(EuInstance, TaggedResource):
             self.debug('Updating cygwin to windows device mapping...')
             output = self.cygwin_cmd("for DEV in " + prefix + " ; do printf $DEV=$(cygpath -w $DEV); echo ''; done",
                                      verbose=False, code=0)
-            for line in output:
-                if re.match(prefix, line):
-                    split = line.split('=')
-                    key = split.pop(0)
-                    if split:
-                        value = split.pop()
-                    else:
-                        value = ''
-                    cygwin_dev_map[key]=value
-            cygwin_dev_map['last_updated'] = time.time()
+            cygwin_dev_map = self.parse_cygwin_device_map(output, prefix=prefix)
             self.cygwin_dev_map = cygwin_dev_map
             self.debug('Updated cygwin to windows device mapping')
         return cygwin_dev_map
 
+    def parse_cygwin_device_map(self, output, prefix='/dev/*'):
+        cygwin_dev_map = {}
+        for line in output:
+            if re.match(prefix, line):
+                split = line.split('=')
+                key = split.pop(0)
+                if split:
+                    value = split.pop()
+                else:
+                    value = ''
+                cygwin_dev_map[key]=value
+        cygwin_dev_map['last_updated'] = time.time()
+        return cygwin_dev_map
+
 
     def rescan_disks(self, timeout=20):
         '''
@@ -44,9 +44,16 @@ import copy
 import sys
 import time
 import re
+from eutester.timer import Metrics, metrics
 
 
 class Winrm_Connection:
+    # Keep one shell open and reuse it for each command, rather than opening and closing a shell per command
+    reuse_shell = True
+    # A reused shell idle for longer than this many seconds is health checked before use
+    shell_check_interval = 60
+    # Max seconds to back off between output polls returning no data
+    output_poll_max_interval = 1
 
     def __init__(self,
                  hostname,
@@ -72,6 +79,9 @@ class Winrm_Connection:
         self.shell_id = None
         self.command_id = None
         self.last_used = None
+        #Per command latency stats for this connection, see show_cmd_stats()
+        self.cmd_stats = Metrics()
+        self.shell_stats = {'opened': 0, 'reused': 0, 'reopened': 0, 'checks': 0}
 
         self.verbose = verbose
 
@@ -103,7 +113,10 @@ class Winrm_Connection:
         while retry < retries:
             retry += 1
             try:
-                self.shell_id = self.winproto.open_shell()
+                with metrics.span('winrm.open_shell'):
+                    self.shell_id = self.winproto.open_shell()
+                self.shell_stats['opened'] += 1
+                self.last_used = time.time()
                 return self.shell_id
             except WinRMTransportError, wte:
                 print "Failed to open shell on attempt#:" + str(retry) + "/" + str(retries)+ ", err:" + str(wte)
@@ -116,25 +129,85 @@ class Winrm_Connection:
         self.debug(str(tb))
         raise Exception('Could not open shell to ' + str(self.url) + str(e))
 
-    def cmd(self, command, console_mode_stdin=True, skip_cmd_shell=False, timeout=None, verbose=None):
+    def get_shell(self, timeout=None):
+        """
+        Returns an open shell id. When reuse_shell is set the existing shell is reused, after a health check
+        if it has been idle longer than shell_check_interval, otherwise a new shell is opened.
+        """
+        timeout = timeout or self.default_command_timeout
+        self.winproto.transport.timeout = timeout
+        if not self.reuse_shell or not self.shell_id:
+            return self.reset_shell(timeout=timeout)
+        if self.last_used and (time.time() - self.last_used) > self.shell_check_interval:
+            if not self.check_shell():
+                self.shell_stats['reopened'] += 1
+                return self.reset_shell(timeout=timeout)
+        self.shell_stats['reused'] += 1
+        return self.shell_id
+
+    def check_shell(self):
+        """
+        Runs a no-op command in the current shell, returns True if the shell is usable
+        """
+        if not self.shell_id:
+            return False
+        self.shell_stats['checks'] += 1
+        command_id = None
+        try:
+            command_id = self.winproto.run_command(self.shell_id, 'echo', arguments=['.'])
+            self.winproto.get_command_output(self.shell_id, command_id)
+            self.last_used = time.time()
+            return True
+        except Exception, e:
+            self.debug('Winrm shell health check failed, shell will be reopened. Err:' + str(e))
+            return False
+        finally:
+            if command_id:
+                try:
+                    self.winproto.cleanup_command(self.shell_id, command_id)
+                except: pass
+
+    def run_command(self, command, arguments, console_mode_stdin=True, skip_cmd_shell=False, timeout=None):
+        """
+        Starts command in the current shell, if the reused shell fails to run it the shell is reopened
+        and the command is run once more.
+        """
+        self.get_shell(timeout=timeout)
+        try:
+            return self.winproto.run_command(self.shell_id, command, arguments=arguments,
+                                             console_mode_stdin=console_mode_stdin,
+                                             skip_cmd_shell=skip_cmd_shell)
+        except Exception, e:
+            if not self.reuse_shell:
+                raise
+            self.debug('Failed to run command in existing winrm shell, reopening shell. Err:' + str(e))
+            self.shell_stats['reopened'] += 1
+            self.reset_shell(timeout=timeout)
+            return self.winproto.run_command(self.shell_id, command, arguments=arguments,
+                                             console_mode_stdin=console_mode_stdin,
+                                             skip_cmd_shell=skip_cmd_shell)
+
+    def cmd(self, command, console_mode_stdin=True, skip_cmd_shell=False, timeout=None, verbose=None,
+            stats_key=None):
         errmsg = ""
+        failed = False
         if verbose is None:
             verbose = self.verbose
         orig_cmd = copy.copy(command)
         arguments = command.split(' ')
         command = arguments.pop(0)
         self.command_id = None
+        start = time.time()
 
         #if timeout is not None:
             #convert timeout to ISO8601 format
             #timeout = self.convert_iso8601_timeout(timeout)
-        self.reset_shell(timeout=timeout)
         try:
-            self.command_id= self.winproto.run_command(self.shell_id,
-                                      command,
-                                      arguments=arguments,
-                                      console_mode_stdin=console_mode_stdin,
-                                      skip_cmd_shell=skip_cmd_shell)
+            self.command_id = self.run_command(command,
+                                               arguments=arguments,
+                                               console_mode_stdin=console_mode_stdin,
+                                               skip_cmd_shell=skip_cmd_shell,
+                                               timeout=timeout)
             self.debug('winrm timeout:' + str(timeout) + ', cmd:' + str(orig_cmd))
             if timeout is not None:
                 sockdefault = socket.getdefaulttimeout()
@@ -148,6 +221,9 @@ class Winrm_Connection:
         except CommandTimeoutException as cte:
             self.debug(str(cte))
             errmsg = 'timed out'
+        except Exception:
+            failed = True
+            raise
         finally:
             try:
                 #self.winproto.transport.timeout = self.default_command_timeout
@@ -155,7 +231,14 @@ class Winrm_Connection:
                     socket.setdefaulttimeout(sockdefault)
                 self.winproto.cleanup_command(self.shell_id, self.command_id)
             except: pass
-            self.close_shell()
+            #Keep the shell for the next command unless this one failed
+            if errmsg or failed or not self.reuse_shell:
+                self.close_shell()
+            else:
+                self.last_used = time.time()
+            elapsed = time.time() - start
+            metrics.record('winrm.cmd', elapsed)
+            self.cmd_stats.record(stats_key or ' '.join([command] + arguments[:1]), elapsed)
         if errmsg:
             if re.search('timed out', errmsg, re.IGNORECASE):
                 raise CommandTimeoutException('ERROR: Timed out after:' +
@@ -167,7 +250,40 @@ class Winrm_Connection:
             self.debug("\n" + str(stdout) + "\n" + str(stderr))
         return {'stdout':stdout, 'stderr':stderr, 'statuscode':statuscode}
 
-
+    def cmd_batch(self, commands, timeout=None, verbose=None):
+        """
+        Runs a list of commands in one round trip, as a single cmd.exe invocation with a marker echoed to
+        stdout and stderr after each command to split the output. Commands run in order regardless of the
+        status of the previous command. Each status is read with 'call echo %^errorlevel%', which expands
+        errorlevel when the marker runs rather than when the line is parsed, so delayed expansion ('!')
+        is not enabled for the caller's commands.
+        :param commands: list of command strings
+        :returns: list of dicts with 'command', 'stdout', 'stderr' and 'statuscode' per command
+        """
+        marker = 'EUTESTER_BATCH_' + str(int(time.time() * 1000))
+        parts = []
+        for index, command in enumerate(commands):
+            parts.append(command)
+            parts.append('call echo ' + marker + ':' + str(index) + ':%^errorlevel%')
+            parts.append('echo ' + marker + ':' + str(index) + ' 1>&2')
+        output = self.cmd('cmd /S /C "' + ' & '.join(parts) + '"', timeout=timeout, verbose=verbose,
+                          stats_key='batch')
+        results = [{'command': command, 'stdout': '', 'stderr': '', 'statuscode': None} for command in commands]
+        marker_re = re.compile('^' + marker + ':(\d+)(?::(-?\d+))?\s*$')
+        for key in ['stdout', 'stderr']:
+            index = 0
+            lines = []
+            for line in (output[key] or '').splitlines(True):
+                match = marker_re.match(line)
+                if match and index < len(results):
+                    results[index][key] = ''.join(lines)
+                    if match.group(2) is not None:
+                        results[index]['statuscode'] = int(match.group(2))
+                    index += 1
+                    lines = []
+                else:
+                    lines.append(line)
+        return results
 
     def get_timed_command_output(self, shell_id, command_id, active_timeout=0):
         """
@@ -181,22 +297,44 @@ class Winrm_Connection:
         stdout_buffer, stderr_buffer = [], []
         command_done = False
         start = time.time()
+        poll_interval = 0
         while not command_done:
             elapsed = time.time()-start
             if active_timeout and (elapsed > active_timeout):
                 raise CommandTimeoutException('Active timeout fired after:' + str(elapsed))
+            if poll_interval:
+                time.sleep(poll_interval)
             stdout, stderr, return_code, command_done = \
                 self.winproto._raw_get_command_output(shell_id, command_id)
             stdout_buffer.append(stdout)
             stderr_buffer.append(stderr)
+            #Back off while polls return no data, poll immediately again once data arrives
+            if stdout or stderr:
+                poll_interval = 0
+            else:
+                poll_interval = min(self.output_poll_max_interval, (poll_interval * 2) or 0.05)
         return ''.join(stdout_buffer), ''.join(stderr_buffer), return_code
 
 
     def close_shell(self):
         if self.shell_id:
-            self.winproto.close_shell(self.shell_id)
+            try:
+                self.winproto.close_shell(self.shell_id)
+            except Exception, e:
+                self.debug('Error closing winrm shell:' + str(e))
         self.shell_id = None
 
+    def show_cmd_stats(self, printmethod=None):
+        """
+        Displays per command latency for this connection and shell open/reuse counts
+        """
+        printmethod = printmethod or self.debug
+        self.cmd_stats.show_stats(printmethod=printmethod)
+        printmethod('Winrm shells opened:' + str(self.shell_stats['opened']) +
+                    ', reused:' + str(self.shell_stats['reused']) +
+                    ', reopened on failure:' + str(self.shell_stats['reopened']) +
+                    ', health checks:' + str(self.shell_stats['checks']))
+
     def sys(self, command, include_stderr=False, listformat=True, carriage_return=False, timeout=None, code=None, verbose=None):
         ret = []
         if verbose is None:
@@ -218,6 +356,28 @@ class Winrm_Connection:
                 ret = ret.extend(output['stderr'].splitlines())
         return ret
 
+    def sys_batch(self, commands, listformat=True, carriage_return=False, timeout=None, code=None, verbose=None):
+        """
+        Runs a list of commands in one round trip, see cmd_batch()
+        Returns a list with the stdout of each command, formatted as sys() would.
+        """
+        if verbose is None:
+            verbose = self.verbose
+        ret = []
+        for output in self.cmd_batch(commands, timeout=timeout, verbose=verbose):
+            if code is not None and output['statuscode'] != code:
+                raise CommandExitCodeException('Cmd:' + str(output['command']) + ' failed with status code:'
+                                               + str(output['statuscode'])
+                                               + "\n, stdout:" + str(output['stdout'])
+                                               + "\n, stderr:" + str(output['stderr']))
+            out = output['stdout']
+            if not carriage_return:
+                out = out.replace('\r','')
+            if listformat:
+                out = out.splitlines()
+            ret.append(out)
+        return ret
+
     @classmethod
     def get_traceback(cls):
         '''
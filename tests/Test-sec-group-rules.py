@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2009-2014, Eucalyptus Systems, Inc.
+# All rights reserved.
+#
+# Redistribution and use of this software in source and binary forms, with or
+# without modification, are permitted provided that the following conditions
+# are met:
+#
+#   Redistributions of source code must retain the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer.
+#
+#   Redistributions in binary form must reproduce the above
+#   copyright notice, this list of conditions and the
+#   following disclaimer in the documentation and/or other
+#   materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+import unittest
+from eutester.sec_group_rules import CompiledRuleSet, cidr_to_range, range_to_cidr
+
+
+class CompiledRuleSetTest(unittest.TestCase):
+    def setUp(self):
+        self.rules = CompiledRuleSet(name='test')
+        self.rules.add_rule('tcp', 22, 22, cidr='10.0.0.0/8')
+        self.rules.add_rule('tcp', 8000, 8080, cidr='192.168.1.5')
+        self.rules.add_rule('udp', 53, 53, src_group='sg-12345678')
+        self.rules.add_rule('icmp', -1, -1, src_group='sg-87654321')
+
+    def test_cidr_ranges(self):
+        self.assertEqual(range_to_cidr(cidr_to_range('10.1.2.3/8')), '10.0.0.0/8')
+        self.assertEqual(range_to_cidr(cidr_to_range('192.168.1.5')), '192.168.1.5/32')
+        self.assertEqual(range_to_cidr(cidr_to_range('0.0.0.0/0')), '0.0.0.0/0')
+
+    def test_port_and_cidr(self):
+        self.assertTrue(self.rules.allows('10.200.1.1', 'tcp', 22))
+        self.assertFalse(self.rules.allows('11.0.0.1', 'tcp', 22))
+        self.assertFalse(self.rules.allows('10.200.1.1', 'tcp', 23))
+        self.assertTrue(self.rules.allows('192.168.1.5', 'tcp', 8000))
+        self.assertTrue(self.rules.allows('192.168.1.5', 'tcp', 8080))
+        self.assertFalse(self.rules.allows('192.168.1.5', 'tcp', 8081))
+        self.assertFalse(self.rules.allows('192.168.1.6', 'tcp', 8000))
+        self.assertFalse(self.rules.allows('10.200.1.1', 'udp', 22))
+
+    def test_src_group(self):
+        self.assertTrue(self.rules.allows(protocol='udp', port=53, src_group='sg-12345678'))
+        self.assertFalse(self.rules.allows(protocol='udp', port=53, src_group='sg-00000000'))
+        self.assertFalse(self.rules.allows(protocol='tcp', port=53, src_group='sg-12345678'))
+
+    def test_icmp_any_port(self):
+        for port in [-1, '-1', None, 0, 8]:
+            self.assertTrue(self.rules.allows(protocol='icmp', port=port, src_group='sg-87654321'))
+        self.assertFalse(self.rules.allows(protocol='icmp', port=-1, src_group='sg-12345678'))
+        self.assertTrue(self.rules.allows('10.0.0.1', 'tcp', -1))
+
+    def test_all_protocols(self):
+        rules = CompiledRuleSet()
+        rules.add_rule('-1', cidr='172.16.0.0/12')
+        self.assertTrue(rules.allows('172.20.1.1', 'tcp', 443))
+        self.assertTrue(rules.allows('172.20.1.1', 'udp', 1))
+        self.assertTrue(rules.allows('172.20.1.1', 'icmp', -1))
+        self.assertFalse(rules.allows('172.32.0.1', 'tcp', 443))
+
+    def test_allows_many(self):
+        self.assertEqual(self.rules.allows_many([('10.0.0.1', 'tcp', 22),
+                                                 ('10.0.0.1', 'tcp', 80),
+                                                 (None, 'udp', 53, 'sg-12345678')]),
+                         [True, False, True])
+
+    def test_diff(self):
+        other = CompiledRuleSet()
+        other.add_rule('tcp', 22, 22, cidr='10.0.0.0/8')
+        other.add_rule('tcp', 443, 443, cidr='0.0.0.0/0')
+        mine, theirs = self.rules.diff(other)
+        self.assertEqual(theirs, [('tcp', 443, 443, '0.0.0.0/0')])
+        self.assertEqual(len(mine), 3)
+        self.assertTrue(('tcp', 22, 22, '10.0.0.0/8') not in mine)
+
+
+if __name__ == "__main__":
+    unittest.main()
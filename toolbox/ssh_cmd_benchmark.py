@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+'''
+Micro-benchmark for SshConnection.cmd()
+
+Runs the same command repeatedly over one ssh connection using the current
+event driven SshConnection.cmd() receive loop and a copy of the previous
+sleep/poll receive loop, then prints commands/second for each.
+
+example:
+    ./ssh_cmd_benchmark.py 192.168.1.2 -p foobar -c 'echo hello' -n 500
+    ./ssh_cmd_benchmark.py 192.168.1.2 -k ~/.ssh/id_rsa -c 'cat /var/log/messages' -n 20
+'''
+import argparse
+import select
+import time
+from eutester.sshconnection import SshConnection
+
+
+def legacy_poll_cmd(ssh, cmd, timeout=120, get_pty=True):
+    '''
+    Reference copy of the sleep/poll receive loop SshConnection.cmd() used previously.
+    Sleeps 50ms per iteration, reads 1024 bytes at a time and concatenates strings.
+    '''
+    chan = ssh.connection.get_transport().open_session()
+    chan.settimeout(timeout)
+    if get_pty:
+        chan.get_pty()
+    chan.setblocking(0)
+    chan.exec_command(cmd)
+    fd = chan.fileno()
+    output = None
+    start = time.time()
+    while not chan.closed:
+        time.sleep(0.05)
+        rl, wl, xl = select.select([fd], [], [], timeout)
+        if int(time.time() - start) >= timeout and len(rl) < 1:
+            raise RuntimeError('Legacy cmd timed out:' + str(cmd))
+        if len(rl) > 0:
+            while chan.recv_ready():
+                new = chan.recv(1024)
+                if output is None:
+                    output = new
+                else:
+                    output += new
+    status = chan.recv_exit_status()
+    return {'output': output or "", 'status': status}
+
+
+def run_benchmark(method, count):
+    '''
+    Run method 'count' times, returns tuple (elapsed seconds, total bytes received)
+    '''
+    total_bytes = 0
+    start = time.time()
+    for x in xrange(0, count):
+        out = method()
+        total_bytes += len(out['output'])
+    return (time.time() - start, total_bytes)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare SshConnection.cmd() rate against the legacy '
+                                                 'sleep/poll receive loop')
+    parser.add_argument('host', help='Host to ssh to')
+    parser.add_argument('-u', '--username', default='root', help='ssh username, default:root')
+    parser.add_argument('-p', '--password', default=None, help='ssh password')
+    parser.add_argument('-k', '--keypath', default=None, help='path to ssh key')
+    parser.add_argument('-c', '--command', default='echo eutester', help='command to run per iteration')
+    parser.add_argument('-n', '--count', type=int, default=200, help='number of commands to run per loop')
+    args = parser.parse_args()
+
+    ssh = SshConnection(args.host, username=args.username, password=args.password, keypath=args.keypath)
+    results = []
+    results.append(('legacy poll loop',) +
+                   run_benchmark(lambda: legacy_poll_cmd(ssh, args.command), args.count))
+    results.append(('SshConnection.cmd',) +
+                   run_benchmark(lambda: ssh.cmd(args.command, verbose=False), args.count))
+    print 'Command:"{0}", iterations:{1}'.format(args.command, args.count)
+    for name, elapsed, total_bytes in results:
+        print '{0:20} elapsed:{1:8.3f}s  cmds/sec:{2:8.2f}  bytes rx:{3}'.format(
+            name, elapsed, args.count / (elapsed or 1), total_bytes)
+    ssh.close()
@@ -10,6 +10,13 @@ import tarfile
 import urllib2
 import cStringIO
 import errno
+import httplib
+import urlparse
+import hashlib
+import json
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
     
 class Tarutils():
     '''
@@ -167,48 +174,207 @@ class Local_Tarutils(Tarutils):
 class Http_Tarutils(Tarutils):
     '''
     Utility class for navigating and operating on remote tarfiles via http
+    Tar headers are read over a keep-alive connection per thread using read ahead range requests,
+    so many small members are indexed per request. The resulting member index is cached on disk
+    keyed by url + ETag.
     '''
-    def get_members(self, url = None, headersize=None, mode=None):
+    #Bytes requested per range request while walking tar headers
+    index_readahead = 64 * 1024
+    #Max number of 3xx redirects followed per request
+    max_redirects = 5
+
+    def __init__(self, uri, headersize=512, printmethod=None, fileformat=None, verbose=True,
+                 index_cache_dir=None, use_index_cache=True, worker_threads=4):
+        '''
+        index_cache_dir - optional - local dir to cache member indexes in, default <tmpdir>/eutester_tar_index
+        use_index_cache - optional - boolean, read/write member indexes from/to index_cache_dir
+        worker_threads - optional - number of members downloaded concurrently by extract_members()
+        '''
+        self.index_cache_dir = index_cache_dir or os.path.join(tempfile.gettempdir(), 'eutester_tar_index')
+        self.use_index_cache = use_index_cache
+        self.worker_threads = worker_threads
+        self.etag = None
+        self._local = threading.local()
+        Tarutils.__init__(self, uri, headersize=headersize, printmethod=printmethod,
+                          fileformat=fileformat, verbose=verbose)
+
+    def get_http_connection(self, url=None, reset=False):
+        '''
+        Returns this thread's keep-alive httplib connection for the host of url
+        reset - optional - boolean, close and replace any existing connection
+        '''
+        parsed = urlparse.urlparse(url or self.uri)
+        key = (parsed.scheme, parsed.netloc)
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get(key)
+        if conn and reset:
+            conn.close()
+            conn = None
+        if not conn:
+            if parsed.scheme == 'https':
+                conn = httplib.HTTPSConnection(parsed.netloc)
+            else:
+                conn = httplib.HTTPConnection(parsed.netloc)
+            connections[key] = conn
+        return conn
+
+    def http_request(self, url=None, method='GET', headers=None):
+        '''
+        Issue a request on this thread's keep-alive connection, reconnecting once if the server
+        closed the idle connection. 3xx redirects are followed up to max_redirects times.
+        The caller must read the entire response before the next request.
+        Returns httplib response, with the url that served it set in response.eutester_url
+        '''
+        url = url or self.uri
+        for redirect in xrange(0, self.max_redirects + 1):
+            response = self._http_request_once(url, method=method, headers=headers)
+            location = response.getheader('Location')
+            if response.status not in [301, 302, 303, 307, 308] or not location:
+                return response
+            response.read()
+            if redirect == self.max_redirects:
+                raise Exception('Too many redirects requesting:' + str(url) + ', last location:' + str(location))
+            url = urlparse.urljoin(url, location)
+            self.debug('Http request redirected (' + str(response.status) + ') to:' + str(url))
+
+    def _http_request_once(self, url, method='GET', headers=None):
+        parsed = urlparse.urlparse(url)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        for attempt in xrange(0, 2):
+            conn = self.get_http_connection(url, reset=bool(attempt))
+            try:
+                conn.request(method, path, headers=headers or {})
+                response = conn.getresponse()
+                response.eutester_url = url
+                return response
+            except (httplib.HTTPException, IOError), he:
+                if attempt:
+                    raise
+                self.debug('Http request failed on existing connection, reconnecting. Err:' + str(he))
+
+    def abort_http_response(self, response, url=None):
+        '''
+        Close a response without reading the rest of its body, ie: when a server ignored the requested
+        range and is sending the entire file. This thread's connection is replaced as it can not be reused.
+        '''
+        response.close()
+        self.get_http_connection(getattr(response, 'eutester_url', url), reset=True)
+
+    def get_index_cache_path(self, url=None, etag=None):
+        '''
+        Returns the local path of the cached member index for url and etag, or None if caching is disabled
+        or the server did not provide an ETag
+        '''
+        url = url or self.uri
+        etag = etag or self.etag
+        if not self.use_index_cache or not etag:
+            return None
+        key = hashlib.md5(str(url) + str(etag)).hexdigest()
+        return os.path.join(self.index_cache_dir, key + '.json')
+
+    def read_index_cache(self, url=None):
+        cache_path = self.get_index_cache_path(url)
+        if not cache_path or not os.path.exists(cache_path):
+            return None
+        try:
+            with open(cache_path) as cache_file:
+                member_dicts = json.load(cache_file)
+        except Exception, e:
+            self.debug('Ignoring unreadable member index cache:' + str(cache_path) + ', err:' + str(e))
+            return None
+        members = []
+        for member_dict in member_dicts:
+            member = tarfile.TarInfo(str(member_dict.pop('name')))
+            for key, value in member_dict.iteritems():
+                if isinstance(value, unicode):
+                    value = str(value)
+                setattr(member, key, value)
+            members.append(member)
+        self.debug('Read ' + str(len(members)) + ' members from index cache:' + str(cache_path))
+        return members
+
+    def write_index_cache(self, members, url=None):
+        cache_path = self.get_index_cache_path(url)
+        if not cache_path:
+            return None
+        member_dicts = []
+        for member in members:
+            member_dicts.append({'name': member.name, 'mode': member.mode, 'uid': member.uid,
+                                 'gid': member.gid, 'size': member.size, 'mtime': member.mtime,
+                                 'type': member.type, 'linkname': member.linkname,
+                                 'uname': member.uname, 'gname': member.gname,
+                                 'devmajor': member.devmajor, 'devminor': member.devminor,
+                                 'offset': member.offset, 'offset_data': member.offset_data})
+        self.make_path(cache_path)
+        tmp_path = cache_path + '.' + str(os.getpid())
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(member_dicts, cache_file)
+        os.rename(tmp_path, cache_path)
+        self.debug('Wrote member index cache:' + str(cache_path))
+        return cache_path
+
+    def get_members(self, url = None, headersize=None, mode=None, readahead=None):
         '''
         Attempts to step through all tarball headers and gather the members/file info contained within.
+        Headers are read in 'readahead' sized range requests so consecutive small members are indexed
+        without a request per header. The index is read from/written to the local index cache.
         Will update self.members with the returned list of members.
         url - optional - remote http address of tarball
         headersize - optional - tar header size to be used
         mode - optional - the file format string used for read the file (ie gzip'd or not)
+        readahead - optional - bytes per range request, default self.index_readahead
         returns a list of Tarinfo member objects
         '''
         headersize = headersize or self.headersize
         mode = mode or self.fileformat
         url = url or self.uri
+        readahead = max(readahead or self.index_readahead, headersize)
         filesize = self.filesize or self.get_file_size(url)
+        headers = self.read_index_cache(url)
+        if headers is not None:
+            self.members = headers
+            return headers
         start = 0
         headers=[]
-        end = 0 
+        end = 0
+        window = ""
+        window_start = 0
+        requests = 0
         self.debug("get_members for url:"+str(url)+", headersize:"+str(headersize)+", filesize:"+str(filesize))
         while (start+headersize) <= filesize and end < 2:
-            data = self.download_http_offset(url, start=start, offset=headersize)
-            if not len(data.getvalue().replace('\x00','')):
+            if not (window_start <= start and (start + headersize) <= (window_start + len(window))):
+                #Next header is outside of the data we already have, read ahead from this header
+                window = self.download_http_offset(url, start=start,
+                                                   offset=min(readahead, filesize - start)).getvalue()
+                window_start = start
+                requests += 1
+            data = window[start - window_start:start - window_start + headersize]
+            if not len(data.replace('\x00','')):
                 #End of Tar markers are 2 consecutive zero filled 512byte buffers
                 self.debug('Got empty header, count:'+str(end))
                 end += 1
                 start += headersize
             else:
                 end = 0
-                #print 'got data:'+str(data.read())
-                data.seek(0)
                 #get tar member info from this header
-                member = tarfile.TarInfo.frombuf(data.getvalue())
+                member = tarfile.TarInfo.frombuf(data)
                 member.offset = start
                 member.offset_data = start + headersize
                 #append tar header/member to the list
                 self.debug("Got header:"+member.name)
                 headers.append(member)
-                #move start point forward by the size of the file and header info. 
-                start = headersize + member.size
-            #must end in an increment of headersize 512 ...or maybe tarfile.fileobject.blocksize ie:1024? 
+                #move start point forward by the size of the file and header info.
+                start += headersize + member.size
+            #must end in an increment of headersize 512 ...or maybe tarfile.fileobject.blocksize ie:1024?
             if start%headersize != 0:
                 start = ((start/headersize)+1)*headersize
+        self.debug('Indexed ' + str(len(headers)) + ' members using ' + str(requests) + ' range requests')
         self.members = headers
+        self.write_index_cache(headers, url)
         return headers
             
     def get_member(self, memberpath):
@@ -255,9 +421,13 @@ class Http_Tarutils(Tarutils):
         filesize = filesize or self.filesize
         freespace = self.get_freespace(destpath)
         if member.size > freespace:
-            raise Exception(str(memberpath)+":"+str(member.size)+" exceeds destpath freespace:"+(destpath)+":"+str(freespace) )
+            raise Exception(str(member.name)+":"+str(member.size)+" exceeds destpath freespace:"+(destpath)+":"+str(freespace) )
         start = member.offset_data
         offset = member.size
+        if not offset:
+            #Empty member, don't request a range. An offset of 0/None reads to the end of the tarball
+            destfile = self.make_path(str(destpath).rstrip('/')+'/'+str(member.name))
+            return open(destfile, 'w+')
         destfile=str(destpath).rstrip('/')+'/'+str(member.name)
         file = self.get_file_offset(uri, start, offset, filesize, readsize=None,destfile=destfile)
         self.debug('Extracted member: '+str(member.name)+' to file: '+str(file.name))
@@ -277,10 +447,33 @@ class Http_Tarutils(Tarutils):
         freespace = self.get_freespace(destpath)
         if size > freespace:
             raise Exception("Extract_all size:"+str(size)+" exceeds destpath freespace:"+(destpath)+":"+str(freespace) )
-        for member in self.members:
-            file = self.extract_member_obj(member, destpath=destpath)
-            if not file.closed:
-                file.close()
+        self.extract_members(list, destpath=destpath)
+
+    def extract_members(self, memberlist=None, destpath='.', worker_threads=None):
+        '''
+        Downloads the members in memberlist concurrently, one ranged request per member,
+        using up to worker_threads keep-alive connections.
+        memberlist - optional - list of tarinfo member objects, default self.members
+        destpath - optional - local destination to download/extract to
+        worker_threads - optional - number of concurrent downloads, default self.worker_threads
+        returns list of local file paths
+        '''
+        memberlist = memberlist or self.members
+        worker_threads = worker_threads or self.worker_threads or 1
+        files = [member for member in memberlist if member.isfile()]
+        for member in memberlist:
+            if member.isdir():
+                self.make_path(str(destpath).rstrip('/') + '/' + str(member.name).rstrip('/') + '/')
+        def extract(member):
+            fileobj = self.extract_member_obj(member, destpath=destpath)
+            if not fileobj.closed:
+                fileobj.close()
+            return fileobj.name
+        if not files:
+            return []
+        with ThreadPoolExecutor(max_workers=max(1, min(worker_threads, len(files)))) as executor:
+            futures = [executor.submit(extract, member) for member in files]
+        return [future.result() for future in futures]
         
         
     def get_file_offset(self, uri=None, start=0, offset=None, filesize=None, readsize=None,destfile=None):
@@ -327,24 +520,25 @@ class Http_Tarutils(Tarutils):
             dfile = open(destfile, 'w+')
         else:
             dfile = cStringIO.StringIO()
-        #form our http request
-        request = urllib2.Request(url)
-        request.headers['Range'] = 'bytes=%s-%s' % (start, end)
-        #open http connection
-        remotefile = urllib2.urlopen(request)
+        #request the range on this thread's keep-alive connection
+        remotefile = self.http_request(url, headers={'Range': 'bytes=%s-%s' % (start, end)})
         # If content length or range is not what we expected throw an error...
         # Note: content range in bytes is formated like: "byte <start>-<end>/<total bytes>
-        range=remotefile.headers.get('Content-Range')
-        clength = int(remotefile.headers.get('Content-Length'))
-        print('Content-Range:' +str(range)+", Content-Length:"+str(clength) ) 
+        range=remotefile.getheader('Content-Range')
+        clength = int(remotefile.getheader('Content-Length'))
+        self.debug('Content-Range:' +str(range)+", Content-Length:"+str(clength) )
         if clength != total:
+            self.abort_http_response(remotefile, url)
             raise Exception("Content-length:"+str(clength)+" not equal to expected total:"+str(total)+", is range supported on remote server?")
         #Now try to parse the ranges...
         try:
             rangestart, rangeend = re.search("\d+-\d+", range).group().split('-')
         except Exception, e:
-            print "Couldn't derive rangestart and rangeend from string:"+str(range)+", err:"+str(e)
+            self.abort_http_response(remotefile, url)
+            raise Exception("Couldn't derive rangestart and rangeend from Content-Range:"+str(range)+", err:"+str(e)+
+                            ", is range supported on remote server?")
         if int(rangestart) != int(start) or int(rangeend) != int(end):
+            self.abort_http_response(remotefile, url)
             raise Exception("Range request not met. (start:"+str(start)+" vs rangestart:"+str(rangestart)+") (end:"+str(end)+" vs rangeend:"+str(rangeend)+"), is range supported on remote server?") 
         #finally get the data and return it as a filelike cString object
         for data in iter(lambda: remotefile.read(readsize), ''):
@@ -355,11 +549,35 @@ class Http_Tarutils(Tarutils):
     
     def get_file_size(self,uri=None):
         '''
-        Get remote file size for the http header
+        Get remote file size for the http header. Servers which refuse HEAD (ie: presigned urls which
+        are only signed for GET) are asked for the first byte with a ranged GET instead.
         '''
-        url = uri or self.uri   
-        site = urllib2.urlopen(url)
-        size =  int(site.headers.get('Content-Length'))
+        url = uri or self.uri
+        site = self.http_request(url, method='HEAD')
+        site.read()
+        if site.status in [403, 405]:
+            self.debug('HEAD request for:' + str(url) + ' returned status:' + str(site.status) +
+                       ', trying ranged GET')
+            site = self.http_request(url, headers={'Range': 'bytes=0-0'})
+            if site.status == 206:
+                site.read()
+                content_range = re.search('/(\d+)\s*$', str(site.getheader('Content-Range')))
+                if not content_range:
+                    raise Exception('Could not get size from Content-Range:' +
+                                    str(site.getheader('Content-Range')) + ' for:' + str(url))
+                size = int(content_range.group(1))
+            elif site.status < 300:
+                #Range ignored, the size is the length of the whole body which is not read
+                self.abort_http_response(site, url)
+                size = int(site.getheader('Content-Length'))
+            else:
+                site.read()
+                raise Exception('GET request for:' + str(url) + ' failed with status:' + str(site.status))
+        elif site.status >= 300:
+            raise Exception('HEAD request for:' + str(url) + ' failed with status:' + str(site.status))
+        else:
+            size = int(site.getheader('Content-Length'))
+        self.etag = site.getheader('ETag')
         self.filesize = size
         return size
     